@@ -25,6 +25,17 @@ NULL_STRING = str(None);
 """Null tag used to represent DB null value"""
 NULL_TAG = "<NULL>";
 
+"""Default bounds on in memory query result caches (see Util.LRUCache), by number of entries and estimated bytes.
+Least recently used entries are evicted beyond these, so long running processes don't grow without limit.
+"""
+DATA_CACHE_MAX_ENTRIES = 1000;
+DATA_CACHE_MAX_BYTES = 4*1024*1024*1024;
+
+"""Number of items sampled from large containers (e.g., query result tables) when estimating their memory use (see Util.estimateBytes).
+The estimate for the sample is scaled up by the container size, so sizing a cache entry stays cheap regardless of its size.
+"""
+ESTIMATE_SAMPLE_SIZE = 100;
+
 """Lower case strings that will be interpreted as a boolean False value"""
 FALSE_STRINGS = ("","0","false","f",str(False));
 
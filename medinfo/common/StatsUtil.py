@@ -2,8 +2,10 @@
 import sys;
 from math import log;
 from math import sqrt, exp, log as ln;
+import numpy as np;
 from scipy.stats import chi2_contingency;
 from scipy.stats import fisher_exact;
+from scipy.stats import chi2 as chi2Distribution;
 
 """Count values less than this in the contingency stats table will be considered degenerate and needing normalization.
 Will correct such values by the given adjustment value.
@@ -306,6 +308,206 @@ class ContingencyStats:
         """Short-hand for access calc function"""
         return self.calc(key);
 
+class ContingencyStatsArray:
+    """Vectorized equivalent of ContingencyStats for many 2x2 tables at once.
+    Initialize with arrays of nAB, nA, nB, N values (one element per table),
+    then calc returns an array of the statistic for every table, using numpy array operations
+    rather than constructing and calculating one ContingencyStats object per table.
+
+    Divide by zero cases yield inf / nan values instead of exceptions.
+    Fisher exact test statistics have no closed form, so are still calculated one (distinct) table at a time.
+    """
+    def __init__(self, nAB, nA, nB, N):
+        self.nAB = np.asarray(nAB, dtype=np.float64);
+        self.nA = np.asarray(nA, dtype=np.float64);
+        self.nB = np.asarray(nB, dtype=np.float64);
+        self.N = np.asarray(N, dtype=np.float64);
+
+        # Shape (2,2,nTables) so ct[i][j] is the array of cell values across tables
+        self.ct = np.array( [ [self.nAB, self.nA-self.nAB], [self.nB-self.nAB, self.N-self.nA-self.nB+self.nAB] ] );
+        self.fisherResults = None;
+
+    def normalize(self,truncateNegativeValues=False):
+        """Check for irregular table values like negative or zero values and adjust them to avoid calculation failures.
+        As ContingencyStats.normalize, only tables with degenerate values are adjusted.
+        """
+        ct = self.ct;
+        if truncateNegativeValues:
+            ct = np.where(ct < 0.0, 0.0, ct);
+        degenerateCells = (np.abs(ct) <= DEGENERATE_VALUE_THRESHOLD);
+        degenerateTables = degenerateCells.any(axis=0).any(axis=0);
+        self.ct = np.where(degenerateTables, np.where(degenerateCells, DEGENERATE_VALUE_ADJUSTMENT, ct+DEGENERATE_VALUE_ADJUSTMENT), ct);
+        self.fisherResults = None;
+
+    def calc(self, statId):
+        """Return an array of a calculated statistic by an identifying name (see ContingencyStats.calc)"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.calcArray(statId);
+
+    def calcArray(self, statId):
+        ct = self.ct;   # Short-hand convenience
+        nAB = self.nAB;
+        nA = self.nA;
+        nB = self.nB;
+        N = self.N;
+
+        if statId in ("total","N"):
+            return N;
+        elif statId in ("nA",):
+            return nA;
+        elif statId in ("nB",):
+            return nB;
+        elif statId in ("nAB","support",):
+            return ct[0][0];
+        elif statId in ("P(A)",):
+            return self["nA"] / self["total"];
+        elif statId in ("P(!A)",):
+            return 1-self["P(A)"];
+        elif statId in ("P(B)","prevalence","preTestProbability","baselineFreq"):
+            return self["nB"] / self["total"];
+        elif statId in ("SE(prevalence)",):
+            return np.sqrt( (self["prevalence"]*(1-self["prevalence"]))/self["total"] );
+        elif statId in ("prevalence95CILow",):
+            return self["prevalence"] - 1.96*self["SE(prevalence)"];
+        elif statId in ("prevalence95CIHigh",):
+            return self["prevalence"] + 1.96*self["SE(prevalence)"];
+        elif statId in ("P(!B)",):
+            return 1-self["P(B)"];
+        elif statId in ("P(AB)",):
+            return self["nAB"] / self["total"];
+        elif statId in ("P(B|A)","positivePredictiveValue","PPV","precision","postTestProbability","confidence","conditionalFreq","truePositiveAccuracy"):
+            denominator = ct[0][0]+ct[0][1];
+            # Fall back on original values that may have been very small and suppressed to 0 by loss of numerical precision
+            return np.where(denominator == 0.0, nAB / nA, ct[0][0] / denominator);
+        elif statId in ("SE(PPV)",):
+            return np.sqrt( (self["PPV"]*(1-self["PPV"]))/(ct[0][0]+ct[0][1]) );
+        elif statId in ("PPV95CILow",):
+            return self["PPV"] - 1.96*self["SE(PPV)"];
+        elif statId in ("PPV95CIHigh",):
+            return self["PPV"] + 1.96*self["SE(PPV)"];
+        elif statId in ("P(!B|A)",):
+            return 1-self["P(B|A)"];
+        elif statId in ("P(B|!A)",):
+            return ct[1][0] / (ct[1][0]+ct[1][1]);
+        elif statId in ("P(!B|!A)","negativePredictiveValue","NPV","inversePrecision","trueNegativeAccuracy"):
+            return 1-self["P(B|!A)"];
+        elif statId in ("P(A|B)","truePositiveRate","TPR","sensitivity","sens","recall"):
+            return ct[0][0] / (ct[0][0]+ct[1][0]);
+        elif statId in ("P(!A|B)","falseNegativeRate","FNR","missRate"):
+            return 1-self["P(A|B)"];
+        elif statId in ("P(A|!B)","falsePositiveRate","FPR","fallout"):
+            return ct[0][1] / (ct[0][1]+ct[1][1]);
+        elif statId in ("P(!A|!B)","trueNegativeRate","TNR","specificity","spec","inverseRecall"):
+            return 1-self["P(A|!B)"];
+        elif statId in ("F1","F1-score"):
+            precision = self["precision"];
+            recall = self["recall"];
+            return np.where(precision+recall == 0.0, 0.0, 2*precision*recall / (precision+recall));
+        elif statId in ("positiveLikelihoodRatio","+LR","LR+","LR"):
+            return self["P(A|B)"] / self["P(A|!B)"];
+        elif statId in ("negativeLikelihoodRatio","-LR","LR-"):
+            return self["P(!A|B)"] / self["P(!A|!B)"];
+        elif statId in ("oddsRatio","OR"):
+            return (ct[0][0]/ct[0][1]) / (ct[1][0]/ct[1][1]);
+        elif statId in ("SE(ln(OR))",):
+            return np.sqrt(1/ct[0][0] + 1/ct[0][1] + 1/ct[1][0] + 1/ct[1][1]);
+        elif statId in ("oddsRatio95CILow","OR95CILow"):
+            return np.exp( np.log(self["OR"]) - 1.96*self["SE(ln(OR))"] );
+        elif statId in ("oddsRatio95CIHigh","OR95CIHigh"):
+            return np.exp( np.log(self["OR"]) + 1.96*self["SE(ln(OR))"] );
+        elif statId in ("relativeRisk","RR"):
+            return self["P(B|A)"] / self["P(B|!A)"];
+        elif statId in ("SE(ln(RR))",):
+            return np.sqrt(1/ct[0][0] + 1/ct[1][0] + 1/(ct[0][0]+ct[0][1]) + 1/(ct[1][0]+ct[1][1]) );
+        elif statId in ("relativeRisk95CILow","RR95CILow"):
+            return np.exp( np.log(self["RR"]) - 1.96*self["SE(ln(RR))"] );
+        elif statId in ("relativeRisk95CIHigh","RR95CIHigh"):
+            return np.exp( np.log(self["RR"]) + 1.96*self["SE(ln(RR))"] );
+        elif statId in ("interest","freqRatio","TF*IDF","tfidf","lift","P(B|A)/P(B)"):
+            return self["P(B|A)"] / self["P(B)"];
+        elif statId in ("YatesChi2",):
+            (chi2, chi2P, validTables) = self.chi2Arrays(True);
+            return np.where(validTables, chi2, 0.0);    # Probably negative values in table, don't know how to interpret
+        elif statId in ("P-YatesChi2",):
+            (chi2, chi2P, validTables) = self.chi2Arrays(True);
+            return np.where(validTables, chi2P, 1.0);
+        elif statId in ("P-YatesChi2-NegLog",):
+            (chi2, chi2P, validTables) = self.chi2Arrays(True);
+            return np.where(validTables, self.signedNegLog(chi2P, self["OR"]), 0.0);
+        elif statId in ("P-Chi2",):
+            (chi2, chi2P, validTables) = self.chi2Arrays(False);
+            return np.where(validTables, chi2P, 1.0);
+        elif statId in ("P-Chi2-NegLog",):
+            (chi2, chi2P, validTables) = self.chi2Arrays(False);
+            return np.where(validTables, self.signedNegLog(chi2P, self["OR"]), 0.0);
+        elif statId in ("P-Fisher",):
+            (oddsRatio, fisherP, validTables) = self.fisherArrays();
+            return np.where(validTables, fisherP, 1.0);
+        elif statId in ("P-Fisher-Complement",):
+            (oddsRatio, fisherP, validTables) = self.fisherArrays();
+            return np.where(validTables, np.where(oddsRatio > 1.0, 1-fisherP, fisherP-1), 0.0);
+        elif statId in ("P-Fisher-NegLog",):
+            (oddsRatio, fisherP, validTables) = self.fisherArrays();
+            return np.where(validTables, self.signedNegLog(fisherP, oddsRatio), 0.0);
+        else:
+            raise UnrecognizedStatException("Unrecognized statistic ID: [%s]" % statId );
+
+    def chi2Arrays(self, correction):
+        """Closed form of scipy.stats.chi2_contingency for 2x2 tables (1 degree of freedom).
+        Returns (chi2, chi2P, validTables), where validTables is False for tables chi2_contingency would reject
+        (negative values or a zero expected frequency).
+        """
+        ct = self.ct;
+        total = ct[0][0]+ct[0][1]+ct[1][0]+ct[1][1];
+        rowSums = [ct[0][0]+ct[0][1], ct[1][0]+ct[1][1]];
+        columnSums = [ct[0][0]+ct[1][0], ct[0][1]+ct[1][1]];
+        validTables = (ct >= 0.0).all(axis=0).all(axis=0);
+        chi2 = np.zeros(ct.shape[2]);
+        for i in (0,1):
+            for j in (0,1):
+                expected = rowSums[i]*columnSums[j] / total;
+                validTables &= (expected != 0.0);
+                observed = ct[i][j];
+                if correction:
+                    # Yates' correction for continuity
+                    observed = observed + 0.5*np.sign(expected - observed);
+                chi2 += (observed - expected)**2 / expected;
+        chi2P = chi2Distribution.sf(chi2, 1);
+        return (chi2, chi2P, validTables);
+
+    def fisherArrays(self):
+        """scipy.stats.fisher_exact results for every table, calculating each distinct (integer) table only once.
+        Returns (oddsRatio, fisherP, validTables), where validTables is False where fisher_exact fails (negative values).
+        """
+        if self.fisherResults is None:
+            nTables = self.ct.shape[2];
+            oddsRatio = np.zeros(nTables);
+            fisherP = np.ones(nTables);
+            validTables = np.zeros(nTables, dtype=bool);
+            resultsByTable = dict();
+            integerTables = self.ct.astype(np.int64);   # As fisher_exact would convert the table to
+            for iTable in xrange(nTables):
+                tableKey = tuple(integerTables[:,:,iTable].flat);
+                if tableKey not in resultsByTable:
+                    try:
+                        resultsByTable[tableKey] = fisher_exact(self.ct[:,:,iTable]) + (True,);
+                    except ValueError:
+                        resultsByTable[tableKey] = (0.0, 1.0, False);
+                (oddsRatio[iTable], fisherP[iTable], validTables[iTable]) = resultsByTable[tableKey];
+            self.fisherResults = (oddsRatio, fisherP, validTables);
+        return self.fisherResults;
+
+    def signedNegLog(self, pValues, oddsRatios):
+        """Negative log (base 10) of P-values, negated for odds ratios <= 1,
+        such that sorting in descending order brings the most significant positive associations to the top.
+        """
+        logP = np.where(pValues > 0.0, np.log10(np.where(pValues > 0.0, pValues, 1.0)), -sys.float_info.max);
+        return np.where(oddsRatios > 1.0, -logP, logP);
+
+    def __getitem__(self, key):
+        """Short-hand for access calc function"""
+        return self.calc(key);
+
 class UnrecognizedStatException(Exception):
     def __init__( self, initStr ):
         Exception.__init__(self, initStr);
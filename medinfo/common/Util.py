@@ -9,8 +9,10 @@ import time;
 import re;
 from datetime import datetime, timedelta;
 import math;
+import itertools;
 import json;
-from Const import DEFAULT_DATE_FORMATS, NULL_STRING, FALSE_STRINGS;
+from collections import OrderedDict;
+from Const import DEFAULT_DATE_FORMATS, NULL_STRING, FALSE_STRINGS, ESTIMATE_SAMPLE_SIZE;
 
 log = logging.getLogger("CDSS")
 log.setLevel(Const.LOGGER_LEVEL)
@@ -162,6 +164,235 @@ class ProgressDots:
             self.stream.flush();
 
 
+def peakMemoryBytes():
+    """High water mark of resident memory (RSS) of this process so far, in bytes.
+    None if not available on this platform.
+    """
+    try:
+        import resource;
+    except ImportError:
+        return None;
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+    if sys.platform == "darwin":
+        return maxRSS;  # Already reported in bytes
+    return maxRSS * 1024;   # Reported in kilobytes on Linux
+
+class PhaseProfiler:
+    """Accumulate the wall time, number of calls, row and association counts,
+    and process peak memory for each named phase of a long running process,
+    so can tell which phase dominates (or regresses) beyond just ProgressDots.
+    Nested start calls for the same phase (e.g., recursion) are only timed once, at the outermost level.
+    """
+    def __init__(self):
+        self.start = time.time();
+        self.phaseNames = list();   # Keep phases in the order first encountered
+        self.statsByPhase = dict();
+
+    def getPhaseStats(self, phaseName):
+        if phaseName not in self.statsByPhase:
+            self.phaseNames.append(phaseName);
+            self.statsByPhase[phaseName] = \
+                {   "phase": phaseName,
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "rows": 0,
+                    "associations": 0,
+                    "startPeakBytes": None,
+                    "peakBytes": None,
+                    "depth": 0,
+                    "timer": None,
+                };
+        return self.statsByPhase[phaseName];
+
+    def startPhase(self, phaseName):
+        stats = self.getPhaseStats(phaseName);
+        stats["depth"] += 1;
+        if stats["depth"] == 1:
+            if stats["startPeakBytes"] is None:
+                stats["startPeakBytes"] = peakMemoryBytes();
+            stats["timer"] = time.time();
+
+    def stopPhase(self, phaseName, rows=0, associations=0):
+        """Stop timing the named phase, adding any counts of rows / associations processed in this call."""
+        stats = self.getPhaseStats(phaseName);
+        stats["rows"] += rows;
+        stats["associations"] += associations;
+        if stats["depth"] > 0:
+            stats["depth"] -= 1;
+            if stats["depth"] == 0:
+                stats["seconds"] += time.time() - stats["timer"];
+                stats["calls"] += 1;
+                stats["peakBytes"] = peakMemoryBytes();
+
+    def mergeSummary(self, summary):
+        """Add the phase statistics from another profiler's summary (e.g., from a worker process).
+        Peak memory takes the max, as it refers to separate processes.
+        """
+        for phaseSummary in summary["phases"]:
+            stats = self.getPhaseStats(phaseSummary["phase"]);
+            for key in ("calls","seconds","rows","associations"):
+                stats[key] += phaseSummary[key];
+            if phaseSummary["peakBytes"] is not None:
+                stats["peakBytes"] = max(stats["peakBytes"], phaseSummary["peakBytes"]);
+                if stats["startPeakBytes"] is None:
+                    stats["startPeakBytes"] = phaseSummary["startPeakBytes"];
+
+    def summary(self):
+        """Machine-readable (JSON compatible) dictionary of the statistics for all phases so far"""
+        phases = list();
+        for phaseName in self.phaseNames:
+            stats = self.statsByPhase[phaseName];
+            phaseSummary = dict( [(key, stats[key]) for key in ("phase","calls","seconds","rows","associations","startPeakBytes","peakBytes")] );
+            phases.append(phaseSummary);
+        return {"elapsedSeconds": time.time()-self.start, "peakBytes": peakMemoryBytes(), "phases": phases};
+
+    def formatReport(self):
+        """Tab-delimited table of the statistics for all phases so far.
+        peakMB is the process memory high water mark as of the end of the phase's last call,
+        growthMB is how much that high water mark grew since the phase first started.
+        """
+        lines = [str.join("\t", ["phase","calls","seconds","rows","associations","peakMB","growthMB"])];
+        for phaseSummary in self.summary()["phases"]:
+            peakMB = growthMB = 0.0;
+            if phaseSummary["peakBytes"] is not None:
+                peakMB = phaseSummary["peakBytes"] / 1024.0 / 1024.0;
+                growthMB = (phaseSummary["peakBytes"] - phaseSummary["startPeakBytes"]) / 1024.0 / 1024.0;
+            lines.append("%(phase)s\t%(calls)d\t%(seconds).3f\t%(rows)d\t%(associations)d" % phaseSummary + "\t%.1f\t%.1f" % (peakMB, growthMB) );
+        return str.join("\n", lines);
+
+    def writeSummary(self, filename):
+        """Write the machine-readable summary out to the named file as JSON"""
+        ofs = stdOpen(filename, "w");
+        json.dump(self.summary(), ofs, indent=2);
+        if ofs is not sys.stdout:
+            ofs.close();
+
+
+class LRUCache:
+    """Dictionary-like in memory cache (e.g., of query results), bounded by number of entries and / or estimated bytes.
+    Beyond either bound, the least recently used entries are evicted.
+    Value sizes are estimated once when stored (see estimateBytes), so values should not be modified after being stored.
+    Keeps hit / miss / eviction counters (see stats) to help size the bounds.
+    Membership checks ("in") do not count as hits or misses, nor as a use of the entry.
+    """
+    def __init__(self, maxEntries=None, maxBytes=None, sizeFunction=None):
+        self.maxEntries = maxEntries;   # None for no limit
+        self.maxBytes = maxBytes;   # None for no limit
+        self.sizeFunction = sizeFunction;
+        if self.sizeFunction is None:
+            self.sizeFunction = estimateBytes;
+        self.clear();
+
+    def clear(self):
+        """Remove all entries and reset the counters"""
+        self.entries = OrderedDict();   # Ordered from least to most recently used
+        self.bytesByKey = dict();
+        self.totalBytes = 0;
+        self.hits = 0;
+        self.misses = 0;
+        self.evictions = 0;
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1;
+            return default;
+        self.hits += 1;
+        value = self.entries.pop(key);
+        self.entries[key] = value;  # Move to most recently used end
+        return value;
+
+    def __getitem__(self, key):
+        if key not in self.entries:
+            self.misses += 1;
+            raise KeyError(key);
+        return self.get(key);
+
+    def __setitem__(self, key, value):
+        self.put(key, value);
+
+    def put(self, key, value, valueBytes=None):
+        """Store the value under the key.  If valueBytes is not given, it is estimated with the sizeFunction.
+        Callers that can size a large value more cheaply (e.g., by row count) can provide valueBytes instead.
+        """
+        if key in self.entries:
+            del self[key];
+        if valueBytes is None:
+            valueBytes = self.sizeFunction(value);
+        if self.maxBytes is not None and valueBytes > self.maxBytes:
+            log.warning("Not caching value of about %d bytes, beyond the cache limit of %d bytes" % (valueBytes, self.maxBytes) );
+            self.evictions += 1;    # Too big to keep at all
+            return;
+        self.entries[key] = value;
+        self.bytesByKey[key] = valueBytes;
+        self.totalBytes += valueBytes;
+        while (self.maxEntries is not None and len(self.entries) > self.maxEntries) or (self.maxBytes is not None and self.totalBytes > self.maxBytes):
+            (evictKey, evictValue) = self.entries.popitem(last=False);
+            self.totalBytes -= self.bytesByKey.pop(evictKey);
+            self.evictions += 1;
+
+    def __delitem__(self, key):
+        del self.entries[key];
+        self.totalBytes -= self.bytesByKey.pop(key);
+
+    def __contains__(self, key):
+        return key in self.entries;
+
+    def __len__(self):
+        return len(self.entries);
+
+    def keys(self):
+        return self.entries.keys();
+
+    def stats(self):
+        """Counters and current size of the cache"""
+        return \
+            {   "entries": len(self.entries),
+                "bytes": self.totalBytes,
+                "maxEntries": self.maxEntries,
+                "maxBytes": self.maxBytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            };
+
+def estimateBytes(value, sampleSize=ESTIMATE_SAMPLE_SIZE):
+    """Rough estimate of the memory used by a value, including the contents of (nested) lists, tuples, sets and dictionaries.
+    Objects referenced multiple times are counted each time, so tends to over-estimate.
+    Containers with more than sampleSize items only have a sample of their items walked
+    (evenly spaced for lists and tuples, else the first iterated), scaled up by the number of items.
+    Set sampleSize to None to walk every item.
+    """
+    nBytes = sys.getsizeof(value);
+    if isinstance(value, dict):
+        nItems = len(value);
+        sampleItems = value.iteritems();
+        if sampleSize is not None and nItems > sampleSize:
+            sampleItems = itertools.islice(sampleItems, sampleSize);
+        sampleBytes = 0;
+        nSampled = 0;
+        for (key, item) in sampleItems:
+            sampleBytes += estimateBytes(key, sampleSize) + estimateBytes(item, sampleSize);
+            nSampled += 1;
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        nItems = len(value);
+        sampleItems = value;
+        if sampleSize is not None and nItems > sampleSize:
+            if isinstance(value, (list, tuple)):
+                sampleItems = value[::nItems // sampleSize][:sampleSize];
+            else:
+                sampleItems = itertools.islice(value, sampleSize);
+        sampleBytes = 0;
+        nSampled = 0;
+        for item in sampleItems:
+            sampleBytes += estimateBytes(item, sampleSize);
+            nSampled += 1;
+    else:
+        return nBytes;
+    if nSampled > 0:
+        nBytes += sampleBytes * nItems // nSampled;
+    return nBytes;
+
+
 def fileLineCount(inputFile):
     """Count up the (remaining) number of lines in an inputFile. 
     Note that this iterates through the lines in the file object, so you will lose your place in the file.
@@ -9,7 +9,7 @@ from math import sqrt, exp, log as ln;
 
 import Const, Util
 
-from medinfo.common.StatsUtil import AggregateStats, ContingencyStats, UnrecognizedStatException;
+from medinfo.common.StatsUtil import AggregateStats, ContingencyStats, ContingencyStatsArray, UnrecognizedStatException;
 from medinfo.common.test.Util import MedInfoTestCase
 
 class TestAggregateStats(MedInfoTestCase):
@@ -263,6 +263,40 @@ class TestContingencyStats(MedInfoTestCase):
             testValue = contStats.calc(statId);
             self.assertAlmostEquals( expectedValue, testValue, 3 );
 
+    def test_contingencyStatsArray(self):
+        # Vectorized stats over several tables should match the one table at a time calculations,
+        #   including tables that need normalization (zero and negative values)
+        tableCounts = \
+            [   (self.TEST_NAB, self.TEST_NA, self.TEST_NB, self.TEST_TOTAL),
+                (10, 15, 25, 20),
+                (0, 30, 40, 100),
+                (3.5, 12.25, 40.0, 3000.0),
+                (1.5e-160, 3.0e-180, 1000.0, 15000.0),
+                (self.TEST_NAB, self.TEST_NA, self.TEST_NB, self.TEST_TOTAL),   # Repeat table
+            ];
+        (nABs, nAs, nBs, Ns) = zip(*tableCounts);
+
+        for truncateNegativeValues in (None, False, True):
+            contStatsArray = ContingencyStatsArray( nABs, nAs, nBs, Ns );
+            contStatsList = [ContingencyStats(*counts) for counts in tableCounts];
+            if truncateNegativeValues is not None:
+                contStatsArray.normalize(truncateNegativeValues);
+                for contStats in contStatsList:
+                    contStats.normalize(truncateNegativeValues);
+
+            for statId in self.EXPECTED.iterkeys():
+                Util.log.debug(statId);
+                testValues = contStatsArray.calc(statId);
+                self.assertEqual( len(tableCounts), len(testValues) );
+                for contStats, testValue in zip(contStatsList, testValues):
+                    try:
+                        expectedValue = contStats.calc(statId);
+                    except (ZeroDivisionError, ValueError):
+                        continue;   # Degenerate table that scalar calculation cannot handle, array version yields inf / nan instead
+                    self.assertEqualGeneral( expectedValue, testValue, 5 );
+
+        self.assertRaises( UnrecognizedStatException, contStatsArray.calc, "unknownStat" );
+
 class TestUnitTestTools(MedInfoTestCase):
     def test_assertEqualsGeneral(self):
         # Should allow option of verifying equal values by number of significant digits, not just decimal places
@@ -1,22 +1,184 @@
 #!/usr/bin/env python
 import sys, os
 import json
+from cStringIO import StringIO;
 import time;
 import math;
+import bisect;
+import multiprocessing;
+import tempfile;
+import shutil;
 from datetime import datetime;
+import numpy as np;
 from optparse import OptionParser
-from medinfo.common.Util import stdOpen, ProgressDots;
+from medinfo.common.Util import stdOpen, ProgressDots, PhaseProfiler;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, generatePlaceholders;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
 from Env import DATE_FORMAT;
+import LocalEnv;
 
 from DataManager import DataManager;
 
-from Const import DELTA_NAME_BY_SECONDS, SECONDS_PER_DAY;
+from Const import DELTA_NAME_BY_SECONDS, SECONDS_PER_DAY, COUNT_PREFIX_OPTIONS, HISTOGRAM_BIN_SECONDS;
 
 from Util import log;
 
+"""Layout of the numeric columns in an update buffer's incrementData array.
+One block of columns per count prefix, each block holding the cumulative time window counts
+(in ascending order of seconds), then count_any, time_diff_sum, and time_diff_sum_squares.
+"""
+DELTA_SECONDS_OPTIONS = sorted(DELTA_NAME_BY_SECONDS.keys());
+WINDOW_INDEX_BY_SECONDS = dict( [(secondsOption, iWindow) for iWindow, secondsOption in enumerate(DELTA_SECONDS_OPTIONS)] );
+N_WINDOWS = len(DELTA_SECONDS_OPTIONS);
+COUNT_ANY_OFFSET = N_WINDOWS;
+TIME_DIFF_SUM_OFFSET = N_WINDOWS+1;
+TIME_DIFF_SUM_SQUARES_OFFSET = N_WINDOWS+2;
+COLUMNS_PER_PREFIX = N_WINDOWS+3;
+INCREMENT_COLUMN_NAMES = list();
+for countPrefix in COUNT_PREFIX_OPTIONS:
+    for secondsOption in DELTA_SECONDS_OPTIONS:
+        INCREMENT_COLUMN_NAMES.append("%scount_%d" % (countPrefix, secondsOption));
+    INCREMENT_COLUMN_NAMES.append(countPrefix+"count_any");
+    INCREMENT_COLUMN_NAMES.append(countPrefix+"time_diff_sum");
+    INCREMENT_COLUMN_NAMES.append(countPrefix+"time_diff_sum_squares");
+BLOCK_START_BY_PREFIX = dict( [(countPrefix, iPrefix*COLUMNS_PER_PREFIX) for iPrefix, countPrefix in enumerate(COUNT_PREFIX_OPTIONS)] );
+
+"""Alternative layout of the numeric columns in an update buffer's incrementData array for histogram storage.
+One block of columns per count prefix, each block holding the (non-cumulative) time delta histogram bins
+(one per HISTOGRAM_BIN_SECONDS edge, then one for any longer deltas), then time_diff_sum and time_diff_sum_squares.
+"""
+N_HISTOGRAM_BINS = len(HISTOGRAM_BIN_SECONDS)+1;
+HISTOGRAM_TIME_DIFF_SUM_OFFSET = N_HISTOGRAM_BINS;
+HISTOGRAM_TIME_DIFF_SUM_SQUARES_OFFSET = N_HISTOGRAM_BINS+1;
+HISTOGRAM_COLUMNS_PER_PREFIX = N_HISTOGRAM_BINS+2;
+HISTOGRAM_COLUMN_NAMES = list();
+for countPrefix in COUNT_PREFIX_OPTIONS:
+    for secondsOption in HISTOGRAM_BIN_SECONDS:
+        HISTOGRAM_COLUMN_NAMES.append("%shistogram_%d" % (countPrefix, secondsOption));
+    HISTOGRAM_COLUMN_NAMES.append(countPrefix+"histogram_any");
+    HISTOGRAM_COLUMN_NAMES.append(countPrefix+"time_diff_sum");
+    HISTOGRAM_COLUMN_NAMES.append(countPrefix+"time_diff_sum_squares");
+HISTOGRAM_BLOCK_START_BY_PREFIX = dict( [(countPrefix, iPrefix*HISTOGRAM_COLUMNS_PER_PREFIX) for iPrefix, countPrefix in enumerate(COUNT_PREFIX_OPTIONS)] );
+
+"""Maximum number of item pairs to evaluate at once in bulk per patient, to limit memory usage for patients with many items"""
+PAIRS_PER_BLOCK = 1 << 20;
+
+"""Filename extension for binary (numpy) update buffer files, sorted by item pair for streaming merges"""
+BINARY_BUFFER_EXTENSION = ".npy";
+
+"""Approximate memory overhead per association for the update buffer's row index lookup dictionary"""
+ROW_INDEX_BYTES_PER_ASSOCIATION = 120;
+
+"""Default number of patient_item rows to fetch from the database at a time"""
+ROWS_PER_FETCH = 10000;
+
+"""Number of records to read at a time from each binary buffer file when merging"""
+MERGE_BLOCK_SIZE = 1 << 16;
+
+"""Starting number of rows to allocate for update buffer arrays. Will double in size as needed."""
+INITIAL_BUFFER_CAPACITY = 1024;
+
+"""Default number of hash rows (independent estimates) in a count-min sketch for approximate association counting"""
+SKETCH_DEPTH = 4;
+
+"""Default maximum number of candidate (heavy hitter) item pairs to track alongside a count-min sketch.
+Candidates are pruned back down to this many (by estimated support) whenever twice as many accumulate.
+"""
+SKETCH_HEAVY_HITTERS = 100000;
+
+"""Fixed seed for count-min sketch hash functions, so sketches counted in separate processes (e.g., parallel shards) can be merged"""
+SKETCH_HASH_SEED = 12345;
+
+"""Increment column used as the support estimate of an item pair in a count-min sketch (number of patients with the pair)"""
+SKETCH_SUPPORT_COLUMN = "patient_count_any";
+
+def itemIdPairKey(itemId1, itemId2):
+    """Single integer key to represent an ordered (itemId1, itemId2) pair,
+    so buffer lookups don't need to build tuple or string keys.
+    Assumes item IDs fit within a signed 32 bit range.
+    """
+    return (itemId1 << 32) + (itemId2 & 0xFFFFFFFF);
+
+def formatHistogram(binCounts):
+    """Compact text form of a time delta histogram (one count per HISTOGRAM_BIN_SECONDS edge, then any longer deltas)
+    for storage, only listing the non-zero bins as space separated "edgeSeconds:count" entries ("any:count" for the last bin).
+    """
+    entries = list();
+    for iBin, count in enumerate(binCounts):
+        if count != 0:
+            binKey = "any";
+            if iBin < len(HISTOGRAM_BIN_SECONDS):
+                binKey = HISTOGRAM_BIN_SECONDS[iBin];
+            entries.append("%s:%.15g" % (binKey, count));
+    return str.join(" ", entries);
+
+def parseHistogram(histogramStr):
+    """Inverse of formatHistogram, returning an array of N_HISTOGRAM_BINS counts.
+    Entries for edges no longer in HISTOGRAM_BIN_SECONDS are counted in the next larger bin.
+    """
+    binCounts = np.zeros(N_HISTOGRAM_BINS);
+    if histogramStr:
+        for entry in histogramStr.split():
+            (binKey, count) = entry.split(":");
+            iBin = N_HISTOGRAM_BINS-1;
+            if binKey != "any":
+                iBin = bisect.bisect_left(HISTOGRAM_BIN_SECONDS, int(binKey));
+            binCounts[iBin] += float(count);
+    return binCounts;
+
+def histogramIncrementData(histogramData):
+    """Convert an array of rows in the HISTOGRAM_COLUMN_NAMES layout
+    into the equivalent (cumulative window) INCREMENT_COLUMN_NAMES layout.
+    """
+    incrementData = np.zeros( (histogramData.shape[0], len(INCREMENT_COLUMN_NAMES)) );
+    binIndexes = [HISTOGRAM_BIN_SECONDS.index(secondsOption) for secondsOption in DELTA_SECONDS_OPTIONS];
+    binIndexes.append(N_HISTOGRAM_BINS-1);  # count_any
+    for countPrefix in COUNT_PREFIX_OPTIONS:
+        blockStart = BLOCK_START_BY_PREFIX[countPrefix];
+        histogramBlockStart = HISTOGRAM_BLOCK_START_BY_PREFIX[countPrefix];
+        cumulativeCounts = np.cumsum(histogramData[:,histogramBlockStart:histogramBlockStart+N_HISTOGRAM_BINS], axis=1);
+        incrementData[:,blockStart:blockStart+COUNT_ANY_OFFSET+1] = cumulativeCounts[:,binIndexes];
+        incrementData[:,blockStart+TIME_DIFF_SUM_OFFSET] = histogramData[:,histogramBlockStart+HISTOGRAM_TIME_DIFF_SUM_OFFSET];
+        incrementData[:,blockStart+TIME_DIFF_SUM_SQUARES_OFFSET] = histogramData[:,histogramBlockStart+HISTOGRAM_TIME_DIFF_SUM_SQUARES_OFFSET];
+    return incrementData;
+
+def analyzePatientShard(shardArgs):
+    """Worker process function to count associations for one shard (subset) of patients
+    into a partial update buffer, without committing anything to the database.
+    Module level function so it can be pickled and sent to a multiprocessing Pool.
+    """
+    (connFactory, analysisOptions, patientIds, linkedItemIdsByBaseId) = shardArgs;
+
+    shardOptions = AnalysisOptions();
+    shardOptions.__dict__.update(analysisOptions.__dict__);
+    shardOptions.patientIds = patientIds;
+
+    analyzer = AssociationAnalysis();
+    analyzer.connFactory = connFactory;
+    updateBuffer = analyzer.makeUpdateBuffer(analysisOptions=shardOptions);
+    analyzer.accumulatePatientItems(shardOptions, updateBuffer, linkedItemIdsByBaseId);
+    return (updateBuffer, analyzer.profiler.summary());
+
+
+class PatientItemRow(tuple):
+    """Lightweight (immutable) tuple form of a patient_item row from queryPatientItemsPerPatient,
+    avoiding the overhead of a RowItemModel dictionary per row, but still allowing lookups by column name.
+    """
+    __slots__ = ();
+    COLUMN_NAMES = ("patient_item_id","patient_id","encounter_id","clinical_item_id","item_date","analyze_date");
+    COLUMN_INDEX_BY_NAME = dict( [(columnName, iColumn) for iColumn, columnName in enumerate(COLUMN_NAMES)] );
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = PatientItemRow.COLUMN_INDEX_BY_NAME[key];
+        return tuple.__getitem__(self, key);
+
+    def __contains__(self, key):
+        return key in PatientItemRow.COLUMN_INDEX_BY_NAME;
+
+    def keys(self):
+        return list(PatientItemRow.COLUMN_NAMES);
 
 class AnalysisOptions:
     """Simple struct to pass filter parameters on which records to do analysis on"""
@@ -25,7 +187,19 @@ class AnalysisOptions:
         self.startDate = None;
         self.endDate = None;
         self.bufferFile = None;
+        self.binaryBufferFile = False;  # If True, save buffer files in binary (BINARY_BUFFER_EXTENSION) rather than JSON format
         self.deltaSecondsOptions = None;    # Seconds values / suffixes to look for count fields to update
+        self.maxBufferMemory = None;    # If set, when update buffer estimated to exceed this many bytes, sort and spill its contents to a temporary run file, to be merged back at commit time
+        self.spillDir = None;   # Directory for spilled buffer run files. Defaults to system temp directory
+        self.checkpointFile = None; # If set, record progress to this file at each interval commit, and resume from it if it exists
+        self.afterPatientId = None; # Only query for patients with IDs after this one (e.g., resuming from a checkpoint)
+        self.sketchWidth = None;    # If set, approximate counts with a count-min sketch of this many buckets per hash row (rounded up to a power of 2), rather than exact counts per item pair
+        self.sketchDepth = SKETCH_DEPTH;    # Number of hash rows in the count-min sketch
+        self.sketchMinSupport = 1;  # Only item pairs with estimated support (SKETCH_SUPPORT_COLUMN) of at least this much are materialized from the sketch
+        self.sketchHeavyHitters = SKETCH_HEAVY_HITTERS; # Maximum number of candidate item pairs to track for materialization from the sketch
+        self.histogramStorage = False;  # If True, count a time delta histogram per item pair (HISTOGRAM_COLUMN_NAMES), stored in clinical_item_association_histogram rather than the cumulative count_* window columns
+        self.minCount = None;   # If set, drop item pairs with a count_any increment below this from the update buffer before committing, and delete stored associations that remain below it afterwards
+        self.minCountByColumn = None;   # Dictionary of further minimum counts by column name (e.g., per time window "count_86400", or "patient_count_any"), pruned the same way as minCount
 
 class AssociationAnalysis:
     """Pre-Computation module to sort through data on patient clinical items
@@ -63,7 +237,12 @@ class AssociationAnalysis:
     connFactory = None; # Allow specification of alternative DB connection source
     patientsPerCommit = None; # Commit any bufferred analysis results to the database after analyzing this many patients.  If None, will wait until the end before committing, so less DB hits, but will lose  progress if script cancelled midway
     associationsPerCommit = None;   # Commit buffered analysis results if accrue this many association results to avoid risk of running over runtime memory limitations
-    itemsPerUpdate = None;  # When updating analyze_dates for patient_items, do so for this many blocks at a time to avoid avoid loading MySQL query time
+    bulkCommit = False; # If True, commit buffered increments with a set-based update from a temporary staging table rather than one update query per item pair
+    nWorkers = None;    # If more than one, split patients into shards counted by this many parallel worker processes, then merge the partial buffers
+    rowsPerFetch = None;    # Number of patient_item rows to fetch from the database at a time
+    itemsPerUpdate = None;  # When updating analyze_dates for patient_items, do so for this many blocks at a time to avoid avoid loading MySQL query time. Otherwise all at once with a single joined update
+    profiler = None;    # Accumulate time, row / association counts, and peak memory for each phase of the analysis
+    profileFile = None; # If provided, write a machine-readable (JSON) summary of the phase profile to this file when done
 
     def __init__(self):
         """Default constructor"""
@@ -71,24 +250,239 @@ class AssociationAnalysis:
         self.dataManager = DataManager();
         self.patientsPerCommit = None;
         self.associationsPerCommit = None;
+        self.nWorkers = None;
+        self.bulkCommit = False;
         self.itemsPerUpdate = None;
+        self.rowsPerFetch = ROWS_PER_FETCH;
+        self.profiler = PhaseProfiler();
+        self.profileFile = None;
 
-    def makeUpdateBuffer(self, existingBuffer=None):
+    def makeUpdateBuffer(self, existingBuffer=None, analysisOptions=None, columnNames=None):
         """Factory method to prepare a blank "updateBuffer" to store association increment data.
         Is really just a dictionary for simple JSON conversion, but instantiate here to control
         expected attributes / keys;
         If exitingBuffer is not None, assume that is a previous one that we wish to
         clear / blank out.
+        If analysisOptions specify a sketchWidth, attach a count-min "sketch" to the buffer
+        for approximate counting (see makeSketch). An existing buffer's sketch is kept, but cleared.
+
+        Increment columns are INCREMENT_COLUMN_NAMES, unless otherwise specified by columnNames,
+        those of the existing buffer, or HISTOGRAM_COLUMN_NAMES if analysisOptions specify histogramStorage.
+
+        Association increments are kept in preallocated numeric arrays rather than
+        a dictionary per item pair to limit memory usage for millions of associations.
+            - itemIdPairs: Array of (clinical_item_id, subsequent_item_id) rows
+            - incrementData: Array of increment values, one row per item pair, one column per INCREMENT_COLUMN_NAMES
+            - rowIndexByItemIdPairKey: Lookup of row index by itemIdPairKey
+        Only the first nAssociations rows of the arrays are in use.
         """
         updateBuffer = existingBuffer;
+        sketch = None;
         if updateBuffer is None:
             updateBuffer = dict();
+        else:
+            sketch = updateBuffer.get("sketch");
+            if columnNames is None:
+                columnNames = updateBuffer.get("columnNames");
+        if columnNames is None:
+            columnNames = INCREMENT_COLUMN_NAMES;
+            if analysisOptions is not None and analysisOptions.histogramStorage:
+                columnNames = HISTOGRAM_COLUMN_NAMES;
+        if analysisOptions is not None and analysisOptions.sketchWidth is not None and columnNames == HISTOGRAM_COLUMN_NAMES:
+            raise ValueError("Approximate (sketch) counting is not supported with histogram storage");
         updateBuffer.clear();
         updateBuffer["nAssociations"] = 0;
         updateBuffer["analyzedPatientItemIds"] = set();
-        updateBuffer["incrementDataByItemIdPair"] = dict();
+        updateBuffer["columnNames"] = list(columnNames);
+        updateBuffer["rowIndexByItemIdPairKey"] = dict();
+        updateBuffer["itemIdPairs"] = np.zeros( (INITIAL_BUFFER_CAPACITY, 2), dtype=np.int64 );
+        updateBuffer["incrementData"] = np.zeros( (INITIAL_BUFFER_CAPACITY, len(columnNames)) );
+        if sketch is not None:
+            sketch["table"].fill(0);
+            sketch["candidateItemIdPairsByKey"].clear();
+            updateBuffer["sketch"] = sketch;
+        elif analysisOptions is not None and analysisOptions.sketchWidth is not None:
+            updateBuffer["sketch"] = self.makeSketch(analysisOptions.sketchWidth, analysisOptions.sketchDepth, analysisOptions.sketchMinSupport, analysisOptions.sketchHeavyHitters);
         return updateBuffer;
 
+    def isHistogramBuffer(self, updateBuffer):
+        """Whether the update buffer accumulates time delta histograms (HISTOGRAM_COLUMN_NAMES) rather than cumulative window counts"""
+        return updateBuffer.get("columnNames") == HISTOGRAM_COLUMN_NAMES;
+
+    def makeSketch(self, width, depth=SKETCH_DEPTH, minSupport=1, maxCandidates=SKETCH_HEAVY_HITTERS):
+        """Prepare a blank count-min sketch to approximately accumulate association increments
+        in a fixed amount of memory, regardless of the number of distinct item pairs observed.
+            - table: Array of (depth, width, len(INCREMENT_COLUMN_NAMES)) increment sums.
+                Each item pair adds its increments to one (hashed) bucket per hash row.
+                Estimate for a pair is the minimum across its buckets, which can only overestimate (from hash collisions).
+            - hashMultipliers: Random odd 64 bit multipliers for multiply-shift hashing of itemIdPairKeys, one per hash row
+            - nBits: Width of the table, as a power of 2
+            - candidateItemIdPairsByKey: Heavy hitter item pairs, whose estimated support has reached minSupport,
+                as the sketch itself can not enumerate which item pairs were counted.
+                Bounded to maxCandidates (by highest estimated support) whenever twice that many accumulate.
+        """
+        nBits = max(1, int(math.ceil(math.log(max(width,2), 2))));
+        randomState = np.random.RandomState(SKETCH_HASH_SEED);
+        hashMultipliers = np.frombuffer(randomState.bytes(8*depth), dtype=np.uint64) | np.uint64(1);
+        sketch = \
+            {   "nBits": nBits,
+                "hashMultipliers": hashMultipliers,
+                "table": np.zeros( (depth, 1 << nBits, len(INCREMENT_COLUMN_NAMES)) ),
+                "minSupport": minSupport,
+                "maxCandidates": maxCandidates,
+                "candidateItemIdPairsByKey": dict(),
+            };
+        return sketch;
+
+    def sketchBuckets(self, sketch, pairKeys):
+        """Array of (depth, len(pairKeys)) bucket indexes for the given itemIdPairKeys in each hash row of the sketch"""
+        pairKeys = np.asarray(pairKeys, dtype=np.int64).astype(np.uint64);
+        hashValues = pairKeys[np.newaxis,:] * sketch["hashMultipliers"][:,np.newaxis];    # Overflow wraps around (mod 2^64) as intended
+        return (hashValues >> np.uint64(64-sketch["nBits"])).astype(np.int64);
+
+    def sketchEstimates(self, sketch, pairKeys):
+        """Array of estimated increments for the given itemIdPairKeys, one row per pair, one column per INCREMENT_COLUMN_NAMES"""
+        buckets = self.sketchBuckets(sketch, pairKeys);
+        depth = buckets.shape[0];
+        return sketch["table"][np.arange(depth)[:,np.newaxis], buckets].min(axis=0);
+
+    def addSketchIncrements(self, sketch, itemIds1, itemIds2, incrementData):
+        """Add increments for the given (parallel arrays of) item pairs into the sketch,
+        then track any pairs whose estimated support now reaches the minimum as candidates for materialization.
+        """
+        pairKeys = (itemIds1.astype(np.int64) << 32) + (itemIds2.astype(np.int64) & 0xFFFFFFFF);    # Vectorized itemIdPairKey
+        table = sketch["table"];
+        buckets = self.sketchBuckets(sketch, pairKeys);
+        for iHashRow in xrange(buckets.shape[0]):
+            np.add.at(table[iHashRow], buckets[iHashRow], incrementData);
+
+        supportColumn = INCREMENT_COLUMN_NAMES.index(SKETCH_SUPPORT_COLUMN);
+        supportEstimates = table[np.arange(buckets.shape[0])[:,np.newaxis], buckets, supportColumn].min(axis=0);
+        candidateItemIdPairsByKey = sketch["candidateItemIdPairsByKey"];
+        for iPair in np.flatnonzero(supportEstimates >= sketch["minSupport"]).tolist():
+            candidateItemIdPairsByKey[int(pairKeys[iPair])] = (int(itemIds1[iPair]), int(itemIds2[iPair]));
+        if len(candidateItemIdPairsByKey) > 2*sketch["maxCandidates"]:
+            self.pruneSketchCandidates(sketch);
+
+    def pruneSketchCandidates(self, sketch):
+        """Keep only the maxCandidates sketch candidate item pairs with the highest estimated support"""
+        candidateItemIdPairsByKey = sketch["candidateItemIdPairsByKey"];
+        nDrop = len(candidateItemIdPairsByKey) - sketch["maxCandidates"];
+        if nDrop > 0:
+            pairKeys = np.array(candidateItemIdPairsByKey.keys(), dtype=np.int64);
+            supportEstimates = self.sketchEstimates(sketch, pairKeys)[:,INCREMENT_COLUMN_NAMES.index(SKETCH_SUPPORT_COLUMN)];
+            for pairKey in pairKeys[np.argpartition(supportEstimates, nDrop-1)[:nDrop]].tolist():
+                del candidateItemIdPairsByKey[pairKey];
+
+    def materializeSketch(self, updateBuffer):
+        """Move the estimated increments for the sketch's candidate item pairs
+        with sufficient estimated support into the regular rows of the update buffer,
+        so they can be persisted like exact counts. Sketch is cleared thereafter.
+        Return the number of item pairs materialized.
+        """
+        sketch = updateBuffer["sketch"];
+        candidateItemIdPairsByKey = sketch["candidateItemIdPairsByKey"];
+        nMaterialized = 0;
+        if candidateItemIdPairsByKey:
+            pairKeys = np.array(candidateItemIdPairsByKey.keys(), dtype=np.int64);
+            estimates = self.sketchEstimates(sketch, pairKeys);
+            isSupported = (estimates[:,INCREMENT_COLUMN_NAMES.index(SKETCH_SUPPORT_COLUMN)] >= sketch["minSupport"]);
+            nMaterialized = int(isSupported.sum());
+            bufferRowIndexes = np.zeros(nMaterialized, dtype=np.int64);
+            for iPair, pairKey in enumerate(pairKeys[isSupported].tolist()):
+                (itemId1, itemId2) = candidateItemIdPairsByKey[pairKey];
+                bufferRowIndexes[iPair] = self.bufferRowIndex(updateBuffer, itemId1, itemId2);
+            updateBuffer["incrementData"][bufferRowIndexes] += estimates[isSupported];
+        log.debug("Materialize %d of %d candidate item pairs from sketch" % (nMaterialized, len(candidateItemIdPairsByKey)) );
+        sketch["table"].fill(0);
+        candidateItemIdPairsByKey.clear();
+        return nMaterialized;
+
+    def mergeSketches(self, sketchOne, sketchTwo):
+        """Add the contents of sketchTwo into sketchOne. Sketches must have the same shape (and hash functions)."""
+        if sketchOne["table"].shape != sketchTwo["table"].shape or not np.array_equal(sketchOne["hashMultipliers"], sketchTwo["hashMultipliers"]):
+            raise ValueError("Can not merge count-min sketches of different shape: %s vs. %s" % (sketchOne["table"].shape, sketchTwo["table"].shape) );
+        sketchOne["table"] += sketchTwo["table"];
+        sketchOne["candidateItemIdPairsByKey"].update(sketchTwo["candidateItemIdPairsByKey"]);
+        if len(sketchOne["candidateItemIdPairsByKey"]) > 2*sketchOne["maxCandidates"]:
+            self.pruneSketchCandidates(sketchOne);
+        return sketchOne;
+
+    def bufferAccuracy(self, exactBuffer, approximateBuffer, minSupport=1):
+        """Compare the item pairs and increments in an approximate (materialized sketch) update buffer
+        against those in an exact update buffer counted from the same patient items.
+        Return a dictionary of accuracy statistics:
+            - nExact / nApproximate: Number of item pairs with (exact / estimated) support of at least minSupport
+            - recall / precision: Fraction of exact pairs found in approximate buffer / approximate pairs found in exact buffer
+            - meanAbsoluteError / maxAbsoluteError: Error across all increment values of the recalled item pairs
+            - maxRelativeError: Largest overestimate of a recalled pair's support, relative to its exact support
+        """
+        supportColumn = INCREMENT_COLUMN_NAMES.index(SKETCH_SUPPORT_COLUMN);
+        bufferDataByItemIdPair = list();
+        for updateBuffer in (exactBuffer, approximateBuffer):
+            dataByItemIdPair = dict();
+            for iRow, itemIdPair in enumerate(self.bufferItemIdPairs(updateBuffer)):
+                rowData = updateBuffer["incrementData"][iRow];
+                if rowData[supportColumn] >= minSupport:
+                    dataByItemIdPair[itemIdPair] = rowData;
+            bufferDataByItemIdPair.append(dataByItemIdPair);
+        (exactDataByItemIdPair, approximateDataByItemIdPair) = bufferDataByItemIdPair;
+
+        commonItemIdPairs = set(exactDataByItemIdPair.keys()) & set(approximateDataByItemIdPair.keys());
+        accuracy = \
+            {   "nExact": len(exactDataByItemIdPair),
+                "nApproximate": len(approximateDataByItemIdPair),
+                "recall": len(commonItemIdPairs) / float(max(len(exactDataByItemIdPair),1)),
+                "precision": len(commonItemIdPairs) / float(max(len(approximateDataByItemIdPair),1)),
+                "meanAbsoluteError": 0.0,
+                "maxAbsoluteError": 0.0,
+                "maxRelativeError": 0.0,
+            };
+        if commonItemIdPairs:
+            exactData = np.array([exactDataByItemIdPair[itemIdPair] for itemIdPair in commonItemIdPairs]);
+            approximateData = np.array([approximateDataByItemIdPair[itemIdPair] for itemIdPair in commonItemIdPairs]);
+            absoluteErrors = np.abs(approximateData - exactData);
+            accuracy["meanAbsoluteError"] = float(absoluteErrors.mean());
+            accuracy["maxAbsoluteError"] = float(absoluteErrors.max());
+            accuracy["maxRelativeError"] = float((absoluteErrors[:,supportColumn] / np.maximum(exactData[:,supportColumn],1)).max());
+        return accuracy;
+
+    def ensureBufferCapacity(self, updateBuffer, nRows):
+        """Make sure the update buffer arrays have room for at least nRows item pairs.
+        Grow by doubling to amortize the cost of copying existing data.
+        """
+        capacity = updateBuffer["itemIdPairs"].shape[0];
+        if nRows > capacity:
+            newCapacity = max(nRows, 2*capacity);
+            nAssociations = updateBuffer["nAssociations"];
+
+            itemIdPairs = np.zeros( (newCapacity, 2), dtype=np.int64 );
+            itemIdPairs[:nAssociations] = updateBuffer["itemIdPairs"][:nAssociations];
+            updateBuffer["itemIdPairs"] = itemIdPairs;
+
+            incrementData = np.zeros( (newCapacity, updateBuffer["incrementData"].shape[1]) );
+            incrementData[:nAssociations] = updateBuffer["incrementData"][:nAssociations];
+            updateBuffer["incrementData"] = incrementData;
+
+    def bufferRowIndex(self, updateBuffer, itemId1, itemId2):
+        """Find the row index in the update buffer arrays for the given item pair,
+        adding a new blank row if the pair has not been seen yet.
+        """
+        pairKey = itemIdPairKey(itemId1, itemId2);
+        rowIndexByItemIdPairKey = updateBuffer["rowIndexByItemIdPairKey"];
+        if pairKey not in rowIndexByItemIdPairKey:
+            iRow = updateBuffer["nAssociations"];
+            self.ensureBufferCapacity(updateBuffer, iRow+1);
+            updateBuffer["itemIdPairs"][iRow] = (itemId1, itemId2);
+            rowIndexByItemIdPairKey[pairKey] = iRow;
+            updateBuffer["nAssociations"] = iRow+1;
+        return rowIndexByItemIdPairKey[pairKey];
+
+    def bufferItemIdPairs(self, updateBuffer):
+        """Return list of the (clinical_item_id, subsequent_item_id) tuples with data in the update buffer, in row order"""
+        itemIdPairs = updateBuffer["itemIdPairs"][:updateBuffer["nAssociations"]].tolist();
+        return [tuple(itemIdPair) for itemIdPair in itemIdPairs];
+
     def analyzePatientItems(self, analysisOptions):
         """Primary run function to analyze patient clinical item data and
         record updated stats to the respective database tables.
@@ -99,6 +493,9 @@ class AssociationAnalysis:
         Will also record analyze_date timestamp on any records analyzed,
         so that analysis will not be repeated if called again on the same records.
         """
+        if self.nWorkers is not None and self.nWorkers > 1:
+            return self.analyzePatientItemsParallel(analysisOptions);
+
         progress = ProgressDots();
         conn = self.connFactory.connection();
 
@@ -108,30 +505,197 @@ class AssociationAnalysis:
 
             # Keep an in memory buffer of the updates to be done so can stall and submit them
             #   to the database in batch to minimize inefficient DB hits
-            updateBuffer = self.makeUpdateBuffer();
+            updateBuffer = self.makeUpdateBuffer(analysisOptions=analysisOptions);
+
+            # Resume from where a prior interrupted run left off, if checkpoint available
+            queryOptions = analysisOptions;
+            iPatientStart = 0;
+            checkpoint = self.loadCheckpoint(analysisOptions);
+            if checkpoint is not None:
+                log.info("Resume after patient %(lastPatientId)s (%(nPatients)s patients completed)" % checkpoint );
+                queryOptions = AnalysisOptions();
+                queryOptions.__dict__.update(analysisOptions.__dict__);
+                queryOptions.afterPatientId = checkpoint["lastPatientId"];
+                iPatientStart = checkpoint["nPatients"];
+
             log.info("Main patient item query...")
-            for iPatient, patientItemList in enumerate(self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn)):
+            for iPatient, patientItemList in enumerate(self.queryPatientItemsPerPatient(queryOptions, progress=progress, conn=conn), iPatientStart):
                 log.debug("Calculate associations for Patient %d's %d patient items. %d associations in buffer." % (iPatient, len(patientItemList), updateBuffer["nAssociations"]) );
-                self.updateItemAssociationsBuffer(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId, progress=progress);
+                self.countPatientItemAssociations(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId, progress=progress);
                 if self.readyForIntervalCommit(iPatient, updateBuffer, analysisOptions):
                     log.info("Commit after %s patients" % (iPatient+1) );
                     self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient, conn=conn);  # Periodically commit update buffer
+                    log.info("Phase profile after %s patients:\n%s" % (iPatient+1, self.profiler.formatReport()) );
+                    if patientItemList:
+                        self.saveCheckpoint(analysisOptions, nPatients=iPatient+1, lastPatientId=patientItemList[0]["patient_id"]);
+                elif self.readyForSpill(updateBuffer, analysisOptions):
+                    self.spillUpdateBuffer(updateBuffer, analysisOptions);
+                    DBUtil.execute("select 1+1", conn=conn);
                 else:   # If not committing, still send a quick arbitrary query to DB,
                         # otherwise connection may get recycled because DB thinks timeout with no interaction
                     DBUtil.execute("select 1+1", conn=conn);
             log.info("Final commit / persist");
             self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, -1, conn=conn);  # Final update buffer commit. Don't use iPatient here, as may collide if interval commit happened to land on last patient
+            if analysisOptions.bufferFile is None:
+                self.pruneItemAssociations(analysisOptions, conn=conn);
+            self.clearCheckpoint(analysisOptions);
+            log.info("Phase profile:\n%s" % self.profiler.formatReport() );
         finally:
             conn.close();
         # progress.PrintStatus();
 
+    def analyzePatientItemsParallel(self, analysisOptions):
+        """Alternative to analyzePatientItems that splits the patients into shards,
+        counted by a pool of nWorkers processes, each with its own database connection.
+        Each worker returns a partial update buffer which is merged here (in shard order)
+        before being committed / persisted, so results should be identical to serial mode.
+        Interval commits are only checked in between shards, with shard size based on patientsPerCommit if specified.
+        Patients are sharded in patient ID order, so a checkpoint only needs the last completed patient ID to resume from,
+        even if the number of workers, shard size, or patients to analyze has changed since.
+        """
+        progress = ProgressDots();
+        conn = self.connFactory.connection();
+        try:
+            linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
+
+            patientIds = analysisOptions.patientIds;
+            if not patientIds:
+                patientIds = self.queryPatientIds(analysisOptions, conn=conn);
+            patientIds = sorted(set([int(patientId) for patientId in patientIds]));   # Same patient order as serial mode
+
+            nPatients = 0;
+            checkpoint = self.loadCheckpoint(analysisOptions);
+            if checkpoint is not None:
+                # Resume from where a prior interrupted run left off, skipping patients already completed
+                log.info("Resume after patient %(lastPatientId)s (%(nPatients)s patients completed)" % checkpoint );
+                nPatients = checkpoint["nPatients"];
+                patientIds = [patientId for patientId in patientIds if patientId > int(checkpoint["lastPatientId"])];
+
+            shardSize = self.patientsPerCommit;
+            if shardSize is None:
+                shardSize = int(math.ceil(len(patientIds) / float(self.nWorkers)));
+            shardSize = max(shardSize, 1);
+            shardArgsList = list();
+            for iStart in xrange(0, len(patientIds), shardSize):
+                shardArgsList.append( (self.connFactory, analysisOptions, patientIds[iStart:iStart+shardSize], linkedItemIdsByBaseId) );
+
+            log.info("Analyze %d patients in %d shards with %d workers" % (len(patientIds), len(shardArgsList), self.nWorkers) );
+            progress.total = len(shardArgsList);
+
+            updateBuffer = self.makeUpdateBuffer(analysisOptions=analysisOptions);
+            pool = multiprocessing.Pool(self.nWorkers);
+            try:
+                for iShard, (shardBuffer, shardProfile) in enumerate(pool.imap(analyzePatientShard, shardArgsList)):
+                    self.profiler.mergeSummary(shardProfile);   # Worker process phases (query and counting)
+                    self.mergeBuffers(updateBuffer, shardBuffer);
+                    del shardBuffer;    # Make sure memory gets reclaimed
+                    nPatients += len(shardArgsList[iShard][2]);
+                    progress.update();
+                    iPatient = nPatients-1;
+                    # Shards already hold patientsPerCommit patients each, so commit after every shard rather than checking the serial patient modulo
+                    isIntervalCommit = self.patientsPerCommit is not None or self.readyForIntervalCommit(iPatient, updateBuffer, analysisOptions);
+                    if iShard < len(shardArgsList)-1 and isIntervalCommit:
+                        log.info("Commit after %s patients" % nPatients );
+                        self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient, conn=conn);
+                        self.saveCheckpoint(analysisOptions, nPatients=nPatients, lastPatientId=shardArgsList[iShard][2][-1]);
+                        log.info("Phase profile after %s patients:\n%s" % (nPatients, self.profiler.formatReport()) );
+                    else:   # Keep connection alive while waiting on workers
+                        if self.readyForSpill(updateBuffer, analysisOptions):
+                            self.spillUpdateBuffer(updateBuffer, analysisOptions);
+                        DBUtil.execute("select 1+1", conn=conn);
+                pool.close();
+            finally:
+                pool.terminate();
+                pool.join();
+
+            log.info("Final commit / persist");
+            self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, -1, conn=conn);
+            if analysisOptions.bufferFile is None:
+                self.pruneItemAssociations(analysisOptions, conn=conn);
+            self.clearCheckpoint(analysisOptions);
+            log.info("Phase profile:\n%s" % self.profiler.formatReport() );
+        finally:
+            conn.close();
+
+    def accumulatePatientItems(self, analysisOptions, updateBuffer, linkedItemIdsByBaseId, progress=None, conn=None):
+        """Count associations for all of the patient items matching the analysisOptions
+        into the given in memory updateBuffer, without any interval commits or persistence.
+        Allows callers to accumulate / chain several analyses in memory (e.g., parallel shards, or decaying window deltas)
+        before deciding what to do with the buffer.
+        """
+        extConn = conn is not None;
+        if not extConn:
+            conn = self.connFactory.connection();
+        try:
+            for patientItemList in self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn):
+                self.countPatientItemAssociations(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId, progress=progress);
+        finally:
+            if not extConn:
+                conn.close();
+        return updateBuffer;
+
+    def loadCheckpoint(self, analysisOptions):
+        """Load the checkpoint left by a prior interrupted run (if any) for the analysisOptions checkpointFile.
+        Returns None if no checkpoint to resume from.
+        """
+        if analysisOptions.checkpointFile is None or not os.path.exists(analysisOptions.checkpointFile):
+            return None;
+        ifs = open(analysisOptions.checkpointFile);
+        checkpoint = json.load(ifs);
+        ifs.close();
+        return checkpoint;
+
+    def saveCheckpoint(self, analysisOptions, nPatients, lastPatientId):
+        """Record progress after an interval commit / persist, so an interrupted run can resume
+        after the last persisted patient, rather than starting over.
+        Write to a temporary file first, then rename, so never left with a partially written checkpoint.
+        Update buffer is always empty at this point (all results persisted), so only need to record
+        which patients are complete and any buffer files written so far.
+        """
+        if analysisOptions.checkpointFile is None:
+            return;
+        checkpoint = \
+            {   "nPatients": nPatients,
+                "lastPatientId": lastPatientId,
+                "bufferFile": analysisOptions.bufferFile,
+                "lastUpdate": datetime.now().isoformat(),
+            };
+        tempFilename = analysisOptions.checkpointFile+".tmp";
+        ofs = open(tempFilename, "w");
+        json.dump(checkpoint, ofs);
+        ofs.flush();
+        os.fsync(ofs.fileno());
+        ofs.close();
+        os.rename(tempFilename, analysisOptions.checkpointFile);
+
+    def clearCheckpoint(self, analysisOptions):
+        """Remove checkpoint once a run is complete, so a subsequent run will start from the beginning"""
+        if analysisOptions.checkpointFile is not None and os.path.exists(analysisOptions.checkpointFile):
+            os.remove(analysisOptions.checkpointFile);
+
+    def queryPatientIds(self, analysisOptions, conn=None):
+        """Query for the distinct patient IDs with items matching the analysisOptions date filters,
+        to support splitting the analysis into patient shards.
+        """
+        query = SQLQuery();
+        query.addSelect("distinct pi.patient_id");
+        query.addFrom("patient_item as pi");
+        if analysisOptions.startDate is not None:
+            query.addWhereOp("pi.item_date",">=", analysisOptions.startDate);
+        if analysisOptions.endDate is not None:
+            query.addWhereOp("pi.item_date","<", analysisOptions.endDate);
+        query.addOrderBy("pi.patient_id");
+        resultTable = DBUtil.execute(query, conn=conn);
+        return [row[0] for row in resultTable];
+
     def queryPatientItemsPerPatient(self, analysisOptions, progress=None, conn=None):
         """Query the database for an ordered list of patient clinical items,
         in the order in which they occurred.
         This could be a large amount of data, so option to provide
         list of specific patientIds or date ranges to query for.  In either case,
         results will be returned as an iterator over individual lists
-        for each patient.  Lists will contain RowItemModels, each with data:
+        for each patient.  Lists will contain PatientItemRows (lightweight tuples
+        that can also be read like RowItemModels by column name), each with data:
             * patient_id
             * encounter_id
             * clinical_item_id
@@ -160,6 +724,8 @@ class AssociationAnalysis:
             query.addWhereOp("pi.item_date",">=", analysisOptions.startDate);
         if analysisOptions.endDate is not None:
             query.addWhereOp("pi.item_date","<", analysisOptions.endDate);
+        if analysisOptions.afterPatientId is not None:
+            query.addWhereOp("pi.patient_id",">", analysisOptions.afterPatientId);
         query.addOrderBy("pi.patient_id");
         query.addOrderBy("pi.item_date");
         query.addOrderBy("pi.clinical_item_id");
@@ -168,35 +734,43 @@ class AssociationAnalysis:
         if progress is not None:
             progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
 
-        cursor = conn.cursor();
+        if LocalEnv.DATABASE_CONNECTOR_NAME == "psycopg2":
+            # Named (server-side) cursor, so the driver only pulls rows across in batches, rather than the whole result set.
+            #   With hold, so it survives any interval commits on the connection while still iterating.
+            cursor = conn.cursor(name="patient_item_cursor_%d" % id(analysisOptions), withhold=True);
+            cursor.itersize = self.rowsPerFetch;
+        else:
+            cursor = conn.cursor();
 
         # Do one massive query, but yield data for one patient at a time.
         # This should minimize the number of DB queries and the amount of
         #   data that must be kept in memory at any one time.
+        self.profiler.startPhase("query");
         cursor.execute( str(query), tuple(query.params) );
 
         currentPatientId = None;
         currentPatientData = list();
 
-        headers = ["patient_item_id","patient_id","encounter_id","clinical_item_id","item_date","analyze_date"];
-
-        row = cursor.fetchone();
-        while row is not None:
-            (patient_item_id, patientId, encounter_id, clinicalItemId, itemDate, analyzeDate) = row;
-            if currentPatientId is None:
-                currentPatientId = patientId;
+        rows = cursor.fetchmany(self.rowsPerFetch);
+        self.profiler.stopPhase("query", rows=len(rows));
+        while rows:
+            for row in rows:
+                patientId = row[1];
+                if currentPatientId is None:
+                    currentPatientId = patientId;
 
-            if patientId != currentPatientId:
-                # Changed user, yield the existing data for the previous user
-                yield currentPatientData;
-                # Update our data tracking for the current user
-                currentPatientId = patientId;
-                currentPatientData = list();
+                if patientId != currentPatientId:
+                    # Changed user, yield the existing data for the previous user
+                    yield currentPatientData;
+                    # Update our data tracking for the current user
+                    currentPatientId = patientId;
+                    currentPatientData = list();
 
-            rowModel = RowItemModel( row, headers );
-            currentPatientData.append( rowModel );
+                currentPatientData.append( PatientItemRow(row) );
 
-            row = cursor.fetchone();
+            self.profiler.startPhase("query");
+            rows = cursor.fetchmany(self.rowsPerFetch);
+            self.profiler.stopPhase("query", rows=len(rows));
 
         # Yield the final user's data
         yield currentPatientData;
@@ -208,6 +782,13 @@ class AssociationAnalysis:
         if not extConn:
             conn.close();
 
+    def countPatientItemAssociations(self, patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId=None, progress=None):
+        """Profiled call to updateItemAssociationsBuffer for one patient's items"""
+        nAssociations = updateBuffer["nAssociations"];
+        self.profiler.startPhase("counting");
+        self.updateItemAssociationsBuffer(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId, progress=progress);
+        self.profiler.stopPhase("counting", rows=len(patientItemList), associations=updateBuffer["nAssociations"]-nAssociations);
+
     def updateItemAssociationsBuffer(self, patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId=None,  progress=None):
         """Given a list of data on patient clinical items,
         ordered by item event date, increment information in the
@@ -218,57 +799,159 @@ class AssociationAnalysis:
         After done, also provide updateBuffer info for subsequent setting the analyze_date
         for all (completed) patient_items from this patient to the current time so that
         subsequent queries will know they have already been accounted for.
+
+        Equivalent to checking every ordered (patientItem1, patientItem2) combination
+        with updateClinicalItemAssociationBuffer, but done in bulk with numpy arrays,
+        in blocks of patientItem1 rows to limit memory usage for patients with many items.
+        "First" pair occurrences for the patient_ and encounter_ counts are
+        by the same (patientItem1, patientItem2) iteration order as the pairwise version.
         """
-        # Keep track of which items to mark as newly analyzed
+        if "analyzedPatientItemIds" not in updateBuffer:
+            updateBuffer["analyzedPatientItemIds"] = set();
+        nItems = len(patientItemList);
+        if nItems < 1:
+            return;
+        if linkedItemIdsByBaseId is None:
+            linkedItemIdsByBaseId = dict();
+
+        # Pull out the relevant data into parallel numpy arrays
+        patientItemIds = np.array([patientItem["patient_item_id"] for patientItem in patientItemList], dtype=np.int64);
+        (uniqueItemIds, itemIndexes) = np.unique([patientItem["clinical_item_id"] for patientItem in patientItemList], return_inverse=True);
+        (uniqueEncounterIds, encounterIndexes) = np.unique([patientItem["encounter_id"] for patientItem in patientItemList], return_inverse=True);
+        firstDate = patientItemList[0]["item_date"];
+        itemSeconds = np.zeros(nItems, dtype=np.int64);
+        for iItem, patientItem in enumerate(patientItemList):
+            timeDelta = patientItem["item_date"] - firstDate;
+            itemSeconds[iItem] = timeDelta.days*SECONDS_PER_DAY + timeDelta.seconds;
+        isNotAnalyzed = np.array([patientItem["analyze_date"] is None for patientItem in patientItemList], dtype=bool);
+        nUniqueItems = len(uniqueItemIds);
+        nEncounters = len(uniqueEncounterIds);
+
+        # Composite linked item pairs, in which case no meaningful association stats to calculate
+        itemIndexById = dict( [(itemId, iUniqueItem) for iUniqueItem, itemId in enumerate(uniqueItemIds.tolist())] );
+        isLinkedPair = np.zeros( (nUniqueItems, nUniqueItems), dtype=bool );
+        for itemId, iUniqueItem in itemIndexById.iteritems():
+            if itemId in linkedItemIdsByBaseId:
+                for linkedItemId in linkedItemIdsByBaseId[itemId]:
+                    if linkedItemId in itemIndexById:
+                        isLinkedPair[iUniqueItem, itemIndexById[linkedItemId]] = True;
+                        isLinkedPair[itemIndexById[linkedItemId], iUniqueItem] = True;
+
+        # Determine which time threshold count windows to update (histograms always count every bin, to support any window)
+        isHistogram = self.isHistogramBuffer(updateBuffer);
+        windowMask = None;
+        if analysisOptions is not None and analysisOptions.deltaSecondsOptions is not None and not isHistogram:
+            windowMask = np.zeros(N_WINDOWS+1, dtype=bool);
+            for secondsOption in analysisOptions.deltaSecondsOptions:
+                windowMask[WINDOW_INDEX_BY_SECONDS[secondsOption]] = True;
+            windowMask[COUNT_ANY_OFFSET] = True;
+
+        # Track pairs (and pairs by encounter) already seen for the patient from prior blocks.
+        #   Pair by encounter keys could exceed int64 for patients with very many distinct items and encounters,
+        #   in which case fall back to (slower) arbitrary precision Python integer keys.
+        encounterKeyType = np.int64;
+        if nUniqueItems*nUniqueItems*nEncounters > np.iinfo(np.int64).max:
+            encounterKeyType = object;
+        seenPairKeys = np.zeros(0, dtype=np.int64);
+        seenEncounterPairKeys = np.zeros(0, dtype=encounterKeyType);
         newlyAnalyzedPatientItemIdSet = set();
 
-        # Keep track of which subsequent items have been analyzed, so we don't count further duplicates (just the first ones found)
-        subsequentItemIds = set();
-        # Keep track of all item pairs encountered to avoid counting patient level duplicates
-        encounterIdPairsByItemIdPair = dict();
-
-        patientId = None;
-        for iItem1, patientItem1 in enumerate(patientItemList):
-            if patientId is None:
-                patientId = patientItem1["patient_id"];
-
-            subsequentItemIds.clear();
-
-            for iItem2, patientItem2 in enumerate(patientItemList):
-                itemIdPair = (patientItem1["clinical_item_id"], patientItem2["clinical_item_id"]);
-                encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
-
-                # Verify is not a previously composite linked item pair, in which case no meaningful asssociation stats to calculate
-                #   and that the item dates are in non-negative direction
-                isPairToAnalyze = self.acceptableClinicalItemPair(patientItem1, patientItem2, linkedItemIdsByBaseId );
-                if isPairToAnalyze:
-                    if (patientItem1["analyze_date"] is None or patientItem2["analyze_date"] is None):
-                        # Record the stat update if this pair has not already been analyzed/recorded before
-                        isNewSubsequentItem = patientItem2["clinical_item_id"] not in subsequentItemIds;   # Track repeats
-                        isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
-                        isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);    # Pair ever seen for a common encounter combination
-
-                        self.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, analysisOptions );
-
-                        if patientItem1["analyze_date"] is None:
-                            newlyAnalyzedPatientItemIdSet.add(patientItem1["patient_item_id"]);
-                        if patientItem2["analyze_date"] is None:
-                            newlyAnalyzedPatientItemIdSet.add(patientItem2["patient_item_id"]);
-                    subsequentItemIds.add(patientItem2["clinical_item_id"]);
-
-                    if itemIdPair not in encounterIdPairsByItemIdPair:
-                        encounterIdPairsByItemIdPair[itemIdPair] = set();
-                    encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+        itemsPerBlock = max(1, PAIRS_PER_BLOCK // nItems);
+        for iBlockStart in xrange(0, nItems, itemsPerBlock):
+            iBlockEnd = min(iBlockStart+itemsPerBlock, nItems);
+
+            # All ordered pairs from this block of first items to every possible subsequent item, in iteration order
+            secondsDeltas = itemSeconds[np.newaxis,:] - itemSeconds[iBlockStart:iBlockEnd,np.newaxis];
+            isPairToAnalyze = (secondsDeltas >= 0);   # Only record forward / non-negative associations
+            isPairToAnalyze &= ~isLinkedPair[itemIndexes[iBlockStart:iBlockEnd,np.newaxis], itemIndexes[np.newaxis,:]];
+            (item1Indexes, item2Indexes) = np.nonzero(isPairToAnalyze);
+            item1Indexes += iBlockStart;
+            secondsDeltas = secondsDeltas[isPairToAnalyze];
+
+            # Pair ever seen for this patient
+            pairKeys = itemIndexes[item1Indexes]*nUniqueItems + itemIndexes[item2Indexes];
+            isNewPair = self.firstOccurrences(pairKeys, seenPairKeys);
+            seenPairKeys = np.union1d(seenPairKeys, pairKeys);
+
+            # Pair ever seen for a common encounter combination.
+            #   Only same encounter combinations can count, so only need to key by the one encounter
+            isSameEncounter = (encounterIndexes[item1Indexes] == encounterIndexes[item2Indexes]);
+            encounterPairKeys = pairKeys[isSameEncounter].astype(encounterKeyType)*nEncounters + encounterIndexes[item1Indexes[isSameEncounter]].astype(encounterKeyType);
+            isNewPairWithinEncounter = np.zeros(len(pairKeys), dtype=bool);
+            isNewPairWithinEncounter[isSameEncounter] = self.firstOccurrences(encounterPairKeys, seenEncounterPairKeys);
+            seenEncounterPairKeys = np.union1d(seenEncounterPairKeys, encounterPairKeys);
+
+            # Record the stat update if this pair has not already been analyzed/recorded before
+            isNewlyAnalyzed1 = isNotAnalyzed[item1Indexes];
+            isNewlyAnalyzed2 = isNotAnalyzed[item2Indexes];
+            isPairToCount = isNewlyAnalyzed1 | isNewlyAnalyzed2;
+            newlyAnalyzedPatientItemIdSet.update(patientItemIds[item1Indexes[isNewlyAnalyzed1 & isPairToCount]].tolist());
+            newlyAnalyzedPatientItemIdSet.update(patientItemIds[item2Indexes[isNewlyAnalyzed2 & isPairToCount]].tolist());
+
+            if isPairToCount.any():
+                pairKeys = pairKeys[isPairToCount];
+                secondsDeltas = secondsDeltas[isPairToCount];
+                prefixMasks = \
+                    {   "": None,
+                        "patient_": isNewPair[isPairToCount],
+                        "encounter_": isNewPairWithinEncounter[isPairToCount],
+                    };
+                (countPairKeys, pairRowIndexes) = np.unique(pairKeys, return_inverse=True);
+                # First window that each time delta fits in. Windows are cumulative, so counts for all subsequent windows (through count_any) as well
+                #   Histogram bins are not cumulative, so only count in the one bin the time delta fits in
+                if isHistogram:
+                    (binSecondsOptions, nBins, blockStartByPrefix, timeDiffSumOffset) = (HISTOGRAM_BIN_SECONDS, N_HISTOGRAM_BINS, HISTOGRAM_BLOCK_START_BY_PREFIX, HISTOGRAM_TIME_DIFF_SUM_OFFSET);
+                else:
+                    (binSecondsOptions, nBins, blockStartByPrefix, timeDiffSumOffset) = (DELTA_SECONDS_OPTIONS, N_WINDOWS+1, BLOCK_START_BY_PREFIX, TIME_DIFF_SUM_OFFSET);
+                firstWindowIndexes = np.searchsorted(binSecondsOptions, secondsDeltas, side="left");
+                secondsDeltas = secondsDeltas.astype(np.float64);
+
+                incrementData = np.zeros( (len(countPairKeys), len(updateBuffer["columnNames"])) );
+                for countPrefix in COUNT_PREFIX_OPTIONS:
+                    prefixMask = prefixMasks[countPrefix];
+                    if prefixMask is None:
+                        (prefixRowIndexes, prefixWindowIndexes, prefixSecondsDeltas) = (pairRowIndexes, firstWindowIndexes, secondsDeltas);
+                    else:
+                        (prefixRowIndexes, prefixWindowIndexes, prefixSecondsDeltas) = (pairRowIndexes[prefixMask], firstWindowIndexes[prefixMask], secondsDeltas[prefixMask]);
+                    blockStart = blockStartByPrefix[countPrefix];
+
+                    windowCounts = np.zeros( (len(countPairKeys), nBins) );
+                    np.add.at(windowCounts, (prefixRowIndexes, prefixWindowIndexes), 1);
+                    if not isHistogram:
+                        windowCounts = np.cumsum(windowCounts, axis=1);
+                    if windowMask is not None:
+                        windowCounts[:,~windowMask] = 0;
+                    incrementData[:,blockStart:blockStart+nBins] = windowCounts;
+                    incrementData[:,blockStart+timeDiffSumOffset] = np.bincount(prefixRowIndexes, weights=prefixSecondsDeltas, minlength=len(countPairKeys));
+                    incrementData[:,blockStart+timeDiffSumOffset+1] = np.bincount(prefixRowIndexes, weights=prefixSecondsDeltas**2, minlength=len(countPairKeys));
+
+                if "sketch" in updateBuffer:
+                    # Approximate counting in fixed memory, rather than a buffer row per item pair
+                    self.addSketchIncrements(updateBuffer["sketch"], uniqueItemIds[countPairKeys // nUniqueItems], uniqueItemIds[countPairKeys % nUniqueItems], incrementData);
+                else:
+                    # Add into the respective update buffer rows
+                    bufferRowIndexes = np.zeros(len(countPairKeys), dtype=np.int64);
+                    for iPair, pairKey in enumerate(countPairKeys.tolist()):
+                        bufferRowIndexes[iPair] = self.bufferRowIndex(updateBuffer, uniqueItemIds[pairKey // nUniqueItems], uniqueItemIds[pairKey % nUniqueItems]);
+                    updateBuffer["incrementData"][bufferRowIndexes] += incrementData;
 
             # Update progress meter if available
             if progress is not None:
-                progress.Update();
+                progress.Update(iBlockEnd-iBlockStart);
 
         # Record this analysis date to any unmarked records
-        if "analyzedPatientItemIds" not in updateBuffer:
-            updateBuffer["analyzedPatientItemIds"] = set();
         updateBuffer["analyzedPatientItemIds"].update(newlyAnalyzedPatientItemIdSet);
 
+    def firstOccurrences(self, keys, seenKeys):
+        """Return boolean array of which positions in the keys array are the first occurrence of that key value,
+        excluding any that were already in the (sorted) seenKeys array.
+        """
+        isFirst = np.zeros(len(keys), dtype=bool);
+        (uniqueKeys, firstIndexes) = np.unique(keys, return_index=True);
+        isFirst[firstIndexes] = True;
+        isFirst &= ~np.in1d(keys, seenKeys, assume_unique=False);
+        return isFirst;
+
     def updateClinicalItemAssociationBuffer(self, patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, analysisOptions=None, itemIdPair=None):
         """Identify and record in the updateBuffer which statistics on associations
         between the two clinical items based on the new piece of observed item pair evidence given.
@@ -281,8 +964,6 @@ class AssociationAnalysis:
         deltaSecondsOptions = None;
         if analysisOptions is not None and analysisOptions.deltaSecondsOptions is not None:
             deltaSecondsOptions = analysisOptions.deltaSecondsOptions;
-        else:
-            deltaSecondsOptions = DELTA_NAME_BY_SECONDS.keys();
 
         # Convert timeDelta object into simple numerical representation (seconds as a real number) to facilitate some arithmetic
         timeDelta = patientItem2["item_date"] - patientItem1["item_date"];
@@ -304,37 +985,35 @@ class AssociationAnalysis:
         if isNewPairWithinEncounter:
             countPrefixes.append("encounter_");
 
-        if "incrementDataByItemIdPair" not in updateBuffer:
-            updateBuffer["incrementDataByItemIdPair"] = dict();
-            updateBuffer["nAssociations"] = 0;
-        if str(itemIdPair) not in updateBuffer["incrementDataByItemIdPair"]:
-            updateBuffer["incrementDataByItemIdPair"][str(itemIdPair)] = dict();
-            updateBuffer["nAssociations"] += 1;
-        incrementData = updateBuffer["incrementDataByItemIdPair"][str(itemIdPair)];
+        iRow = self.bufferRowIndex(updateBuffer, itemIdPair[0], itemIdPair[-1]);
+        incrementData = updateBuffer["incrementData"][iRow];   # View of the row for this item pair
+
+        if self.isHistogramBuffer(updateBuffer):
+            # Only need to increment the one histogram bin the time delta fits in
+            iBin = bisect.bisect_left(HISTOGRAM_BIN_SECONDS, secondsDelta);
+            for countPrefix in countPrefixes:
+                blockStart = HISTOGRAM_BLOCK_START_BY_PREFIX[countPrefix];
+                incrementData[blockStart+iBin] += 1;
+                incrementData[blockStart+HISTOGRAM_TIME_DIFF_SUM_OFFSET] += secondsDelta;
+                incrementData[blockStart+HISTOGRAM_TIME_DIFF_SUM_SQUARES_OFFSET] += secondsDelta**2;
+            return;
+
+        # Windows are cumulative and in ascending order, so every window from the first one that fits the time delta gets incremented
+        iFirstWindow = bisect.bisect_left(DELTA_SECONDS_OPTIONS, secondsDelta);
 
         # Decide on columns to increment pair association with time dependency
         for countPrefix in countPrefixes:
-            countField = countPrefix+"count_any";
-            if countField not in incrementData:
-                incrementData[countField] = 0;
-            incrementData[countField] += 1;
-
-            for secondsOption in deltaSecondsOptions:
-                if secondsDelta <= secondsOption:
-                    countField = countPrefix+"count_%d" % secondsOption;
-                    if countField not in incrementData:
-                        incrementData[countField] = 0;
-                    incrementData[countField] += 1;
-
-            sumField = countPrefix+"time_diff_sum";
-            if sumField not in incrementData:
-                incrementData[sumField] = 0;
-            incrementData[sumField] += secondsDelta;
-
-            sumField = countPrefix+"time_diff_sum_squares";
-            if sumField not in incrementData:
-                incrementData[sumField] = 0;
-            incrementData[sumField] += secondsDelta**2;
+            blockStart = BLOCK_START_BY_PREFIX[countPrefix];
+            if deltaSecondsOptions is None:
+                # Contiguous range of window columns through to count_any
+                incrementData[blockStart+iFirstWindow:blockStart+COUNT_ANY_OFFSET+1] += 1;
+            else:
+                for secondsOption in deltaSecondsOptions:
+                    if secondsDelta <= secondsOption:
+                        incrementData[blockStart+WINDOW_INDEX_BY_SECONDS[secondsOption]] += 1;
+                incrementData[blockStart+COUNT_ANY_OFFSET] += 1;
+            incrementData[blockStart+TIME_DIFF_SUM_OFFSET] += secondsDelta;
+            incrementData[blockStart+TIME_DIFF_SUM_SQUARES_OFFSET] += secondsDelta**2;
 
     def readyForIntervalCommit(self, iPatient, updateBuffer, analysisOptions):
         isReady = False;
@@ -343,55 +1022,281 @@ class AssociationAnalysis:
         return isReady;
 
 
+    def bufferMemoryBytes(self, updateBuffer):
+        """Rough estimate of the memory used by the update buffer, including the arrays' allocated capacity
+        and the row index lookup (Python dictionary entries and int objects)
+        """
+        memoryBytes = 0;
+        if "incrementData" in updateBuffer:
+            memoryBytes += updateBuffer["itemIdPairs"].nbytes + updateBuffer["incrementData"].nbytes;
+            memoryBytes += updateBuffer["nAssociations"] * ROW_INDEX_BYTES_PER_ASSOCIATION;
+        return memoryBytes;
+
+    def readyForSpill(self, updateBuffer, analysisOptions):
+        return analysisOptions.maxBufferMemory is not None and updateBuffer["nAssociations"] > 0 and self.bufferMemoryBytes(updateBuffer) > analysisOptions.maxBufferMemory;
+
+    def spillUpdateBuffer(self, updateBuffer, analysisOptions):
+        """Save the contents of the update buffer to a temporary sorted (binary) run file and clear it to free up memory.
+        Run files are tracked in the buffer's "spillFilenames" and merged back in when the buffer is persisted.
+        """
+        spillFilenames = updateBuffer.get("spillFilenames", []);
+        (fd, spillFilename) = tempfile.mkstemp(suffix=BINARY_BUFFER_EXTENSION, prefix="AssociationAnalysis.spill.", dir=analysisOptions.spillDir);
+        os.close(fd);
+        nAssociations = updateBuffer["nAssociations"];
+        log.info("Spill %d associations in buffer to %s" % (nAssociations, spillFilename) );
+        self.profiler.startPhase("spill");
+        self.saveBufferToBinaryFile(spillFilename, updateBuffer);   # Also resets buffer contents
+        self.profiler.stopPhase("spill", associations=nAssociations);
+        spillFilenames.append(spillFilename);
+        updateBuffer["spillFilenames"] = spillFilenames;
+
+    def commitSpilledBuffer(self, updateBuffer, linkedItemIdsByBaseId, analysisOptions, conn=None):
+        """Spill the rest of the update buffer contents as well, then commit the streaming merge
+        of all of the spilled run files in bounded blocks (commitBinaryBufferFiles),
+        so peak memory stays within the spill budget rather than that of the full merged results.
+        Spill files are removed and the given update buffer is reset.
+        """
+        self.spillUpdateBuffer(updateBuffer, analysisOptions);
+        spillFilenames = updateBuffer["spillFilenames"];
+        self.commitBinaryBufferFiles(spillFilenames, linkedItemIdsByBaseId, analysisOptions, conn=conn);
+        self.makeUpdateBuffer(updateBuffer);
+        for spillFilename in spillFilenames:
+            os.remove(spillFilename);
+
+    def saveSpilledBufferToBinaryFile(self, filename, updateBuffer, analysisOptions):
+        """Spill the rest of the update buffer contents as well, then write the streaming merge
+        of all of the spilled run files into a single binary buffer file (saveBinaryBufferBlocks).
+        Spill files are removed and the given update buffer is reset.
+        """
+        self.spillUpdateBuffer(updateBuffer, analysisOptions);
+        spillFilenames = updateBuffer["spillFilenames"];
+        (recordsList, analyzedPatientItemIds, columnNames) = self.openBinaryBufferFiles(spillFilenames);
+        self.profiler.startPhase("spillMerge");
+        nAssociations = self.saveBinaryBufferBlocks(filename, self.mergeBinaryBufferBlocks(recordsList, columnNames), analyzedPatientItemIds, columnNames);
+        self.profiler.stopPhase("spillMerge", associations=nAssociations);
+        del recordsList;    # Release memory maps
+        self.makeUpdateBuffer(updateBuffer);
+        for spillFilename in spillFilenames:
+            os.remove(spillFilename);
+
+    def collectSpilledBuffer(self, updateBuffer):
+        """Merge any spilled run files along with the current contents of the update buffer into a new (in-memory) buffer.
+        Only needed for (JSON) buffer file output. Otherwise, see commitSpilledBuffer and saveSpilledBufferToBinaryFile.
+        Spill files are removed and the given update buffer is reset.
+        """
+        spillFilenames = updateBuffer.get("spillFilenames", []);
+        self.profiler.startPhase("spillMerge");
+        mergedBuffer = self.mergeBinaryBufferFiles(spillFilenames);
+        self.mergeBuffers(mergedBuffer, updateBuffer);
+        self.profiler.stopPhase("spillMerge", associations=mergedBuffer["nAssociations"]);
+        self.makeUpdateBuffer(updateBuffer);
+        for spillFilename in spillFilenames:
+            os.remove(spillFilename);
+        return mergedBuffer;
+
     def mergeBuffers(self, bufferOne, bufferTwo):
+        """Add the contents of bufferTwo into bufferOne.
+        Item pairs found in both have their increments summed, while those only in bufferTwo are appended.
+        """
+        if "incrementData" not in bufferOne:
+            self.makeUpdateBuffer(bufferOne, columnNames=bufferTwo.get("columnNames"));
+        if "incrementData" in bufferTwo and bufferOne["columnNames"] != bufferTwo["columnNames"]:
+            raise ValueError("Can not merge update buffers with different increment columns (e.g., histogram vs. window counts)");
         if "analyzedPatientItemIds" not in bufferOne:
             bufferOne["analyzedPatientItemIds"] = set();
-        else:
+        if "analyzedPatientItemIds" in bufferTwo:
             bufferOne["analyzedPatientItemIds"].update(bufferTwo["analyzedPatientItemIds"]);
 
-        if "nAssociations" not in bufferOne:
-            bufferOne["nAssociations"] = 0
-        else:
-             bufferOne["nAssociations"] = bufferOne["nAssociations"] + bufferTwo["nAssociations"]
-
-        if "incrementDataByItemIdPair" not in bufferOne:
-            bufferOne["incrementDataByItemIdPair"] = dict()
-        if "incrementDataByItemIdPair" not in bufferTwo:
-            bufferTwo["incrementDataByItemIdPair"] = dict()
-
-        # then fill up any remaining id pairs from buffer two. if you have some in buffer two that are also in buffer one, then add those specific ones together
-        for key, value in bufferTwo["incrementDataByItemIdPair"].iteritems():
-            if key not in bufferOne["incrementDataByItemIdPair"]:
-                bufferOne["incrementDataByItemIdPair"][key] = bufferTwo["incrementDataByItemIdPair"][key]
-            else:
-                for key2, value2 in bufferTwo["incrementDataByItemIdPair"][key].iteritems():
-                    if key2 not in bufferOne["incrementDataByItemIdPair"][key]:
-                        bufferOne["incrementDataByItemIdPair"][key][key2]=bufferTwo["incrementDataByItemIdPair"][key][key2]
-                    else:
-                        bufferOne["incrementDataByItemIdPair"][key][key2]+=bufferTwo["incrementDataByItemIdPair"][key][key2]
+        if "incrementData" in bufferTwo:
+            # Find (or add) rows in buffer one for every item pair in buffer two, then add all increments at once
+            nRowsTwo = bufferTwo["nAssociations"];
+            self.ensureBufferCapacity(bufferOne, bufferOne["nAssociations"]+nRowsTwo);
+            rowIndexes = np.zeros(nRowsTwo, dtype=np.int64);
+            for iRowTwo, (itemId1, itemId2) in enumerate(bufferTwo["itemIdPairs"][:nRowsTwo].tolist()):
+                rowIndexes[iRowTwo] = self.bufferRowIndex(bufferOne, itemId1, itemId2);
+            bufferOne["incrementData"][rowIndexes] += bufferTwo["incrementData"][:nRowsTwo];
+
+        if "sketch" in bufferTwo:
+            if "sketch" not in bufferOne:
+                sketch = dict(bufferTwo["sketch"]);
+                sketch["table"] = np.zeros_like(sketch["table"]);
+                sketch["candidateItemIdPairsByKey"] = dict();
+                bufferOne["sketch"] = sketch;
+            self.mergeSketches(bufferOne["sketch"], bufferTwo["sketch"]);
 
         return bufferOne
 
     def bufferDecay (self, bufferDecay, decayValue):
-        if "incrementDataByItemIdPair" in bufferDecay:
-            for key, value in bufferDecay["incrementDataByItemIdPair"].iteritems():
-                for key2, value2 in bufferDecay["incrementDataByItemIdPair"][key].iteritems():
-                    bufferDecay["incrementDataByItemIdPair"][key][key2] *= decayValue
+        if "incrementData" in bufferDecay:
+            bufferDecay["incrementData"][:bufferDecay["nAssociations"]] *= decayValue;
         return bufferDecay
 
 
     def persistUpdateBuffer(self, updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient=None, conn=None):
+        if "sketch" in updateBuffer:
+            # Approximate counts. Only persist the item pairs with sufficient estimated support
+            self.profiler.startPhase("sketchMaterialize");
+            nMaterialized = self.materializeSketch(updateBuffer);
+            self.profiler.stopPhase("sketchMaterialize", associations=nMaterialized);
+        # Buffer contents may have been partially spilled to disk to stay within memory budget.
+        #   If so, stream merge them back in blocks for the full results
+        isSpilled = bool(updateBuffer.get("spillFilenames"));
         if analysisOptions.bufferFile is None:
             linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
-            self.commitUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, conn=conn)
+            if isSpilled:
+                self.commitSpilledBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, conn=conn);
+            else:
+                self.pruneUpdateBuffer(updateBuffer, analysisOptions, conn=conn);
+                self.commitUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, conn=conn)
         else:
-            bufferFilename = "%s.%s.json.gz" % (analysisOptions.bufferFile, iPatient);    # Modify filename with which patient done so far, in case saving several sequential results
-            self.saveBufferToFile(bufferFilename, updateBuffer);
+            nAssociations = updateBuffer["nAssociations"];
+            self.profiler.startPhase("bufferSave");
+            if analysisOptions.binaryBufferFile:
+                bufferFilename = "%s.%s%s" % (analysisOptions.bufferFile, iPatient, BINARY_BUFFER_EXTENSION);
+                if isSpilled:
+                    self.saveSpilledBufferToBinaryFile(bufferFilename, updateBuffer, analysisOptions);
+                else:
+                    self.saveBufferToBinaryFile(bufferFilename, updateBuffer);
+            else:
+                if isSpilled:   # JSON output needs the full results in memory anyway
+                    updateBuffer = self.collectSpilledBuffer(updateBuffer);
+                    nAssociations = updateBuffer["nAssociations"];
+                bufferFilename = "%s.%s.json.gz" % (analysisOptions.bufferFile, iPatient);    # Modify filename with which patient done so far, in case saving several sequential results
+                self.saveBufferToFile(bufferFilename, updateBuffer);
+            self.profiler.stopPhase("bufferSave", associations=nAssociations);
+
+    def minCountThresholds(self, analysisOptions):
+        """List of (columnName, minCount) support thresholds specified by the analysisOptions (minCount applies to count_any)"""
+        thresholds = list();
+        if analysisOptions is not None:
+            if analysisOptions.minCount is not None:
+                thresholds.append( ("count_any", analysisOptions.minCount) );
+            if analysisOptions.minCountByColumn is not None:
+                thresholds.extend( sorted(analysisOptions.minCountByColumn.iteritems()) );
+        for (columnName, minCount) in thresholds:
+            if columnName not in INCREMENT_COLUMN_NAMES:
+                raise ValueError("Unrecognized count column for minimum count: %s" % columnName);
+        return thresholds;
+
+    def pruneUpdateBuffer(self, updateBuffer, analysisOptions, conn=None):
+        """Drop the (long-tail) item pairs in the update buffer whose increments do not meet
+        every one of the analysisOptions minimum count thresholds, before they are committed.
+        Thresholds apply to the counts accumulated in the buffer, so with interval commits (patientsPerCommit),
+        a pair not yet stored must meet the thresholds within a single interval's counts.
+        Pairs already stored (e.g., by prior interval commits) are always kept, so stored counts are not left short,
+        leaving it to the pruneItemAssociations post-pass to check their totals.
+        Diagonal (item with itself) pairs are always kept, as they record the base counts for each item.
+        Return the number of item pairs dropped.
+        """
+        thresholds = self.minCountThresholds(analysisOptions);
+        nAssociations = updateBuffer.get("nAssociations", 0);
+        if not thresholds or nAssociations < 1:
+            return 0;
+        self.profiler.startPhase("prune");
+        itemIdPairs = updateBuffer["itemIdPairs"][:nAssociations];
+        incrementData = updateBuffer["incrementData"][:nAssociations];
+        countData = incrementData;
+        if self.isHistogramBuffer(updateBuffer):
+            countData = histogramIncrementData(incrementData);  # Window counts from histogram prefix sums
+        isKept = (itemIdPairs[:,0] == itemIdPairs[:,-1]);
+        isSupported = np.ones(nAssociations, dtype=bool);
+        for (columnName, minCount) in thresholds:
+            isSupported &= (countData[:,INCREMENT_COLUMN_NAMES.index(columnName)] >= minCount);
+        isKept |= isSupported;
+        candidateRowIndexes = np.flatnonzero(~isKept);
+        if len(candidateRowIndexes) > 0:
+            tableName = "clinical_item_association";
+            if self.isHistogramBuffer(updateBuffer):
+                tableName = "clinical_item_association_histogram";
+            isKept[candidateRowIndexes] = self.storedItemIdPairs(itemIdPairs[candidateRowIndexes], tableName, conn=conn);
+
+        # Compact the kept rows to the top of the buffer arrays and rebuild the row lookup
+        keptRowIndexes = np.flatnonzero(isKept);
+        nKept = len(keptRowIndexes);
+        updateBuffer["itemIdPairs"][:nKept] = itemIdPairs[keptRowIndexes];
+        updateBuffer["incrementData"][:nKept] = incrementData[keptRowIndexes];
+        updateBuffer["itemIdPairs"][nKept:nAssociations] = 0;
+        updateBuffer["incrementData"][nKept:nAssociations] = 0;
+        updateBuffer["nAssociations"] = nKept;
+        rowIndexByItemIdPairKey = updateBuffer["rowIndexByItemIdPairKey"];
+        rowIndexByItemIdPairKey.clear();
+        for iRow, (itemId1, itemId2) in enumerate(updateBuffer["itemIdPairs"][:nKept].tolist()):
+            rowIndexByItemIdPairKey[itemIdPairKey(itemId1, itemId2)] = iRow;
+        nPruned = nAssociations - nKept;
+        self.profiler.stopPhase("prune", associations=nPruned);
+        log.debug("Pruned %d of %d item pairs below minimum counts" % (nPruned, nAssociations) );
+        return nPruned;
+
+    def storedItemIdPairs(self, itemIdPairs, tableName, conn=None):
+        """Boolean array of which of the (clinical_item_id, subsequent_item_id) rows in the itemIdPairs array
+        already have a record in the given association table.
+        Item pairs are loaded into a staging table and joined against the association table, rather than a huge IN list.
+        """
+        extConn = conn is not None;
+        if not extConn:
+            conn = self.connFactory.connection();
+        cursor = conn.cursor();
+        try:
+            stagingTable = "clinical_item_association_stored";
+            columnNames = ["clinical_item_id","subsequent_item_id"];
+            self.loadStagingTable(stagingTable, ["clinical_item_id BIGINT","subsequent_item_id BIGINT"], columnNames, [tuple(itemIdPair) for itemIdPair in itemIdPairs.tolist()], cursor);
+            query = \
+                """
+                SELECT s.clinical_item_id, s.subsequent_item_id
+                FROM %(stagingTable)s AS s
+                INNER JOIN %(tableName)s AS cia
+                    ON cia.clinical_item_id = s.clinical_item_id AND cia.subsequent_item_id = s.subsequent_item_id
+                """ % {"stagingTable": stagingTable, "tableName": tableName};
+            cursor.execute(query);
+            storedItemIdPairs = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1,2);
+            cursor.execute("DELETE FROM %s" % stagingTable);
+        finally:
+            cursor.close();
+            if not extConn:
+                conn.close();
+        return np.in1d(itemIdPairKey(itemIdPairs[:,0], itemIdPairs[:,-1]), itemIdPairKey(storedItemIdPairs[:,0], storedItemIdPairs[:,-1]));
+
+    def pruneItemAssociations(self, analysisOptions, conn=None):
+        """Post-pass to delete stored clinical_item_association records (other than diagonal item base counts)
+        that do not meet every one of the analysisOptions minimum count thresholds,
+        including baseline (zero) records prepared for item pairs that never accrued any counts.
+        Stored histograms (histogramStorage) can not be filtered by count in the database, so are only pruned from the update buffer.
+        Return the number of records deleted.
+        """
+        thresholds = self.minCountThresholds(analysisOptions);
+        if not thresholds:
+            return 0;
+        extConn = conn is not None;
+        if not extConn:
+            conn = self.connFactory.connection();
+        try:
+            # Stored counts may be lazily scaled (e.g., decayed by DecayingWindows), so scale thresholds to match
+            countScale = self.dataManager.getAssociationCountScale(conn=conn);
+            query = ["DELETE FROM clinical_item_association WHERE clinical_item_id <> subsequent_item_id AND ("];
+            query.append(str.join(" OR ", ["%s < %s" % (columnName, DBUtil.SQL_PLACEHOLDER) for (columnName, minCount) in thresholds]) );
+            query.append(")");
+            params = [minCount / countScale for (columnName, minCount) in thresholds];
+            self.profiler.startPhase("prune");
+            nDeleted = DBUtil.execute(str.join(" ", query), params, conn=conn);
+            self.profiler.stopPhase("prune", associations=nDeleted);
+            log.info("Deleted %d stored associations below minimum counts" % nDeleted );
+            return nDeleted;
+        finally:
+            if not extConn:
+                conn.close();
 
     def saveBufferToFile (self, filename, updateBuffer):
+        nAssociations = updateBuffer["nAssociations"];
+        # Convert numeric arrays into plain lists for JSON output, only including rows in use
+        bufferData = \
+            {   "nAssociations": nAssociations,
+                "analyzedPatientItemIds": list(updateBuffer["analyzedPatientItemIds"]),
+                "columnNames": updateBuffer["columnNames"],
+                "itemIdPairs": updateBuffer["itemIdPairs"][:nAssociations].tolist(),
+                "incrementData": updateBuffer["incrementData"][:nAssociations].tolist(),
+            };
         ofs = stdOpen (filename, "w");
-        updateBuffer["analyzedPatientItemIds"] = list(updateBuffer["analyzedPatientItemIds"]);
-        json.dump(updateBuffer, ofs);
+        json.dump(bufferData, ofs);
         ofs.close();
 
         # Wipe out buffer to reflect incremental changes done, so any new ones should be recorded fresh
@@ -401,20 +1306,38 @@ class AssociationAnalysis:
         updateBuffer = None;
         try:
             #print >> sys.stderr, filename
+            if filename.endswith(BINARY_BUFFER_EXTENSION):
+                return self.mergeBinaryBufferFiles([filename]);
             log.info("Loading: %s" % filename);
+
             ifs = stdOpen(filename, "r")
-            updateBuffer = json.load(ifs)
-            updateBuffer["analyzedPatientItemIds"] = set(updateBuffer["analyzedPatientItemIds"])
+            bufferData = json.load(ifs)
             ifs.close()
+
+            updateBuffer = self.makeUpdateBuffer(columnNames=self.bufferColumnNames(bufferData["columnNames"]));
+            updateBuffer["analyzedPatientItemIds"].update(bufferData["analyzedPatientItemIds"]);
+            nAssociations = bufferData["nAssociations"];
+            if nAssociations > 0:
+                self.ensureBufferCapacity(updateBuffer, nAssociations);
+                updateBuffer["itemIdPairs"][:nAssociations] = bufferData["itemIdPairs"];
+                # Map columns by name in case saved by a version with a different column layout
+                columnIndexes = [updateBuffer["columnNames"].index(columnName) for columnName in bufferData["columnNames"]];
+                updateBuffer["incrementData"][:nAssociations, columnIndexes] = bufferData["incrementData"];
+                for iRow, (itemId1, itemId2) in enumerate(bufferData["itemIdPairs"]):
+                    updateBuffer["rowIndexByItemIdPairKey"][itemIdPairKey(itemId1, itemId2)] = iRow;
+                updateBuffer["nAssociations"] = nAssociations;
         except IOError, exc:
             # Apparently could not find the named filename. See if instead it's a prefix
             #    for a series of enumerated files and then merge them into one mass buffer
-            dirname = os.path.dirname(filename);
-            if dirname == "": dirname = ".";    # Implicitly the current working directory
-            basename = os.path.basename(filename);
-            for nextFilename in os.listdir(dirname):
-                if nextFilename.startswith(basename):
-                    nextFilepath = os.path.join(dirname, nextFilename);
+            nextFilepaths = self.bufferFilenames(filename);
+
+            # Binary buffer files can all be merged together in a single streaming pass
+            binaryFilepaths = [nextFilepath for nextFilepath in nextFilepaths if nextFilepath.endswith(BINARY_BUFFER_EXTENSION)];
+            if binaryFilepaths:
+                updateBuffer = self.mergeBinaryBufferFiles(binaryFilepaths);
+
+            for nextFilepath in nextFilepaths:
+                if nextFilepath not in binaryFilepaths:
                     nextUpdateBuffer = self.loadUpdateBufferFromFile(nextFilepath);
                     if updateBuffer is None:    # First update buffer, use it as base
                         updateBuffer = nextUpdateBuffer;
@@ -424,11 +1347,257 @@ class AssociationAnalysis:
 
         return updateBuffer;
 
-    def commitUpdateBufferFromFile(self, filename):
+    def bufferColumnNames(self, savedColumnNames):
+        """Increment column layout (HISTOGRAM_COLUMN_NAMES or INCREMENT_COLUMN_NAMES) to load saved buffer columns into"""
+        if savedColumnNames and savedColumnNames[0] in HISTOGRAM_COLUMN_NAMES:
+            return HISTOGRAM_COLUMN_NAMES;
+        return INCREMENT_COLUMN_NAMES;
+
+    def saveBufferToBinaryFile(self, filename, updateBuffer):
+        """Alternative to saveBufferToFile with a binary fixed-width format (numpy .npy)
+        that is much faster to write and read than JSON, and can be memory-mapped.
+        File contains one record per item pair, sorted by itemIdPairKey,
+        with fields for the item IDs and each increment column (columnNames),
+        followed by a second array of the analyzed patient item IDs.
+        """
+        nAssociations = updateBuffer["nAssociations"];
+        itemIdPairs = updateBuffer["itemIdPairs"][:nAssociations];
+        incrementData = updateBuffer["incrementData"][:nAssociations];
+        sortIndexes = np.argsort(itemIdPairKey(itemIdPairs[:,0], itemIdPairs[:,-1]), kind="mergesort");
+
+        records = np.zeros(nAssociations, dtype=self.binaryBufferDtype(updateBuffer["columnNames"]));
+        records["clinical_item_id"] = itemIdPairs[sortIndexes,0];
+        records["subsequent_item_id"] = itemIdPairs[sortIndexes,-1];
+        for iColumn, columnName in enumerate(updateBuffer["columnNames"]):
+            records[columnName] = incrementData[sortIndexes,iColumn];
+        analyzedPatientItemIds = np.array(sorted(updateBuffer["analyzedPatientItemIds"]), dtype=np.int64);
+
+        ofs = open(filename, "wb");
+        np.save(ofs, records);
+        np.save(ofs, analyzedPatientItemIds);
+        ofs.close();
+
+        # Wipe out buffer to reflect incremental changes done, so any new ones should be recorded fresh
+        updateBuffer = self.makeUpdateBuffer(updateBuffer);
+
+    def saveBinaryBufferBlocks(self, filename, mergedBlocks, analyzedPatientItemIds, columnNames):
+        """Write blocks of merged item pairs (e.g., from mergeBinaryBufferBlocks, already in key order)
+        to a binary buffer file in the same format as saveBufferToBinaryFile, one block at a time.
+        The number of records is not known until the end, so they are first written to a temporary file,
+        then copied after the array header.
+        Returns the number of item pair records written.
+        """
+        dtype = self.binaryBufferDtype(columnNames);
+        nRecords = 0;
+        recordsFile = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename)));
+        try:
+            for (uniqueKeys, itemIdPairs, incrementData) in mergedBlocks:
+                records = np.zeros(len(uniqueKeys), dtype=dtype);
+                records["clinical_item_id"] = itemIdPairs[:,0];
+                records["subsequent_item_id"] = itemIdPairs[:,-1];
+                for iColumn, columnName in enumerate(columnNames):
+                    records[columnName] = incrementData[:,iColumn];
+                recordsFile.write(records.tostring());
+                nRecords += len(records);
+            recordsFile.seek(0);
+
+            ofs = open(filename, "wb");
+            np.lib.format.write_array_header_1_0(ofs, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (nRecords,)});
+            shutil.copyfileobj(recordsFile, ofs);
+            np.save(ofs, np.array(sorted(analyzedPatientItemIds), dtype=np.int64));
+            ofs.close();
+        finally:
+            recordsFile.close();
+        return nRecords;
+
+    def binaryBufferDtype(self, columnNames):
+        """Numpy record type for binary buffer files"""
+        fields = [("clinical_item_id", np.int64), ("subsequent_item_id", np.int64)];
+        fields.extend([(str(columnName), np.float64) for columnName in columnNames]);
+        return np.dtype(fields);
+
+    def openBinaryBufferFile(self, filename):
+        """Memory-map the item pair records of a binary buffer file (saveBufferToBinaryFile),
+        so they can be read in blocks without loading the whole file.
+        Returns (records, analyzedPatientItemIds)
+        """
+        ifs = open(filename, "rb");
+        try:
+            version = np.lib.format.read_magic(ifs);
+            if version == (1,0):
+                (shape, fortranOrder, dtype) = np.lib.format.read_array_header_1_0(ifs);
+            else:
+                (shape, fortranOrder, dtype) = np.lib.format.read_array_header_2_0(ifs);
+            offset = ifs.tell();
+            records = np.zeros(0, dtype=dtype);
+            if shape[0] > 0:
+                records = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape);
+            ifs.seek(offset + shape[0]*dtype.itemsize);
+            analyzedPatientItemIds = np.load(ifs);
+        finally:
+            ifs.close();
+        return (records, analyzedPatientItemIds);
+
+    def openBinaryBufferFiles(self, filenames):
+        """Memory-map the item pair records of each of the binary buffer files, to be merged by mergeBinaryBufferBlocks.
+        Returns (recordsList, analyzedPatientItemIds, columnNames), with the union of the analyzed patient item IDs
+        and the increment column layout to merge the records into.
+        """
+        recordsList = list();
+        analyzedPatientItemIdSet = set();
+        for filename in filenames:
+            log.info("Loading: %s" % filename);
+            (records, analyzedPatientItemIds) = self.openBinaryBufferFile(filename);
+            recordsList.append(records);
+            analyzedPatientItemIdSet.update(analyzedPatientItemIds.tolist());
+        savedColumnNames = None;
+        if recordsList:
+            savedColumnNames = list(recordsList[0].dtype.names[2:]);
+        return (recordsList, analyzedPatientItemIdSet, self.bufferColumnNames(savedColumnNames));
+
+    def mergeBinaryBufferBlocks(self, recordsList, columnNames):
+        """Generator for a streaming k-way merge of binary buffer file records (openBinaryBufferFiles).
+        Since records in each file are sorted by item pair key, only need to read a block at a time from each file.
+        Each round, take the smallest of the last keys in each file's next block as a bound,
+        then add up every record up to the bound across all files (which must be in the current blocks).
+        Yields (itemIdPairKeys, itemIdPairs, incrementData) arrays for each round's merged item pairs (in columnNames layout),
+        in key order, so each item pair's increments are complete within the one block it appears in.
+        """
+        positions = [0]*len(recordsList);
+        while True:
+            activeSources = [iSource for iSource, records in enumerate(recordsList) if positions[iSource] < len(records)];
+            if not activeSources:
+                break;
+
+            blockKeysBySource = dict();
+            keyBound = None;
+            for iSource in activeSources:
+                block = recordsList[iSource][positions[iSource]:positions[iSource]+MERGE_BLOCK_SIZE];
+                blockKeys = itemIdPairKey(block["clinical_item_id"], block["subsequent_item_id"]);
+                blockKeysBySource[iSource] = blockKeys;
+                if keyBound is None or blockKeys[-1] < keyBound:
+                    keyBound = blockKeys[-1];
+
+            # Collect all records up to the key bound from each source
+            keysList = list();
+            itemIdPairsList = list();
+            incrementDataList = list();
+            for iSource in activeSources:
+                blockKeys = blockKeysBySource[iSource];
+                nTake = np.searchsorted(blockKeys, keyBound, side="right");
+                block = recordsList[iSource][positions[iSource]:positions[iSource]+nTake];
+                keysList.append(blockKeys[:nTake]);
+                itemIdPairsList.append(np.column_stack([block["clinical_item_id"], block["subsequent_item_id"]]));
+                sourceColumnNames = [columnName for columnName in block.dtype.names[2:]];
+                sourceData = np.zeros( (nTake, len(columnNames)) );
+                for columnName in sourceColumnNames:
+                    sourceData[:,columnNames.index(columnName)] = block[columnName];
+                incrementDataList.append(sourceData);
+                positions[iSource] += nTake;
+
+            # Sum up records for the same item pair
+            keys = np.concatenate(keysList);
+            sortIndexes = np.argsort(keys, kind="mergesort");
+            keys = keys[sortIndexes];
+            itemIdPairs = np.concatenate(itemIdPairsList)[sortIndexes];
+            incrementData = np.concatenate(incrementDataList)[sortIndexes];
+            (uniqueKeys, firstIndexes) = np.unique(keys, return_index=True);
+            itemIdPairs = itemIdPairs[firstIndexes];
+            incrementData = np.add.reduceat(incrementData, firstIndexes, axis=0);
+
+            yield (uniqueKeys, itemIdPairs, incrementData);
+
+    def mergeBinaryBufferFiles(self, filenames):
+        """Load and merge binary buffer files into a single in-memory update buffer with a streaming k-way merge (mergeBinaryBufferBlocks).
+        Use commitBinaryBufferFiles instead to commit the files without holding the full merged results in memory.
+        """
+        (recordsList, analyzedPatientItemIds, columnNames) = self.openBinaryBufferFiles(filenames);
+        updateBuffer = self.makeUpdateBuffer(columnNames=columnNames);
+        updateBuffer["analyzedPatientItemIds"].update(analyzedPatientItemIds);
+        for (uniqueKeys, itemIdPairs, incrementData) in self.mergeBinaryBufferBlocks(recordsList, columnNames):
+            # Append to the update buffer. Keys all greater than those from prior rounds, so no existing rows to add to.
+            nAssociations = updateBuffer["nAssociations"];
+            nNewAssociations = len(uniqueKeys);
+            self.ensureBufferCapacity(updateBuffer, nAssociations+nNewAssociations);
+            updateBuffer["itemIdPairs"][nAssociations:nAssociations+nNewAssociations] = itemIdPairs;
+            updateBuffer["incrementData"][nAssociations:nAssociations+nNewAssociations] = incrementData;
+            updateBuffer["rowIndexByItemIdPairKey"].update( zip(uniqueKeys.tolist(), xrange(nAssociations, nAssociations+nNewAssociations)) );
+            updateBuffer["nAssociations"] = nAssociations+nNewAssociations;
+
+        return updateBuffer;
+
+    def commitBinaryBufferFiles(self, filenames, linkedItemIdsByBaseId, analysisOptions=None, conn=None):
+        """Alternative to commitUpdateBuffer(mergeBinaryBufferFiles(filenames)) that commits the
+        streaming merge of the binary buffer files block by block (mergeBinaryBufferBlocks),
+        so the full merged results (or a row lookup for them) never need to be held in memory.
+        Each block's increments are staged on the same connection, with a single database commit
+        (and marking of the analyzed patient items) at the end, as if committing all at once.
+        If analysisOptions specify minimum counts, each block is pruned before it is committed,
+        which is equivalent to pruning all at once since each item pair only appears in one block.
+        """
+        extConn = conn is not None;
+        if not extConn:
+            conn = self.connFactory.connection();
+        try:
+            (recordsList, analyzedPatientItemIds, columnNames) = self.openBinaryBufferFiles(filenames);
+            blockBuffer = self.makeUpdateBuffer(columnNames=columnNames);
+
+            prepareBaseline = True;
+            if not self.isHistogramBuffer(blockBuffer):
+                # Baseline records for all combinations of the items involved up front, rather than only within each block
+                itemIdSet = set();
+                for records in recordsList:
+                    itemIdSet.update(np.unique(records["clinical_item_id"]).tolist());
+                    itemIdSet.update(np.unique(records["subsequent_item_id"]).tolist());
+                itemIdPairs = [(itemId, itemId) for itemId in sorted(itemIdSet)];
+                self.profiler.startPhase("baseline");
+                self.prepareItemAssociations(itemIdPairs, linkedItemIdsByBaseId, conn);
+                self.profiler.stopPhase("baseline", associations=len(itemIdPairs));
+                prepareBaseline = False;
+
+            for (uniqueKeys, itemIdPairs, incrementData) in self.mergeBinaryBufferBlocks(recordsList, columnNames):
+                # Blocks are only committed, never looked up by item pair, so no need for the row index lookup
+                self.makeUpdateBuffer(blockBuffer);
+                nAssociations = len(uniqueKeys);
+                self.ensureBufferCapacity(blockBuffer, nAssociations);
+                blockBuffer["itemIdPairs"][:nAssociations] = itemIdPairs;
+                blockBuffer["incrementData"][:nAssociations] = incrementData;
+                blockBuffer["nAssociations"] = nAssociations;
+                self.pruneUpdateBuffer(blockBuffer, analysisOptions, conn=conn);
+                self.stageUpdateBufferIncrements(blockBuffer, linkedItemIdsByBaseId, conn, prepareBaseline);
+            del recordsList;    # Release memory maps
+
+            self.commitAnalyzedPatientItems(analyzedPatientItemIds, conn);
+        finally:
+            if not extConn:
+                conn.close();
+
+    def bufferFilenames(self, filename):
+        """List of the buffer file(s) with the given filename, or if no such file, those with it as a prefix (e.g., enumerated interval buffer files)"""
+        if os.path.isfile(filename):
+            return [filename];
+        dirname = os.path.dirname(filename);
+        if dirname == "": dirname = ".";    # Implicitly the current working directory
+        basename = os.path.basename(filename);
+        return [os.path.join(dirname, nextFilename) for nextFilename in sorted(os.listdir(dirname)) if nextFilename.startswith(basename)];
+
+    def commitUpdateBufferFromFile(self, filename, analysisOptions=None):
+        """Load (and merge) the buffer file(s) with the given filename (prefix) and commit them to the database.
+        If analysisOptions specify minimum counts, prune the merged buffer and stored associations with them.
+        """
         conn = self.connFactory.connection();
-        updateBuffer = self.loadUpdateBufferFromFile(filename);
         linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
-        self.commitUpdateBuffer(updateBuffer,linkedItemIdsByBaseId, conn=conn);
+        filenames = self.bufferFilenames(filename);
+        if filenames and all([nextFilename.endswith(BINARY_BUFFER_EXTENSION) for nextFilename in filenames]):
+            # Binary buffer files can be merged and committed in a single streaming pass
+            self.commitBinaryBufferFiles(filenames, linkedItemIdsByBaseId, analysisOptions, conn=conn);
+        else:
+            self.profiler.startPhase("bufferLoad");
+            updateBuffer = self.loadUpdateBufferFromFile(filename);
+            self.profiler.stopPhase("bufferLoad", associations=updateBuffer["nAssociations"]);
+            self.pruneUpdateBuffer(updateBuffer, analysisOptions, conn=conn);
+            self.commitUpdateBuffer(updateBuffer,linkedItemIdsByBaseId, conn=conn);
+        self.pruneItemAssociations(analysisOptions, conn=conn);
 
 
     def commitUpdateBuffer(self, updateBuffer, linkedItemIdsByBaseId, conn=None):
@@ -440,126 +1609,318 @@ class AssociationAnalysis:
         if not extConn:
             conn = self.connFactory.connection();
         try:
-            if "incrementDataByItemIdPair" in updateBuffer:
-                # Ensure baseline records exist to facilitate subsequent incremental update queries
-                itemIdPairs = updateBuffer["incrementDataByItemIdPair"].keys();
-                self.prepareItemAssociations(itemIdPairs, linkedItemIdsByBaseId, conn);
-
-                # Construct incremental update queries based on each item pair's incremental counts/sums
-                nItemPairs = len(itemIdPairs);
-                log.debug("Primary increment updates for %d item pairs" % nItemPairs );
-                incrementProg = ProgressDots(name="Increments");
-                incrementProg.total = nItemPairs;
-                cursor = conn.cursor();
-                try:
-                    for (itemIdPair, incrementData) in updateBuffer["incrementDataByItemIdPair"].iteritems():
-                        query = ["UPDATE clinical_item_association SET"];
-                        for col, increment in incrementData.iteritems():
-                            query.append("%(col)s=%(col)s+%(increment)s" % {"col":col,"increment":increment});
-                            query.append(",");
-                        query.pop();    # Drop extra comma at end of list
-                        query.append("WHERE clinical_item_id=%(p)s AND subsequent_item_id=%(p)s" % {"p":DBUtil.SQL_PLACEHOLDER} );
-                        query = str.join(" ", query);
-                        itemIdPair = eval(itemIdPair)
-                        cursor.execute(query, itemIdPair);
-                        incrementProg.update();
-                    # incrementProg.printStatus();
-                finally:
-                    cursor.close();
-
-            if "analyzedPatientItemIds" in updateBuffer:
-                # Record analysis date for the given patient items
-                patientItemIdSet = updateBuffer["analyzedPatientItemIds"];
-                nItems = len(patientItemIdSet);
-                log.debug("Record %d analyzed items" % nItems );
-                if nItems > 0:
-                    paramList = [datetime.now()];
-                    updateSize = 0;
-                    for itemId in patientItemIdSet:
-                        paramList.append(itemId);
-                        updateSize += 1;
-
-                        if self.itemsPerUpdate is not None and updateSize > self.itemsPerUpdate:
-                            # Update what we have so far to avoid excessive single mass query that may overwhelm database timeout
-                            DBUtil.execute \
-                            (   """update patient_item
-                                set analyze_date = %(p)s
-                                where patient_item_id in (%(pList)s)
-                                and analyze_date is null
-                                """ % {"p": DBUtil.SQL_PLACEHOLDER, "pList":generatePlaceholders(updateSize)},
-                                tuple(paramList),
-                                conn=conn
-                            );
-                            # Reset item list parameters
-                            paramList = [datetime.now()];
-                            updateSize = 0;
-                    # Final Update
-                    DBUtil.execute \
-                    (   """update patient_item
-                        set analyze_date = %(p)s
-                        where patient_item_id in (%(pList)s)
-                        and analyze_date is null
-                        """ % {"p": DBUtil.SQL_PLACEHOLDER, "pList":generatePlaceholders(updateSize)},
-                        tuple(paramList),
-                        conn=conn
-                    );
-
-            # Flag that any cached association metrics will be out of date
-            self.dataManager.clearCacheData("analyzedPatientCount");
-            self.dataManager.clearCacheData("clinicalItemCountsUpdated");
-
-            # Database commit
-            conn.commit();
+            if "incrementData" in updateBuffer:
+                self.stageUpdateBufferIncrements(updateBuffer, linkedItemIdsByBaseId, conn);
+            self.commitAnalyzedPatientItems(updateBuffer.get("analyzedPatientItemIds"), conn);
 
             # Wipe out buffer to reflect incremental changes done, so any new ones should be recorded fresh
-            updateBuffer.clear();
-            updateBuffer["nAssociations"] = 0;
+            self.makeUpdateBuffer(updateBuffer);
         finally:
             if not extConn:
                 conn.close();
 
-    def prepareItemAssociations(self, itemIdPairs, linkedItemIdsByBaseId, conn):
+    def stageUpdateBufferIncrements(self, updateBuffer, linkedItemIdsByBaseId, conn, prepareBaseline=True):
+        """Apply the item pair increments in the updateBuffer to the database, without committing the transaction yet.
+        Unless prepareBaseline is False (i.e., already done by the caller), first ensure the baseline association records exist.
+        """
+        itemIdPairs = self.bufferItemIdPairs(updateBuffer);
+        incrementData = updateBuffer["incrementData"][:len(itemIdPairs)];
+        columnNames = updateBuffer["columnNames"];
+        # Stored counts may be lazily scaled (e.g., decayed by DecayingWindows), so new count increments must be inversely scaled to match
+        countScale = self.dataManager.getAssociationCountScale(conn=conn);
+
+        allCombinations = True;
+        if self.isHistogramBuffer(updateBuffer):
+            # Item pair histograms stored separately, leaving only the diagonal item base counts for clinical_item_association
+            (itemIdPairs, incrementData) = self.commitHistogramIncrements(itemIdPairs, incrementData, countScale, conn);
+            columnNames = INCREMENT_COLUMN_NAMES;
+            allCombinations = False;
+
+        # Ensure baseline records exist to facilitate subsequent incremental update queries
+        if prepareBaseline:
+            self.profiler.startPhase("baseline");
+            self.prepareItemAssociations(itemIdPairs, linkedItemIdsByBaseId, conn, allCombinations);
+            self.profiler.stopPhase("baseline", associations=len(itemIdPairs));
+
+        # Construct incremental update queries based on each item pair's incremental counts/sums
+        nItemPairs = len(itemIdPairs);
+        if countScale != 1.0:
+            countColumnIndexes = [iColumn for iColumn, columnName in enumerate(columnNames) if "count_" in columnName];
+            incrementData = incrementData.copy();
+            incrementData[:,countColumnIndexes] /= countScale;
+        # Only bother with columns that have any increments at all (e.g., may only be counting some time windows)
+        activeColumnIndexes = np.flatnonzero(incrementData.any(axis=0));
+        log.debug("Primary increment updates for %d item pairs" % nItemPairs );
+        activeColumnNames = [columnNames[iColumn] for iColumn in activeColumnIndexes];
+        self.profiler.startPhase("increments");
+        if len(activeColumnIndexes) < 1:
+            pass;   # Nothing to increment
+        elif self.bulkCommit:
+            self.commitIncrementsBulk(itemIdPairs, incrementData[:,activeColumnIndexes], activeColumnNames, conn);
+        else:
+            self.commitIncrements(itemIdPairs, incrementData[:,activeColumnIndexes], activeColumnNames, conn);
+        self.profiler.stopPhase("increments", associations=nItemPairs);
+
+    def commitAnalyzedPatientItems(self, analyzedPatientItemIds, conn):
+        """Record the analysis date for the given patient items (if any), flag cached association metrics
+        as out of date, and commit the database transaction along with any staged increments.
+        """
+        if analyzedPatientItemIds is not None:
+            # Record analysis date for the given patient items
+            self.profiler.startPhase("markAnalyzed");
+            self.markAnalyzedPatientItems(analyzedPatientItemIds, conn);
+            self.profiler.stopPhase("markAnalyzed", rows=len(analyzedPatientItemIds));
+
+        # Flag that any cached association metrics will be out of date
+        self.dataManager.clearCacheData("analyzedPatientCount", conn=conn);
+        self.dataManager.clearCacheData("clinicalItemCountsUpdated", conn=conn);
+
+        # Database commit
+        self.profiler.startPhase("dbCommit");
+        conn.commit();
+        self.profiler.stopPhase("dbCommit");
+
+    def commitHistogramIncrements(self, itemIdPairs, histogramData, countScale, conn):
+        """Add the (HISTOGRAM_COLUMN_NAMES layout) histogram increments for the off-diagonal item pairs
+        into their clinical_item_association_histogram records, inserting any not yet recorded.
+        Stored histograms are text, so existing records are read (joined against a staging table of the item pairs),
+        added to in memory, then written back.
+        Return (itemIdPairs, incrementData) for the remaining diagonal item pairs, converted to the INCREMENT_COLUMN_NAMES layout,
+        to be committed as usual, as the item base counts.
+        """
+        isDiagonal = np.array([itemId1 == itemId2 for (itemId1, itemId2) in itemIdPairs], dtype=bool);
+        diagonalItemIdPairs = [itemIdPair for itemIdPair, diagonal in zip(itemIdPairs, isDiagonal.tolist()) if diagonal];
+        diagonalIncrementData = histogramIncrementData(histogramData[isDiagonal]);
+        histogramItemIdPairs = [itemIdPair for itemIdPair, diagonal in zip(itemIdPairs, isDiagonal.tolist()) if not diagonal];
+        histogramData = histogramData[~isDiagonal];
+        if countScale != 1.0:
+            # Stored histograms (bins and time_diff sums) are decayed together (see DecayingWindows), so scale both
+            histogramData = histogramData / countScale;
+
+        self.profiler.startPhase("histograms");
+        histogramColumns = [countPrefix+"histogram" for countPrefix in COUNT_PREFIX_OPTIONS];
+        sumColumns = list();
+        for countPrefix in COUNT_PREFIX_OPTIONS:
+            sumColumns.extend([countPrefix+"time_diff_sum", countPrefix+"time_diff_sum_squares"]);
+        stagingTable = "clinical_item_association_histogram_key";
+        cursor = conn.cursor();
+        try:
+            # Existing records for the item pairs
+            self.loadStagingTable(stagingTable, ["clinical_item_id BIGINT","subsequent_item_id BIGINT"], ["clinical_item_id","subsequent_item_id"], histogramItemIdPairs, cursor);
+            query = \
+                """
+                SELECT h.clinical_item_id, h.subsequent_item_id, %s
+                FROM clinical_item_association_histogram AS h
+                INNER JOIN %s AS s
+                    ON h.clinical_item_id = s.clinical_item_id AND h.subsequent_item_id = s.subsequent_item_id
+                """ % (str.join(", ", ["h.%s" % col for col in histogramColumns+sumColumns]), stagingTable);
+            cursor.execute(query);
+            existingRowByItemIdPair = dict();
+            for row in cursor.fetchall():
+                existingRowByItemIdPair[(row[0], row[1])] = row[2:];
+            cursor.execute("DELETE FROM %s" % stagingTable);
+
+            updateRows = list();
+            insertRows = list();
+            for iRow, itemIdPair in enumerate(histogramItemIdPairs):
+                rowData = histogramData[iRow];
+                existingRow = existingRowByItemIdPair.get(itemIdPair);
+                histogramValues = list();
+                sumValues = list();
+                for iPrefix, countPrefix in enumerate(COUNT_PREFIX_OPTIONS):
+                    blockStart = HISTOGRAM_BLOCK_START_BY_PREFIX[countPrefix];
+                    binCounts = rowData[blockStart:blockStart+N_HISTOGRAM_BINS];
+                    timeDiffSums = rowData[blockStart+HISTOGRAM_TIME_DIFF_SUM_OFFSET:blockStart+HISTOGRAM_TIME_DIFF_SUM_SQUARES_OFFSET+1].tolist();
+                    if existingRow is not None:
+                        binCounts = binCounts + parseHistogram(existingRow[iPrefix]);
+                        timeDiffSums = [timeDiffSum + (existingSum or 0.0) for timeDiffSum, existingSum in zip(timeDiffSums, existingRow[len(COUNT_PREFIX_OPTIONS)+2*iPrefix:len(COUNT_PREFIX_OPTIONS)+2*iPrefix+2])];
+                    histogramValues.append(formatHistogram(binCounts));
+                    sumValues.extend(timeDiffSums);
+                if existingRow is not None:
+                    updateRows.append( histogramValues + sumValues + list(itemIdPair) );
+                else:
+                    insertRows.append( list(itemIdPair) + histogramValues + sumValues );
+
+            log.debug("Update %d and insert %d item pair histograms" % (len(updateRows), len(insertRows)) );
+            if updateRows:
+                query = "UPDATE clinical_item_association_histogram SET %s WHERE clinical_item_id = %s AND subsequent_item_id = %s" % \
+                    (str.join(", ", ["%s = %s" % (col, DBUtil.SQL_PLACEHOLDER) for col in histogramColumns+sumColumns]), DBUtil.SQL_PLACEHOLDER, DBUtil.SQL_PLACEHOLDER);
+                cursor.executemany(query, updateRows);
+            if insertRows:
+                insertColumns = ["clinical_item_id","subsequent_item_id"] + histogramColumns + sumColumns;
+                query = "INSERT INTO clinical_item_association_histogram (%s) VALUES (%s)" % (str.join(",", insertColumns), generatePlaceholders(len(insertColumns)) );
+                cursor.executemany(query, insertRows);
+        finally:
+            cursor.close();
+        self.profiler.stopPhase("histograms", associations=len(histogramItemIdPairs));
+
+        return (diagonalItemIdPairs, diagonalIncrementData);
+
+    def commitIncrements(self, itemIdPairs, incrementData, columnNames, conn):
+        """Apply the increments to the existing baseline clinical_item_association records
+        with one parametrized UPDATE query per item pair.
+        """
+        query = ["UPDATE clinical_item_association SET"];
+        for col in columnNames:
+            query.append("%(col)s=%(col)s+%(p)s" % {"col":col,"p":DBUtil.SQL_PLACEHOLDER});
+            query.append(",");
+        query.pop();    # Drop extra comma at end of list
+        query.append("WHERE clinical_item_id=%(p)s AND subsequent_item_id=%(p)s" % {"p":DBUtil.SQL_PLACEHOLDER} );
+        query = str.join(" ", query);
+
+        incrementProg = ProgressDots(name="Increments");
+        incrementProg.total = len(itemIdPairs);
+        cursor = conn.cursor();
+        try:
+            for iRow, itemIdPair in enumerate(itemIdPairs):
+                params = incrementData[iRow].tolist();
+                params.extend(itemIdPair);
+                cursor.execute(query, params);
+                incrementProg.update();
+            # incrementProg.printStatus();
+        finally:
+            cursor.close();
+
+    def commitIncrementsBulk(self, itemIdPairs, incrementData, columnNames, conn):
+        """Set-based alternative to one UPDATE query per item pair.
+        Load all of the increments into a temporary staging table
+        (COPY for PostgreSQL, otherwise executemany inserts), then apply them
+        with a single UPDATE joined against the staging table.
+        Assumes baseline clinical_item_association records already exist (prepareItemAssociations).
+        """
+        stagingTable = "clinical_item_association_increment";
+        cursor = conn.cursor();
+        try:
+            columnDefs = ["clinical_item_id BIGINT","subsequent_item_id BIGINT"];
+            columnDefs.extend(["%s DOUBLE PRECISION DEFAULT 0" % col for col in INCREMENT_COLUMN_NAMES]);
+            stagingColumns = ["clinical_item_id","subsequent_item_id"];
+            stagingColumns.extend(columnNames);
+            log.debug("Stage increments for %d item pairs" % len(itemIdPairs) );
+            stagingRows = [itemIdPair+tuple(rowData) for itemIdPair, rowData in zip(itemIdPairs, incrementData.tolist())];
+            self.loadStagingTable(stagingTable, columnDefs, stagingColumns, stagingRows, cursor);
+
+            log.debug("Apply staged increments");
+            if LocalEnv.DATABASE_CONNECTOR_NAME in ("mysql.connector","MySQLdb"):
+                # MySQL does not support UPDATE ... FROM, but equivalent with JOIN syntax
+                query = ["UPDATE clinical_item_association AS cia JOIN %s AS s ON cia.clinical_item_id = s.clinical_item_id AND cia.subsequent_item_id = s.subsequent_item_id SET" % stagingTable];
+                query.append(str.join(", ", ["cia.%(col)s = cia.%(col)s + s.%(col)s" % {"col":col} for col in columnNames]) );
+            else:
+                query = ["UPDATE clinical_item_association SET"];
+                query.append(str.join(", ", ["%(col)s = clinical_item_association.%(col)s + s.%(col)s" % {"col":col} for col in columnNames]) );
+                query.append("FROM %s AS s" % stagingTable);
+                query.append("WHERE clinical_item_association.clinical_item_id = s.clinical_item_id AND clinical_item_association.subsequent_item_id = s.subsequent_item_id");
+            cursor.execute(str.join(" ", query));
+
+            cursor.execute("DELETE FROM %s" % stagingTable);
+        finally:
+            cursor.close();
+
+    def markAnalyzedPatientItems(self, patientItemIds, conn):
+        """Set the analyze_date for the given patient items that have not been marked yet.
+        Load the IDs into a temporary staging table and run a joined update,
+        rather than parsing / planning huge IN lists.
+        If itemsPerUpdate is set, will only stage and update that many items at a time.
+        """
+        patientItemIds = list(patientItemIds);
+        nItems = len(patientItemIds);
+        log.debug("Record %d analyzed items" % nItems );
+        if nItems < 1:
+            return;
+
+        updateSize = nItems;
+        if self.itemsPerUpdate is not None:
+            updateSize = max(self.itemsPerUpdate, 1);
+
+        stagingTable = "patient_item_analyzed";
+        query = \
+            """update patient_item
+            set analyze_date = %(p)s
+            where patient_item_id in (select patient_item_id from %(stagingTable)s)
+            and analyze_date is null
+            """ % {"p": DBUtil.SQL_PLACEHOLDER, "stagingTable": stagingTable};
+        cursor = conn.cursor();
+        try:
+            for iStart in xrange(0, nItems, updateSize):
+                stagingRows = [(patientItemId,) for patientItemId in patientItemIds[iStart:iStart+updateSize]];
+                self.loadStagingTable(stagingTable, ["patient_item_id BIGINT"], ["patient_item_id"], stagingRows, cursor);
+                cursor.execute(query, (datetime.now(),) );
+            cursor.execute("DELETE FROM %s" % stagingTable);
+        finally:
+            cursor.close();
+
+    def loadStagingTable(self, stagingTable, columnDefs, columnNames, rows, cursor):
+        """Create (if needed) a temporary staging table and fill it with the given rows,
+        replacing any prior contents. Uses COPY for PostgreSQL, otherwise executemany inserts.
+
+        Staging tables are kept for the life of the connection and emptied rather than dropped,
+        as sqlite will not drop a table while the patient item query is still being read from the same connection.
+        """
+        cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS %s (%s)" % (stagingTable, str.join(", ", columnDefs)) );
+        cursor.execute("DELETE FROM %s" % stagingTable);
+        if LocalEnv.DATABASE_CONNECTOR_NAME == "psycopg2":
+            # Stream rows as tab-delimited text through COPY
+            stagingFile = StringIO();
+            for row in rows:
+                stagingFile.write(str.join("\t", [repr(value) if isinstance(value, float) else str(value) for value in row]));
+                stagingFile.write("\n");
+            stagingFile.seek(0);
+            cursor.copy_from(stagingFile, stagingTable, columns=columnNames);
+        else:
+            insertQuery = "INSERT INTO %s (%s) VALUES (%s)" % (stagingTable, str.join(",", columnNames), generatePlaceholders(len(columnNames)) );
+            cursor.executemany(insertQuery, rows);
+
+    def prepareItemAssociations(self, itemIdPairs, linkedItemIdsByBaseId, conn, allCombinations=True):
         """Make sure all pair-wise item association records are ready / initialized
         so that subsequent queries don't have to pause to check for their existence.
         Should help greatly to reduce number of queries and execution time.
-        """
-        clinicalItemIdSet = set();
-        #Do the below to convert the list of strings into a list of pairs, which is needed for the rest of this function
-        for index, pair in enumerate(itemIdPairs):
-            itemIdPairs[index]=eval(pair)
 
-        for (itemId1, itemId2) in itemIdPairs:
-            clinicalItemIdSet.add(itemId1);
-            clinicalItemIdSet.add(itemId2);
-        nItems = len(clinicalItemIdSet);
+        Candidate pairs (all acceptable combinations of the items involved) are loaded into a
+        staging table, and only those missing from clinical_item_association are inserted
+        with a single anti-join INSERT ... SELECT.
+        Pairs that still collide with existing records (e.g., inserted by a parallel process
+        in the meantime) are skipped individually rather than failing the whole insert.
+        If not allCombinations, only prepare records for the given item pairs themselves.
+        """
+        candidateItemIdPairs = list();
+        if allCombinations:
+            clinicalItemIdSet = set();
+            for (itemId1, itemId2) in itemIdPairs:
+                clinicalItemIdSet.add(itemId1);
+                clinicalItemIdSet.add(itemId2);
+            for itemId1 in clinicalItemIdSet:
+                for itemId2 in clinicalItemIdSet:
+                    if self.acceptableClinicalItemIdPair(itemId1, itemId2, linkedItemIdsByBaseId):
+                        candidateItemIdPairs.append( (itemId1, itemId2) );
+        else:
+            candidateItemIdPairs.extend(itemIdPairs);
 
         # Now go through all needed item pairs and create default records as needed
-        log.debug("Ensure %d baseline records ready" % (nItems*nItems) );
-        for itemId1 in clinicalItemIdSet:
-            # Query to see which ones already exist in the database
-            # Do this for each source clinical item instead of all combinations to avoid excessive in memory tracking
-            query = SQLQuery();
-            query.addSelect("clinical_item_id");
-            query.addSelect("subsequent_item_id");
-            query.addFrom("clinical_item_association");
-            query.addWhereEqual("clinical_item_id", itemId1 );
-            query.addWhereIn("subsequent_item_id", clinicalItemIdSet );
-            associationTable = DBUtil.execute( query, conn=conn );
-
-            # Keep track in memory temporarily for rapid lookup
-            existingItemIdPairs = set();
-            for row in associationTable:
-                existingItemIdPairs.add( tuple(row) );
-
-            for itemId2 in clinicalItemIdSet:
-                itemIdPair = (itemId1,itemId2);
-                if itemIdPair not in existingItemIdPairs and self.acceptableClinicalItemIdPair(itemId1, itemId2, linkedItemIdsByBaseId):
-                    defaultAssociation = RowItemModel( itemIdPair, ("clinical_item_id","subsequent_item_id") );
-                    try:    # Optimistic insert of a new item pair, should be safe since just checked above, but parallel processes may collide
-                        DBUtil.insertRow("clinical_item_association", defaultAssociation, conn=conn);
-                    except conn.IntegrityError, err:
-                        log.warning(err);
-                        pass;
+        log.debug("Ensure %d baseline records ready" % len(candidateItemIdPairs) );
+        stagingTable = "clinical_item_association_candidate";
+        cursor = conn.cursor();
+        try:
+            columnNames = ["clinical_item_id","subsequent_item_id"];
+            self.loadStagingTable(stagingTable, ["clinical_item_id BIGINT","subsequent_item_id BIGINT"], columnNames, candidateItemIdPairs, cursor);
+            # Dialect specific clauses to skip conflicting pairs, without aborting the transaction
+            (insertCommand, conflictClause) = ("INSERT OR IGNORE", "");
+            if LocalEnv.DATABASE_CONNECTOR_NAME == "psycopg2":
+                (insertCommand, conflictClause) = ("INSERT", "ON CONFLICT (clinical_item_id, subsequent_item_id) DO NOTHING");
+            elif LocalEnv.DATABASE_CONNECTOR_NAME in ("mysql.connector","MySQLdb"):
+                (insertCommand, conflictClause) = ("INSERT IGNORE", "");
+            query = \
+                """
+                %(insertCommand)s INTO clinical_item_association (clinical_item_id, subsequent_item_id)
+                SELECT s.clinical_item_id, s.subsequent_item_id
+                FROM %(stagingTable)s AS s
+                LEFT JOIN clinical_item_association AS cia
+                    ON cia.clinical_item_id = s.clinical_item_id AND cia.subsequent_item_id = s.subsequent_item_id
+                WHERE cia.clinical_item_id IS NULL
+                %(conflictClause)s
+                """ % {"insertCommand": insertCommand, "stagingTable": stagingTable, "conflictClause": conflictClause};
+            cursor.execute(query);
+            cursor.execute("DELETE FROM %s" % stagingTable);
+        finally:
+            cursor.close();
 
     def acceptableClinicalItemPair(self, patientItem1, patientItem2, linkedItemIdsByBaseId ):
         """Verify is not a previously composite linked item pair, in which case no meaningful asssociation stats to calculate
@@ -592,6 +1953,19 @@ class AssociationAnalysis:
         parser.add_option("-p", "--patientsPerCommit", dest="patientsPerCommit", help="If provided, will commit incremental analysis results to the database after every p patients.  If not set, will just wait until full analysis to commit all (will keep more in memory, and will lose progress if script aborted during mid-execution).  Beware that large values are more efficient, but requires more runtime memory which can exceed memory limits.")
         parser.add_option("-a", "--associationsPerCommit", dest="associationsPerCommit", help="If provided, will commit incremental analysis results to the database when accrue this many association items.  Can help to avoid allowing accrual of too much buffered items whose runtime memory will exceed the 32bit 2GB program limit. 1M seems to just fit within 7.5GB memory (assuming 64-bit Python). Running batches of 3000 patients with ~3000 possible clinical items yields ~5M associations requiring ~25GB memory for learning then ~45GB memory to reload and commit a buffer file.")
         parser.add_option("-u", "--itemsPerUpdate", dest="itemsPerUpdate", help="If provided, when updating patient_item analyze_dates, will only update this many items at a time to avoid overloading MySQL query. (e.g., 10,000)")
+        parser.add_option("-w", "--workers", dest="nWorkers", help="If provided and more than 1, will split the patients into shards to count associations with this many parallel worker processes, merging the partial results before commits.")
+        parser.add_option("-k", "--bulkCommit", dest="bulkCommit", action="store_true", help="If set, commit increments to the database by loading them into a temporary staging table and applying a single set-based update, rather than one update query per item pair.")
+        parser.add_option("-y", "--binaryBufferFile", dest="binaryBufferFile", action="store_true", help="If set, save buffer files in a binary format sorted by item pair (%s extension) rather than JSON. Much faster to save and load, and multiple files can be merged with bounded memory." % BINARY_BUFFER_EXTENSION)
+        parser.add_option("-m", "--maxBufferMemory", dest="maxBufferMemory", help="If provided, when the in-memory association buffer exceeds this many megabytes, spill its contents to a sorted temporary run file on disk. All runs are merged back at commit time, allowing large analyses without needing lower patientsPerCommit.")
+        parser.add_option("-t", "--spillDir", dest="spillDir", help="Directory to write spilled buffer run files to if using maxBufferMemory. Defaults to the system temp directory.")
+        parser.add_option("-c", "--checkpointFile", dest="checkpointFile", help="If provided, record progress to this file after each interval commit (see patientsPerCommit). If the file already exists, resume from the last recorded patient of the prior interrupted run. File is removed once the run completes.")
+        parser.add_option("-f", "--rowsPerFetch", dest="rowsPerFetch", help="Number of patient item rows to fetch from the database at a time (default %d)." % ROWS_PER_FETCH)
+        parser.add_option("-r", "--profileFile", dest="profileFile", help="If provided, write a machine-readable (JSON) summary of the time, row and association counts, and peak memory of each analysis phase to this file when done. A table of the same is logged after every commit interval.")
+        parser.add_option("-x", "--sketchWidth", dest="sketchWidth", help="If provided, approximate association counts with a count-min sketch of this many buckets per hash row (rounded up to a power of 2), so counting memory is fixed regardless of the number of patients. Only item pairs with estimated patient support of at least sketchMinSupport are stored. Approximate counts can only overestimate from hash collisions, so use a width well above the number of expected item pairs for accuracy.")
+        parser.add_option("-n", "--sketchMinSupport", dest="sketchMinSupport", help="If using sketchWidth, minimum estimated number of patients with an item pair for it to be stored (default 1). Applies per commit interval (see patientsPerCommit).")
+        parser.add_option("-g", "--minCount", dest="minCount", help="If provided, drop item pairs counted fewer than this many times (count_any) before committing to the database, then delete stored associations that remain below this count. Counts are per commit interval (see patientsPerCommit) or merged buffer file(s).")
+        parser.add_option("-j", "--minColumnCounts", dest="minColumnCounts", help="Comma-separated list of further minimum counts by count column, pruned the same way as minCount (e.g., count_86400:2,patient_count_any:3)")
+        parser.add_option("-z", "--histogramStorage", dest="histogramStorage", action="store_true", help="If set, count a compact time delta histogram per item pair, stored in clinical_item_association_histogram, instead of the cumulative count_* window columns of clinical_item_association (which then only records the item base counts). Counts within any time window are then a prefix sum over the histogram bins.")
         parser.add_option("-b", "--bufferFile", dest="bufferFile", help="If provided, send buffer to output file rather than commiting to database. If patientIds arguments and idFile parameter are blank, then instead read in bufferFile from this filename (prefix) and commit to database.")
         (options, args) = parser.parse_args(argv[1:])
 
@@ -610,14 +1984,49 @@ class AssociationAnalysis:
 
         if options.bufferFile is not None:
             analysisOptions.bufferFile = options.bufferFile
+        if options.binaryBufferFile:
+            analysisOptions.binaryBufferFile = True;
+        if options.maxBufferMemory is not None:
+            analysisOptions.maxBufferMemory = int(float(options.maxBufferMemory) * 1024 * 1024);
+        analysisOptions.spillDir = options.spillDir;
+        analysisOptions.checkpointFile = options.checkpointFile;
+        if options.sketchWidth is not None:
+            analysisOptions.sketchWidth = int(options.sketchWidth);
+        if options.sketchMinSupport is not None:
+            analysisOptions.sketchMinSupport = float(options.sketchMinSupport);
+        if options.histogramStorage:
+            analysisOptions.histogramStorage = True;
+        if options.minCount is not None:
+            analysisOptions.minCount = float(options.minCount);
+        if options.minColumnCounts is not None:
+            analysisOptions.minCountByColumn = dict();
+            for columnCount in options.minColumnCounts.split(","):
+                (columnName, minCount) = columnCount.split(":");
+                analysisOptions.minCountByColumn[columnName.strip()] = float(minCount);
 
         if options.itemsPerUpdate is not None:
             self.itemsPerUpdate = int(options.itemsPerUpdate);
+        if options.rowsPerFetch is not None:
+            self.rowsPerFetch = int(options.rowsPerFetch);
+        if options.bulkCommit:
+            self.bulkCommit = True;
+        self.profileFile = options.profileFile;
+
+        try:
+            self.runAnalysis(parser, options, analysisOptions);
+        finally:
+            if self.profileFile is not None:
+                self.profiler.writeSummary(self.profileFile);
 
+        timer = time.time() - timer;
+        log.info("%.3f seconds to complete",timer);
+
+    def runAnalysis(self, parser, options, analysisOptions):
+        """Run the analysis (or buffer file commit) as directed by the command line options"""
         if analysisOptions.bufferFile is not None and not analysisOptions.patientIds:
             # Have a previously generated result buffer file and not trying to train on any patientID subset.
             # Just commit buffer file directly to database
-            self.commitUpdateBufferFromFile(analysisOptions.bufferFile);
+            self.commitUpdateBufferFromFile(analysisOptions.bufferFile, analysisOptions);
         else:
             # Usual association analysis from scratch with option to commit direct to database or save to buffer file
             analysisOptions.startDate = None;
@@ -640,12 +2049,11 @@ class AssociationAnalysis:
                 self.patientsPerCommit = int(options.patientsPerCommit);
             if options.associationsPerCommit is not None:
                 self.associationsPerCommit = int(options.associationsPerCommit);
+            if options.nWorkers is not None:
+                self.nWorkers = int(options.nWorkers);
 
             self.analyzePatientItems(analysisOptions);
 
-        timer = time.time() - timer;
-        log.info("%.3f seconds to complete",timer);
-
 if __name__ == "__main__":
     instance = AssociationAnalysis();
     instance.main(sys.argv);
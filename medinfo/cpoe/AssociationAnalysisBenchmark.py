@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+import sys, os
+import re;
+import time;
+import shutil;
+import tempfile;
+from datetime import datetime, timedelta;
+import numpy as np;
+from optparse import OptionParser
+from medinfo.db import DBUtil;
+import LocalEnv;
+
+from AssociationAnalysis import AssociationAnalysis, AnalysisOptions, BINARY_BUFFER_EXTENSION;
+
+from Util import log;
+
+"""Tables needed to run an association analysis end to end, in dependency order"""
+BENCHMARK_TABLES = \
+    [   "clinical_item_category",
+        "clinical_item",
+        "patient_item",
+        "clinical_item_link",
+        "data_cache",
+        "clinical_item_association",
+        "clinical_item_association_histogram",
+    ];
+
+"""Reference date for the start of synthetic patient item histories"""
+BASE_DATE = datetime(2010,1,1);
+
+class SQLiteConnectionFactory(DBUtil.ConnectionFactory):
+    """Connection source to a standalone sqlite3 database file,
+    parsing TIMESTAMP columns back into datetime objects as the analysis expects.
+    """
+    def __init__(self, dbFilename):
+        DBUtil.ConnectionFactory.__init__(self);
+        self.dbFilename = dbFilename;
+
+    def connection(self):
+        import sqlite3;
+        return sqlite3.connect(self.dbFilename, detect_types=sqlite3.PARSE_DECLTYPES);
+
+class AssociationAnalysisBenchmark:
+    """Generate a synthetic population of patients and clinical items in a standalone
+    sqlite3 database, then run AssociationAnalysis end to end on it,
+    reporting the wall time and peak memory (RSS) for each phase of the pipeline:
+    patient item query, in memory association counting, association buffer save (and reload),
+    baseline (zero) record preparation, increments, and patient_item analyze_date marking.
+
+    Item occurrences are drawn from a Zipf-like popularity distribution, so a few common items
+    dominate as in real order data, with each patient's items spread over a time span
+    with an occasional item repeated at a later time.
+    """
+    nPatients = None;   # Number of synthetic patients to generate
+    nItems = None;  # Number of distinct synthetic clinical items
+    itemsPerPatient = None; # Average number of patient items per patient (Poisson distributed)
+    daysPerPatient = None;  # Time span over which each patient's items occur
+    nLinks = None;  # Number of clinical_item_link records to generate, which will be excluded from associations
+    randomSeed = None;  # Seed for reproducible synthetic data
+    sketchAccuracy = None;  # If run with approximate (sketch) counting, statistics on its accuracy against exact counts
+
+    def __init__(self):
+        """Default constructor"""
+        self.nPatients = 100;
+        self.nItems = 200;
+        self.itemsPerPatient = 50;
+        self.daysPerPatient = 30;
+        self.nLinks = 10;
+        self.randomSeed = 0;
+        self.sketchAccuracy = None;
+
+    def buildSchema(self, conn):
+        """Create the clinical item tables (and indices) from the PostgreSQL schema definitions,
+        adapting the auto-increment (SERIAL) primary keys into sqlite3 form.
+        """
+        from stride.clinical_item.ClinicalItemDataLoader import ClinicalItemDataLoader;
+        schemaDir = ClinicalItemDataLoader.fetch_psql_schemata_dir();
+        indexDir = ClinicalItemDataLoader.fetch_psql_indices_dir();
+        for tableName in BENCHMARK_TABLES:
+            schemaFile = open(os.path.join(schemaDir, "%s.schema.sql" % tableName));
+            sql = schemaFile.read();
+            schemaFile.close();
+            sql = re.sub(r"(\w+)\s+SERIAL\s+NOT NULL", r"\1 INTEGER PRIMARY KEY", sql);
+            sql = re.sub(r"CONSTRAINT \w+ PRIMARY KEY \([^)]*\),?", "", sql);
+            sql = re.sub(r",(\s*\))", r"\1", sql);  # Drop any trailing comma left from the removed primary key constraint
+            conn.executescript(sql);
+
+            indexFilename = os.path.join(indexDir, "%s.indices.sql" % tableName);
+            if os.path.exists(indexFilename):
+                indexFile = open(indexFilename);
+                conn.executescript(indexFile.read());
+                indexFile.close();
+        conn.commit();
+
+    def generateData(self, conn):
+        """Populate the clinical item tables with synthetic data.
+        Return the list of generated patient IDs.
+        """
+        randomState = np.random.RandomState(self.randomSeed);
+        cursor = conn.cursor();
+
+        cursor.execute("insert into clinical_item_category (clinical_item_category_id, source_table, description) values (1, 'synthetic', 'Synthetic Items')");
+
+        clinicalItemRows = [(itemId, 1, "ITEM%d" % itemId, "Synthetic Item %d" % itemId) for itemId in xrange(1, self.nItems+1)];
+        cursor.executemany("insert into clinical_item (clinical_item_id, clinical_item_category_id, name, description) values (?,?,?,?)", clinicalItemRows);
+
+        # Zipf-like item popularity
+        itemWeights = 1.0 / np.arange(1, self.nItems+1);
+        itemWeights /= itemWeights.sum();
+
+        linkRows = set();
+        while len(linkRows) < min(self.nLinks, self.nItems*(self.nItems-1)):
+            (itemId, linkedItemId) = randomState.choice(self.nItems, 2, replace=False) + 1;
+            linkRows.add( (int(itemId), int(linkedItemId)) );
+        cursor.executemany("insert into clinical_item_link (clinical_item_id, linked_item_id) values (?,?)", sorted(linkRows));
+
+        patientIds = range(1, self.nPatients+1);
+        patientItemId = 0;
+        for patientId in patientIds:
+            nPatientItems = max(1, randomState.poisson(self.itemsPerPatient));
+            itemIds = randomState.choice(self.nItems, nPatientItems, p=itemWeights) + 1;
+            itemSeconds = randomState.randint(0, self.daysPerPatient*24*60*60, nPatientItems);
+            itemSeconds -= itemSeconds % 60;    # Round to minutes, so some items will be recorded simultaneously
+            patientItemRows = list();
+            for (itemId, itemKey) in sorted(set(zip(itemIds.tolist(), itemSeconds.tolist()))):
+                patientItemId += 1;
+                itemDate = BASE_DATE + timedelta(seconds=itemKey);
+                encounterId = patientId*10 + itemKey/(7*24*60*60);   # One encounter per week
+                patientItemRows.append( (patientItemId, patientId, encounterId, itemId, itemDate) );
+            cursor.executemany("insert into patient_item (patient_item_id, patient_id, encounter_id, clinical_item_id, item_date) values (?,?,?,?,?)", patientItemRows);
+        conn.commit();
+        cursor.close();
+
+        log.info("Generated %d patient items for %d patients across %d clinical items" % (patientItemId, self.nPatients, self.nItems) );
+        return patientIds;
+
+    def run(self, analysis, dbFilename, bufferFile, binaryBufferFile=False, sketchWidth=None, sketchMinSupport=1):
+        """Build and populate the synthetic database, then run the analysis on it through a buffer file.
+        Return the analysis PhaseProfiler with the collected phase statistics.
+
+        If sketchWidth specified, run the analysis with approximate (count-min sketch) counting,
+        first recording the sketchAccuracy against exact counts for the same patients.
+        """
+        connFactory = SQLiteConnectionFactory(dbFilename);
+        conn = connFactory.connection();
+        try:
+            self.buildSchema(conn);
+            patientIds = self.generateData(conn);
+        finally:
+            conn.close();
+
+        analysis.connFactory = connFactory;
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = patientIds;
+        analysisOptions.bufferFile = bufferFile;
+        analysisOptions.binaryBufferFile = binaryBufferFile;
+        if sketchWidth is not None:
+            analysisOptions.sketchWidth = sketchWidth;
+            analysisOptions.sketchMinSupport = sketchMinSupport;
+            self.sketchAccuracy = self.measureSketchAccuracy(analysis, analysisOptions);
+        analysis.analyzePatientItems(analysisOptions);
+        analysis.commitUpdateBufferFromFile(bufferFile);
+        return analysis.profiler;
+
+    def measureSketchAccuracy(self, analysis, analysisOptions):
+        """Count associations in memory both exactly and with the analysisOptions sketch,
+        without committing anything, and return the accuracy statistics of the latter.
+        """
+        accuracyAnalysis = AssociationAnalysis();
+        accuracyAnalysis.connFactory = analysis.connFactory;
+        conn = accuracyAnalysis.connFactory.connection();
+        try:
+            linkedItemIdsByBaseId = accuracyAnalysis.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
+            sketchBuffer = accuracyAnalysis.makeUpdateBuffer(analysisOptions=analysisOptions);
+            accuracyAnalysis.accumulatePatientItems(analysisOptions, sketchBuffer, linkedItemIdsByBaseId, conn=conn);
+            accuracyAnalysis.materializeSketch(sketchBuffer);
+            exactBuffer = accuracyAnalysis.accumulatePatientItems(analysisOptions, accuracyAnalysis.makeUpdateBuffer(), linkedItemIdsByBaseId, conn=conn);
+        finally:
+            conn.close();
+        sketchAccuracy = accuracyAnalysis.bufferAccuracy(exactBuffer, sketchBuffer, analysisOptions.sketchMinSupport);
+        log.info("Sketch accuracy: %s" % sketchAccuracy );
+        return sketchAccuracy;
+
+    def main(self, argv):
+        """Main method, callable from command line"""
+        usageStr =  "usage: %prog [options] [<outputFile>]\n"+\
+                    "   <outputFile>    Tab-delimited file to write phase time and memory statistics to. Leave blank or specify \"-\" to send to stdout.\n"
+        parser = OptionParser(usage=usageStr)
+        parser.add_option("-n", "--patients", dest="nPatients", help="Number of synthetic patients to generate (default %d)." % self.nPatients);
+        parser.add_option("-c", "--items", dest="nItems", help="Number of distinct synthetic clinical items (default %d)." % self.nItems);
+        parser.add_option("-i", "--itemsPerPatient", dest="itemsPerPatient", help="Average number of items per patient (default %d)." % self.itemsPerPatient);
+        parser.add_option("-d", "--days", dest="daysPerPatient", help="Number of days over which each patient's items occur (default %d)." % self.daysPerPatient);
+        parser.add_option("-l", "--links", dest="nLinks", help="Number of clinical item links to exclude from associations (default %d)." % self.nLinks);
+        parser.add_option("-r", "--seed", dest="randomSeed", help="Random seed for reproducible synthetic data (default %d)." % self.randomSeed);
+        parser.add_option("-o", "--dbFile", dest="dbFile", help="sqlite3 database file to build the synthetic data in. Must not already exist. Defaults to a temporary file removed after the run.");
+        parser.add_option("-p", "--patientsPerCommit", dest="patientsPerCommit", help="Passed through to AssociationAnalysis.");
+        parser.add_option("-u", "--itemsPerUpdate", dest="itemsPerUpdate", help="Passed through to AssociationAnalysis.");
+        parser.add_option("-f", "--rowsPerFetch", dest="rowsPerFetch", help="Passed through to AssociationAnalysis.");
+        parser.add_option("-k", "--bulkCommit", dest="bulkCommit", action="store_true", help="Passed through to AssociationAnalysis.");
+        parser.add_option("-x", "--sketchWidth", dest="sketchWidth", help="Passed through to AssociationAnalysis. Also reports the accuracy of the approximate counts against exact counts.");
+        parser.add_option("-s", "--sketchMinSupport", dest="sketchMinSupport", help="Passed through to AssociationAnalysis (default 1).");
+        parser.add_option("-y", "--binaryBufferFile", dest="binaryBufferFile", action="store_true", help="Save the association buffer in the binary (%s) format rather than JSON." % BINARY_BUFFER_EXTENSION);
+        (options, args) = parser.parse_args(argv[1:])
+
+        log.info("Starting: "+str.join(" ", argv))
+        timer = time.time();
+
+        if LocalEnv.DATABASE_CONNECTOR_NAME != "sqlite3":
+            # Analysis query syntax (placeholders, staging tables) follows the configured database connector
+            print >> sys.stderr, "Benchmark requires the sqlite3 database connector to be configured in LocalEnv, found: %s" % LocalEnv.DATABASE_CONNECTOR_NAME;
+            sys.exit(-1);
+
+        for attrName in ("nPatients","nItems","itemsPerPatient","daysPerPatient","nLinks","randomSeed"):
+            if getattr(options, attrName) is not None:
+                setattr(self, attrName, int(getattr(options, attrName)));
+
+        analysis = AssociationAnalysis();
+        if options.patientsPerCommit is not None:
+            analysis.patientsPerCommit = int(options.patientsPerCommit);
+        if options.itemsPerUpdate is not None:
+            analysis.itemsPerUpdate = int(options.itemsPerUpdate);
+        if options.rowsPerFetch is not None:
+            analysis.rowsPerFetch = int(options.rowsPerFetch);
+        if options.bulkCommit:
+            analysis.bulkCommit = True;
+
+        tempDir = tempfile.mkdtemp();
+        try:
+            dbFilename = options.dbFile;
+            if dbFilename is None:
+                dbFilename = os.path.join(tempDir, "benchmark.db");
+            elif os.path.exists(dbFilename):
+                print >> sys.stderr, "Database file already exists: %s" % dbFilename;
+                sys.exit(-1);
+            bufferFile = os.path.join(tempDir, "buffer");
+            sketchWidth = None;
+            if options.sketchWidth is not None:
+                sketchWidth = int(options.sketchWidth);
+            sketchMinSupport = 1;
+            if options.sketchMinSupport is not None:
+                sketchMinSupport = float(options.sketchMinSupport);
+            profiler = self.run(analysis, dbFilename, bufferFile, bool(options.binaryBufferFile), sketchWidth, sketchMinSupport);
+        finally:
+            shutil.rmtree(tempDir);
+
+        outFile = "-";
+        if len(args) > 0:
+            outFile = args[0];
+        ofs = sys.stdout;
+        if outFile != "-":
+            ofs = open(outFile, "w");
+        print >> ofs, profiler.formatReport();
+        if self.sketchAccuracy is not None:
+            print >> ofs;
+            print >> ofs, "sketchAccuracy\tvalue";
+            for key in sorted(self.sketchAccuracy.keys()):
+                print >> ofs, "%s\t%s" % (key, self.sketchAccuracy[key]);
+        if ofs is not sys.stdout:
+            ofs.close();
+
+        timer = time.time() - timer;
+        log.info("%.3f seconds to complete",timer);
+
+if __name__ == "__main__":
+    instance = AssociationAnalysisBenchmark();
+    instance.main(sys.argv);
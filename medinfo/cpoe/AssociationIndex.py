@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+"""
+Export the clinical_item_association counts (and clinical_item base counts)
+into a single compressed sparse row (CSR) binary file that can be memory-mapped,
+so recommender processes can answer association queries from the file
+without (re)loading the association table from the database.
+"""
+import sys, os
+import time;
+import json;
+from optparse import OptionParser;
+import numpy as np;
+from medinfo.db import DBUtil;
+from medinfo.db.Model import SQLQuery;
+
+from AssociationAnalysis import INCREMENT_COLUMN_NAMES;
+from DataManager import DataManager;
+
+from Util import log;
+
+"""Association count columns to export, one count array per time window (the time_diff summary columns are not needed for recommendations)"""
+INDEX_COUNT_COLUMN_NAMES = [columnName for columnName in INCREMENT_COLUMN_NAMES if "time_diff" not in columnName];
+
+"""Base (summary) count columns to export from clinical_item"""
+INDEX_BASE_COUNT_COLUMN_NAMES = ["item_count","patient_count","encounter_count"];
+
+"""Order of the numpy arrays stored in an index file.
+Forward rows (by clinical_item_id) list the entry positions of the subsequent items in order.
+Transpose rows (by subsequent_item_id) list positions into the same entries, to serve inverted queries without a second copy of the counts.
+Metadata (JSON) goes last, so all of the fixed-width arrays before it stay 8 byte aligned for memory-mapping.
+"""
+INDEX_ARRAY_NAMES = \
+    [   "itemIds",              # Sorted clinical_item_id of each (forward) row
+        "rowOffsets",           # Entries for itemIds[i] are in positions rowOffsets[i]:rowOffsets[i+1]
+        "columnItemIds",        # subsequent_item_id of each entry
+        "countData",            # Count array per time window column (INDEX_COUNT_COLUMN_NAMES), shape (nColumns, nEntries)
+        "transposeItemIds",     # Sorted subsequent_item_id of each transpose row
+        "transposeOffsets",     # Transpose entries for transposeItemIds[i] are in transposeEntries[transposeOffsets[i]:transposeOffsets[i+1]]
+        "transposeEntries",     # Forward entry positions grouped by subsequent_item_id
+        "baseCounts",           # clinical_item base count records, sorted by clinical_item_id
+        "metadata",
+    ];
+
+"""Number of association rows to fetch from the database at a time when exporting"""
+EXPORT_ROWS_PER_FETCH = 100000;
+
+def saveArrays(filename, arraysByName, arrayNames):
+    """Write the named numpy arrays to a file as a sequence of numpy (.npy) arrays in the order of arrayNames"""
+    ofs = open(filename, "wb");
+    try:
+        for arrayName in arrayNames:
+            np.save(ofs, arraysByName[arrayName]);
+    finally:
+        ofs.close();
+
+def loadArrays(filename, arrayNames):
+    """Memory-map the sequence of numpy arrays in a file written by saveArrays, returning them keyed by arrayNames.
+    Pages are only read in as entries are accessed, and are shared by any processes mapping the same file.
+    """
+    arraysByName = dict();
+    ifs = open(filename, "rb");
+    try:
+        for arrayName in arrayNames:
+            version = np.lib.format.read_magic(ifs);
+            if version == (1,0):
+                (shape, fortranOrder, dtype) = np.lib.format.read_array_header_1_0(ifs);
+            else:
+                (shape, fortranOrder, dtype) = np.lib.format.read_array_header_2_0(ifs);
+            offset = ifs.tell();
+            size = int(np.prod(shape));
+            if size > 0 and len(shape) > 0:
+                arraysByName[arrayName] = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape, order=("F" if fortranOrder else "C"));
+            else:
+                arraysByName[arrayName] = np.fromfile(ifs, dtype=dtype, count=size).reshape(shape, order=("F" if fortranOrder else "C"));
+            ifs.seek(offset + size*dtype.itemsize);
+    finally:
+        ifs.close();
+    return arraysByName;
+
+class AssociationIndex:
+    """Memory-mapped CSR copy of the clinical_item_association counts.
+    Export with exportIndex, then open with loadIndex (or the filename constructor argument)
+    and look up item association results with loadResultModels.
+
+    The index is a snapshot, so should be re-exported after association analysis updates.
+    Counts are stored as in the database (before the countScale factor, which is recorded in the metadata).
+    """
+    connFactory = None; # Allow specification of alternative DB connection source
+    filename = None;
+    countScale = None;  # DataManager.getAssociationCountScale at the time of export
+    totalPatients = None;   # Number of analyzed patients at the time of export
+
+    def __init__(self, filename=None):
+        """Default constructor"""
+        self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
+        self.dataManager = DataManager();
+        self.filename = None;
+        self.countScale = 1.0;
+        self.totalPatients = None;
+        self.arraysByName = dict();
+        self.columnIndexByName = dict();
+        if filename is not None:
+            self.loadIndex(filename);
+
+    def exportIndex(self, filename, conn=None):
+        """Write the current clinical_item_association (count_any > 0) and clinical_item base counts to an index file.
+        File is a sequence of numpy (.npy) arrays in the order of INDEX_ARRAY_NAMES.
+        """
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+        try:
+            # Base counts derive from the association counts, so make sure they are current first
+            self.dataManager.updateClinicalItemCounts(conn=conn);
+            countScale = self.dataManager.getAssociationCountScale(conn=conn);
+
+            (itemIdPairs, countData) = self.queryAssociationCounts(conn);
+            baseCounts = self.queryBaseCounts(conn);
+            totalPatients = self.queryTotalPatients(conn);
+        finally:
+            if not extConn:
+                conn.close();
+
+        # Sort entries by (clinical_item_id, subsequent_item_id) for the forward rows
+        sortIndexes = np.lexsort( (itemIdPairs[:,1], itemIdPairs[:,0]) );
+        itemIdPairs = itemIdPairs[sortIndexes];
+        countData = np.ascontiguousarray(countData[:,sortIndexes]);   # Keep each column's counts contiguous
+        (itemIds, rowOffsets) = self.rowOffsets(itemIdPairs[:,0]);
+        columnItemIds = itemIdPairs[:,1].copy();
+
+        # Transpose rows only need the entry positions, ordered by subsequent_item_id (stable to keep clinical_item_id order within each)
+        transposeEntries = np.argsort(columnItemIds, kind="mergesort").astype(np.int64);
+        (transposeItemIds, transposeOffsets) = self.rowOffsets(columnItemIds[transposeEntries]);
+
+        metadata = \
+            {   "countScale": countScale,
+                "totalPatients": totalPatients,
+                "countColumnNames": INDEX_COUNT_COLUMN_NAMES,
+                "baseCountColumnNames": INDEX_BASE_COUNT_COLUMN_NAMES,
+                "nEntries": len(columnItemIds),
+            };
+
+        arraysByName = \
+            {   "itemIds": itemIds,
+                "rowOffsets": rowOffsets,
+                "columnItemIds": columnItemIds,
+                "countData": countData,
+                "transposeItemIds": transposeItemIds,
+                "transposeOffsets": transposeOffsets,
+                "transposeEntries": transposeEntries,
+                "baseCounts": baseCounts,
+                "metadata": np.array(json.dumps(metadata)),
+            };
+        saveArrays(filename, arraysByName, INDEX_ARRAY_NAMES);
+        log.info("Exported %d item associations for %d items to %s" % (len(columnItemIds), len(itemIds), filename) );
+
+    def queryAssociationCounts(self, conn):
+        """Fetch all of the non-zero association records in blocks.
+        Returns (itemIdPairs, countData) with countData shaped (nColumns, nEntries) as stored in the index.
+        """
+        query = SQLQuery();
+        query.addSelect("clinical_item_id");
+        query.addSelect("subsequent_item_id");
+        for columnName in INDEX_COUNT_COLUMN_NAMES:
+            query.addSelect(columnName);
+        query.addFrom("clinical_item_association");
+        query.addWhere("count_any > 0");    # Same records the recommender would consider
+
+        itemIdPairsList = list();
+        countDataList = list();
+        cursor = conn.cursor();
+        try:
+            cursor.execute( str(query), tuple(query.params) );
+            rows = cursor.fetchmany(EXPORT_ROWS_PER_FETCH);
+            while rows:
+                blockData = np.array(rows, dtype=np.float64);
+                itemIdPairsList.append( blockData[:,:2].astype(np.int64) );
+                countDataList.append( blockData[:,2:].T );
+                rows = cursor.fetchmany(EXPORT_ROWS_PER_FETCH);
+        finally:
+            cursor.close();
+
+        if not itemIdPairsList:
+            return (np.zeros((0,2), dtype=np.int64), np.zeros((len(INDEX_COUNT_COLUMN_NAMES),0)));
+        return (np.concatenate(itemIdPairsList), np.concatenate(countDataList, axis=1));
+
+    def queryBaseCounts(self, conn):
+        """Base count records of the clinical items fit for analysis (as ItemAssociationRecommender.populateResultCounts would use).
+        Missing (null) counts are stored as NaN.
+        """
+        query = SQLQuery();
+        query.addSelect("clinical_item_id");
+        query.addSelect("clinical_item_category_id");
+        for columnName in INDEX_BASE_COUNT_COLUMN_NAMES:
+            query.addSelect(columnName);
+        query.addFrom("clinical_item");
+        query.addWhere("analysis_status <> 0");
+        query.addOrderBy("clinical_item_id");
+        resultTable = DBUtil.execute(query, conn=conn);
+
+        baseCounts = np.zeros(len(resultTable), dtype=self.baseCountDtype());
+        for iRow, row in enumerate(resultTable):
+            baseCounts[iRow] = tuple([value if value is not None else np.nan for value in row]);
+        return baseCounts;
+
+    def queryTotalPatients(self, conn):
+        """Number of patients that association analysis has been done for (as ItemAssociationRecommender.totalPatientCount would use)"""
+        query = SQLQuery();
+        query.addSelect("count(distinct patient_id)");
+        query.addFrom("patient_item");
+        query.addWhere("analyze_date is not null");
+        return float(DBUtil.execute(query, conn=conn)[0][0]);
+
+    def baseCountDtype(self):
+        """Numpy record type for the clinical_item base counts"""
+        fields = [("clinical_item_id", np.int64), ("clinical_item_category_id", np.int64)];
+        fields.extend([(columnName, np.float64) for columnName in INDEX_BASE_COUNT_COLUMN_NAMES]);
+        return np.dtype(fields);
+
+    def rowOffsets(self, sortedItemIds):
+        """Given the (sorted) row item ID of every entry, return (itemIds, rowOffsets)
+        for the distinct row items and the start of each one's entries (plus a final end offset).
+        """
+        (itemIds, rowStarts) = np.unique(sortedItemIds, return_index=True);
+        rowOffsets = np.append(rowStarts, len(sortedItemIds)).astype(np.int64);
+        return (itemIds.astype(np.int64), rowOffsets);
+
+    def loadIndex(self, filename):
+        """Memory-map the arrays of an index file written by exportIndex (see loadArrays)"""
+        arraysByName = loadArrays(filename, INDEX_ARRAY_NAMES);
+        metadata = json.loads(str(arraysByName["metadata"]));
+        self.filename = filename;
+        self.countScale = metadata["countScale"];
+        self.totalPatients = metadata.get("totalPatients");
+        self.arraysByName = arraysByName;
+        self.columnIndexByName = dict([(columnName, iColumn) for iColumn, columnName in enumerate(metadata["countColumnNames"])]);
+
+    def itemEntries(self, itemId, inverted=False):
+        """Entry positions (into columnItemIds and countData) of the associations for the item,
+        as the preceding item, or as the subsequent item if inverted.
+        Returns (entryPositions, otherItemIds) where otherItemIds are the associated items in the other role.
+        """
+        if inverted:
+            rowItemIds = self.arraysByName["transposeItemIds"];
+            rowOffsets = self.arraysByName["transposeOffsets"];
+        else:
+            rowItemIds = self.arraysByName["itemIds"];
+            rowOffsets = self.arraysByName["rowOffsets"];
+
+        iRow = np.searchsorted(rowItemIds, itemId);
+        if iRow >= len(rowItemIds) or rowItemIds[iRow] != itemId:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64));
+
+        if inverted:
+            entryPositions = np.asarray(self.arraysByName["transposeEntries"][rowOffsets[iRow]:rowOffsets[iRow+1]]);
+            # Recover the preceding item of each entry from the forward row it falls in
+            iForwardRows = np.searchsorted(self.arraysByName["rowOffsets"], entryPositions, side="right") - 1;
+            otherItemIds = np.asarray(self.arraysByName["itemIds"][iForwardRows]);
+        else:
+            entryPositions = np.arange(rowOffsets[iRow], rowOffsets[iRow+1]);
+            otherItemIds = np.asarray(self.arraysByName["columnItemIds"][rowOffsets[iRow]:rowOffsets[iRow+1]]);
+        return (entryPositions, otherItemIds);
+
+    def columnCounts(self, columnName, entryPositions):
+        """Count values of the time window column for the given entry positions"""
+        if columnName not in self.columnIndexByName:
+            raise ValueError("Association index has no count column: %s" % columnName);
+        return np.asarray(self.arraysByName["countData"][self.columnIndexByName[columnName]][entryPositions]);
+
+    def categoryIds(self, itemIds):
+        """clinical_item_category_id for each of the item IDs, with None for items not in the base counts"""
+        baseCounts = self.arraysByName["baseCounts"];
+        baseItemIds = baseCounts["clinical_item_id"];
+        iBases = np.searchsorted(baseItemIds, itemIds);
+        categoryIds = list();
+        for itemId, iBase in zip(itemIds, iBases):
+            categoryId = None;
+            if iBase < len(baseItemIds) and baseItemIds[iBase] == itemId:
+                categoryId = int(baseCounts["clinical_item_category_id"][iBase]);
+            categoryIds.append(categoryId);
+        return categoryIds;
+
+    def loadResultModels(self, query, countField):
+        """Equivalent result models to ItemAssociationRecommender querying clinical_item_association
+        for the query items, with the source and target item columns, countPrefix count_0 and the countField.
+        Applies the maxRecommendedId and excludeCategoryIds filters like the SQL query would.
+        """
+        count0Field = query.countPrefix+"count_0";
+        resultModels = list();
+        for queryItemId in query.queryItemIds:
+            (entryPositions, targetItemIds) = self.itemEntries(queryItemId, query.invertQuery);
+            if len(entryPositions) < 1:
+                continue;
+
+            includeMask = np.ones(len(entryPositions), dtype=bool);
+            if query.maxRecommendedId is not None:
+                includeMask &= (targetItemIds <= query.maxRecommendedId);
+            if query.excludeCategoryIds:
+                # Items not in clinical_item would drop out of the SQL join as well
+                categoryIds = self.categoryIds(targetItemIds);
+                includeMask &= np.array([categoryId is not None and categoryId not in query.excludeCategoryIds for categoryId in categoryIds], dtype=bool);
+            entryPositions = entryPositions[includeMask];
+            targetItemIds = targetItemIds[includeMask];
+
+            count0Values = self.columnCounts(count0Field, entryPositions);
+            countValues = self.columnCounts(countField, entryPositions);
+            for targetItemId, count0, count in zip(targetItemIds.tolist(), count0Values.tolist(), countValues.tolist()):
+                result = dict();
+                result[query.sourceCol()] = queryItemId;
+                result[query.targetCol()] = targetItemId;
+                result[count0Field] = count0;
+                result[countField] = count;
+                resultModels.append(result);
+        return resultModels;
+
+    def loadBaseCountModelsByItemId(self, countPrefix):
+        """Base count models by clinical_item_id, with the countPrefix count, as the clinical_item query
+        in ItemAssociationRecommender.populateResultCounts would return.
+        Returns a read-only view (see BaseCountModels) that looks up models from the memory-mapped records as needed.
+        """
+        if countPrefix == "":
+            countPrefix = "item_";
+        return BaseCountModels(self.arraysByName["baseCounts"], countPrefix+"count");
+
+    def main(self, argv):
+        """Main method, callable from command line"""
+        usageStr =  "usage: %prog [options] <outputFile>\n"+\
+                    "   <outputFile>    Index file to write the current item association counts to.\n"+\
+                    "                   Use with the ItemRecommender associationIndex option to serve recommendations from it.\n"
+        parser = OptionParser(usage=usageStr)
+        (options, args) = parser.parse_args(argv[1:])
+
+        log.info("Starting: "+str.join(" ", argv))
+        timer = time.time();
+        if len(args) > 0:
+            self.exportIndex(args[0]);
+        else:
+            parser.print_help()
+            sys.exit(-1)
+
+        timer = time.time() - timer;
+        log.info("%.3f seconds to complete",timer);
+
+class BaseCountModels:
+    """Read-only, dictionary-like view of base count models by clinical_item_id (see AssociationIndex.loadBaseCountModelsByItemId).
+    Rather than copying every item's counts into a dictionary (for every process and query),
+    each model is looked up from the sorted (memory-mapped) base count records when requested.
+    """
+    def __init__(self, baseCounts, countField):
+        self.baseCounts = baseCounts;
+        self.countField = countField;
+
+    def findIndex(self, itemId):
+        """Position of the item's base count record, or None if it has none"""
+        baseItemIds = self.baseCounts["clinical_item_id"];
+        iBase = np.searchsorted(baseItemIds, itemId);
+        if iBase < len(baseItemIds) and baseItemIds[iBase] == itemId:
+            return iBase;
+        return None;
+
+    def __getitem__(self, itemId):
+        iBase = self.findIndex(itemId);
+        if iBase is None:
+            raise KeyError(itemId);
+        baseCount = float(self.baseCounts[self.countField][iBase]);
+        if np.isnan(baseCount):
+            baseCount = None;
+        return {"clinical_item_id": itemId, self.countField: baseCount};
+
+    def get(self, itemId, default=None):
+        if itemId in self:
+            return self[itemId];
+        return default;
+
+    def __contains__(self, itemId):
+        return self.findIndex(itemId) is not None;
+
+    def __len__(self):
+        return len(self.baseCounts);
+
+    def keys(self):
+        return self.baseCounts["clinical_item_id"].tolist();
+
+if __name__ == "__main__":
+    instance = AssociationIndex();
+    instance.main(sys.argv);
@@ -35,6 +35,14 @@ DELTA_NAME_BY_SECONDS = \
         63072000: "2 years",
         126144000: "4 years",
     }
+"""Time delta bin edges (seconds) for association histograms (see AssociationAnalysis histogramStorage).
+Each bin counts time deltas greater than the prior edge, up to and including its own edge, with a final bin for any longer deltas,
+so the count within any window at a bin edge is a prefix sum of the bins.
+Includes every DELTA_NAME_BY_SECONDS window, plus intermediate edges, so further windows can be queried without schema changes.
+Stored histograms are keyed by bin edge, so edges may be added later, but only take effect for newly counted data.
+"""
+HISTOGRAM_BIN_SECONDS = sorted( set(DELTA_NAME_BY_SECONDS.keys()) | set([1800, 10800, 259200, 864000, 5184000, 23328000, 94608000]) );
+
 """Similar list but starting in units of 1 day"""
 DELTA_NAME_BY_DAYS = dict();
 for seconds, label in DELTA_NAME_BY_SECONDS.iteritems():
@@ -8,7 +8,8 @@ import time;
 from optparse import OptionParser
 import math;
 from datetime import datetime;
-from medinfo.common.Util import stdOpen, ProgressDots;
+from medinfo.common.Const import DATA_CACHE_MAX_ENTRIES, DATA_CACHE_MAX_BYTES;
+from medinfo.common.Util import stdOpen, ProgressDots, LRUCache;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, RowItemModel, generatePlaceholders;
 from medinfo.db.Model import modelListFromTable, modelDictFromList;
@@ -21,7 +22,7 @@ class DataManager:
     def __init__(self):
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
         self.maxClinicalItemId = None;  # Can set to a value to limit what items will be processed.  Particularly for setting to 0, so will only work on negative values, generally only test cases, while leaving "real" data alone
-        self.dataCache = dict();  # If set, use as in memory data cache.  Set to None to avoid usage if having memory leak problems with persistent processes
+        self.dataCache = LRUCache(DATA_CACHE_MAX_ENTRIES, DATA_CACHE_MAX_BYTES);  # If set, use as in memory data cache (bounded, least recently used entries evicted).  Set to None to avoid usage if having memory problems with persistent processes
         self.queryCount = 0;
 
     def resetAssociationModel(self, conn=None):
@@ -33,6 +34,8 @@ class DataManager:
             log.debug("Connected to database for reseting purposes");
             result = DBUtil.execute("DELETE FROM clinical_item_association;", conn=conn);
             log.debug("Training table cleared items: %s" % result);
+            result = DBUtil.execute("DELETE FROM clinical_item_association_histogram;", conn=conn);
+            log.debug("Histogram table cleared items: %s" % result);
 
             # Droppings constraints can greatly speed up the next step of updating analyze dates
             #curs.execute("ALTER TABLE backup_link_patient_item drop constraint backup_link_patient_item_patient_item_fkey;")
@@ -61,6 +64,7 @@ class DataManager:
 
             # Flag that any cached association metrics will be out of date
             self.clearCacheData("analyzedPatientCount",conn=conn);
+            self.clearCacheData("associationCountScale",conn=conn);
 
             # Reset clinical_item denormalized counts
             self.updateClinicalItemCounts(conn=conn);
@@ -112,7 +116,14 @@ class DataManager:
             resultTable = DBUtil.execute( sqlQuery, includeColumnNames=True, conn=conn );
             resultModels = modelListFromTable( resultTable );
 
+            # Association counts may be stored lazily scaled (e.g., decayed)
+            countScale = self.getAssociationCountScale(conn=conn);
+
             for result in resultModels:
+                if countScale != 1.0:
+                    for countCol in ("item_count","patient_count","encounter_count"):
+                        if result[countCol] is not None:
+                            result[countCol] *= countScale;
                 DBUtil.updateRow("clinical_item", result, result["clinical_item_id"], conn=conn);
 
             # Make a note that this cache data has been updated
@@ -516,6 +527,26 @@ class DataManager:
                 conn.close();
         return linkedItemIdsByBaseId;
 
+    def getAssociationCountScale(self, conn=None):
+        """Global scale factor that all clinical_item_association count values should be read through (multiplied by).
+        Allows for lazy decay of the counts (see DecayingWindows) by just updating this one factor,
+        rather than rewriting every association record. Defaults to 1.0 if not set.
+        """
+        dataStr = self.getCacheData("associationCountScale", conn=conn);
+        if dataStr is None:
+            return 1.0;
+        return float(dataStr);
+
+    def setAssociationCountScale(self, countScale, conn=None):
+        """Record the global association count scale factor (see getAssociationCountScale).
+        Also flags the clinical_item summary counts derived from the association counts as out of date.
+        """
+        if countScale == 1.0:
+            self.clearCacheData("associationCountScale", conn=conn);
+        else:
+            self.setCacheData("associationCountScale", repr(countScale), conn=conn);
+        self.clearCacheData("clinicalItemCountsUpdated", conn=conn);
+
     def getCacheData(self,key,conn=None):
         """Utility function to retrieve cached data item from data_cache table.  Returns None if not found"""
         extConn = conn is not None;
@@ -563,22 +594,25 @@ class DataManager:
     def executeCacheOption(self, query, parameters=None, includeColumnNames=False, incTypeCodes=False, formatter=None, conn=None, connFactory=None, autoCommit=True):
         """Wrap DBUtil.execute.  If instance's dataCache is present, will check and store any results in there
         to help reduce time for repeat queries.
+        Results are cached by the query text with its parameters filled in (and the column name / type code options).
 
-        Beware, bad idea to store lots of varied, huge results in this cache, otherwise memory leak explosion.
+        Beware, bad idea to store lots of varied, huge results in an unbounded (dict) cache, otherwise memory leak explosion.
+        The default LRUCache evicts the least recently used results beyond its bounds.
         """
         if connFactory is None:
             connFactory = self.connFactory;
 
-        dataCache = self.dataCache;
-        if dataCache is None:
-            dataCache = dict(); # Create a temporary holder
-
-        queryStr = DBUtil.parameterizeQueryString(query);
-        if queryStr not in dataCache:
-            dataCache[queryStr] = DBUtil.execute( query, parameters, includeColumnNames, incTypeCodes, formatter, conn, connFactory, autoCommit );
+        cacheKey = (DBUtil.parameterizeQueryString(query, parameters), includeColumnNames, incTypeCodes);
+        resultTable = None;
+        if self.dataCache is not None:
+            resultTable = self.dataCache.get(cacheKey);
+        if resultTable is None:
+            resultTable = DBUtil.execute( query, parameters, includeColumnNames, incTypeCodes, formatter, conn, connFactory, autoCommit );
             self.queryCount += 1;
+            if self.dataCache is not None:
+                self.dataCache[cacheKey] = resultTable;
 
-        dataCopy = list(dataCache[queryStr]);
+        dataCopy = list(resultTable);
 
         return dataCopy;
 
@@ -41,8 +41,10 @@ from medinfo.cpoe.Env import DATE_FORMAT
 from medinfo.db import DBUtil
 from medinfo.cpoe.test import TestAssociationAnalysis
 from medinfo.cpoe import AssociationAnalysis
+from medinfo.cpoe.DataManager import DataManager
 from medinfo.cpoe.test.Const import RUNNER_VERBOSITY
-from medinfo.cpoe.Const import DELTA_NAME_BY_SECONDS, SECONDS_PER_DAY;
+from medinfo.cpoe.Const import DELTA_NAME_BY_SECONDS, SECONDS_PER_DAY, COUNT_PREFIX_OPTIONS;
+from medinfo.cpoe.AssociationAnalysis import parseHistogram, formatHistogram;
 from Util import log;
 
 class DecayAnalysisOptions:
@@ -56,8 +58,10 @@ class DecayAnalysisOptions:
 		self.delta = timedelta(weeks=4)
 		self.associationsPerCommit = None
 		self.itemsPerUpdate = None
-		self.outputFile = None
+		self.inMemory = False;	# If set, accumulate all deltas in a single in memory buffer, decayed between deltas, and only commit to the database once at the end
 		self.skipLargerCountWindows = True;	# If set, then won't try to update association count fields longer than the given delta time, since will never be a different number than the next largest interval count and just consumes extra memory
+		self.lazyDecay = False;	# If set, decay by updating a global scale factor that the stored counts are read through, rather than rewriting every count in the database
+		self.minCountScale = 1e-6;	# With lazyDecay, once the scale factor drops below this, renormalize by rewriting the stored counts, to avoid losing precision as they grow
 
 
 class DecayingWindows:
@@ -66,21 +70,52 @@ class DecayingWindows:
 	def __init__(self):
 		"Default constructor"
 		self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
+		self.dataManager = DataManager();
 		self.decayCount = 0
 
-	def standardDecay (self, decayAnalysisOptions):
-		conn = self.connFactory.connection()
+	def countFieldUpdates(self, factor):
+		"Assignment expressions to multiply every clinical_item_association count field by the given factor"
 		prefixes = ['', 'patient_', 'encounter_']
 		times = ['0', '3600', '7200', '21600', '43200', '86400', '172800', '345600', '604800', '1209600', '2592000', '7776000', '15552000', '31536000', '63072000', '126144000', 'any']
+		fields = list()
+		for prefix in prefixes:
+			for time in times:
+				fieldName = prefix + "count_" + str(time)
+				fields.append(fieldName + '=' + fieldName + "*" + repr(factor))
+		return fields
+
+	def rescaleHistograms(self, factor, conn):
+		"""Multiply every clinical_item_association_histogram bin count and time_diff sum by the given factor,
+		so item pair histograms decay along with the clinical_item_association counts.
+		Histogram bins are stored as text, so they are read, rescaled and written back here, rather than in a single UPDATE statement.
+		"""
+		histogramColumns = [countPrefix+"histogram" for countPrefix in COUNT_PREFIX_OPTIONS]
+		sumColumns = list()
+		for countPrefix in COUNT_PREFIX_OPTIONS:
+			sumColumns.extend([countPrefix+"time_diff_sum", countPrefix+"time_diff_sum_squares"])
+		curs = conn.cursor()
+		try:
+			curs.execute("SELECT clinical_item_id, subsequent_item_id, %s FROM clinical_item_association_histogram" % str.join(", ", histogramColumns+sumColumns))
+			updateRows = list()
+			for row in curs.fetchall():
+				histogramValues = [formatHistogram(parseHistogram(histogramStr) * factor) for histogramStr in row[2:2+len(histogramColumns)]]
+				sumValues = [(timeDiffSum or 0.0) * factor for timeDiffSum in row[2+len(histogramColumns):]]
+				updateRows.append(histogramValues + sumValues + list(row[:2]))
+			log.debug("rescale %d item pair histograms by %s" % (len(updateRows), factor));
+			if updateRows:
+				query = "UPDATE clinical_item_association_histogram SET %s WHERE clinical_item_id = %s AND subsequent_item_id = %s" % \
+					(str.join(", ", ["%s = %s" % (col, DBUtil.SQL_PLACEHOLDER) for col in histogramColumns+sumColumns]), DBUtil.SQL_PLACEHOLDER, DBUtil.SQL_PLACEHOLDER)
+				curs.executemany(query, updateRows)
+		finally:
+			curs.close()
+
+	def standardDecay (self, decayAnalysisOptions):
+		conn = self.connFactory.connection()
 		try:
 			log.debug("Connected to datbase");
 			curs = conn.cursor()
 
-			fields = list()
-			for prefix in prefixes:
-				for time in times:
-					fieldName = prefix + "count_" + str(time)
-					fields.append(fieldName + '=' + fieldName + "*" + str(decayAnalysisOptions.decay))
+			fields = self.countFieldUpdates(decayAnalysisOptions.decay)
 
 			"""log.debug("starting to drop indices");
 			sqlQuery = "ALTER TABLE clinical_item_association drop CONSTRAINT clinical_item_association_pkey;"
@@ -101,6 +136,7 @@ class DecayingWindows:
 			log.debug("starting decay");
 			sqlQuery = "UPDATE clinical_item_association SET " + str.join(',', fields) + ";"
 			curs.execute(sqlQuery)
+			self.rescaleHistograms(decayAnalysisOptions.decay, conn)
 			log.debug("finished decay");
 
 			"""log.debug("starting to add indices");
@@ -125,6 +161,30 @@ class DecayingWindows:
 			curs.close()
 			conn.close()
 
+	def lazyDecay (self, decayAnalysisOptions):
+		"""Alternative to standardDecay that does not rewrite every clinical_item_association record.
+		Just multiply the global scale factor that all stored counts are read through (DataManager.getAssociationCountScale)
+		by the decay, with subsequent count increments inversely scaled when committed (AssociationAnalysis.commitUpdateBuffer).
+		Stored counts (including any item pair histograms) are only physically rewritten (renormalized back to a scale of 1)
+		once the scale factor drops below decayAnalysisOptions.minCountScale.
+		"""
+		conn = self.connFactory.connection()
+		try:
+			countScale = self.dataManager.getAssociationCountScale(conn=conn) * decayAnalysisOptions.decay
+			if countScale < decayAnalysisOptions.minCountScale:
+				log.debug("renormalize counts by %s" % countScale);
+				curs = conn.cursor()
+				try:
+					curs.execute("UPDATE clinical_item_association SET " + str.join(',', self.countFieldUpdates(countScale)) + ";")
+				finally:
+					curs.close()
+				self.rescaleHistograms(countScale, conn)
+				countScale = 1.0
+			self.dataManager.setAssociationCountScale(countScale, conn=conn)
+			conn.commit()
+		finally:
+			conn.close()
+
 	def decayAnalyzePatientItems(self, decayAnalysisOptions):
 		log.debug("delta = %s" % decayAnalysisOptions.delta);
 
@@ -132,9 +192,18 @@ class DecayingWindows:
 		if decayAnalysisOptions.decay is None:
 			decayAnalysisOptions.decay = 1-(1.0/decayAnalysisOptions.windowLength) #decay rate = (1 - (1/c)), where c = window length
 
-		currentBuffer = None;	# In memory buffer if using temp files. Otherwise, use the database as the data cache
-		if decayAnalysisOptions.outputFile is not None:
-			currentBuffer = dict();
+		# Single analysis instance to accumulate all deltas with
+		instance = AssociationAnalysis.AssociationAnalysis()
+		instance.connFactory = self.connFactory
+		instance.associationsPerCommit = decayAnalysisOptions.associationsPerCommit
+		instance.itemsPerUpdate = decayAnalysisOptions.itemsPerUpdate
+
+		currentBuffer = None;	# In memory buffer if requested (inMemory option). Otherwise, use the database as the data cache
+		linkedItemIdsByBaseId = None;
+		if decayAnalysisOptions.inMemory:
+			# Keep one long-lived buffer across all deltas, decayed in memory between them, rather than round trips through buffer files
+			currentBuffer = instance.makeUpdateBuffer();
+			linkedItemIdsByBaseId = instance.dataManager.loadLinkedItemIdsByBaseId();
 
 		#####
 		# Step one delta (e.g., month) at a time until end date
@@ -148,14 +217,12 @@ class DecayingWindows:
 			log.debug(currentItemStart);
 			log.debug(currentItemEnd);
 
-			instance = AssociationAnalysis.AssociationAnalysis()
 			analysisOptions = AssociationAnalysis.AnalysisOptions()
 
-			if decayAnalysisOptions.outputFile is not None:
-				analysisOptions.bufferFile = decayAnalysisOptions.outputFile
-
 			# Decay any existing stats before learn new ones to increment
-			if currentBuffer is None:
+			if currentBuffer is None and decayAnalysisOptions.lazyDecay:
+				self.lazyDecay(decayAnalysisOptions)
+			elif currentBuffer is None:
 				self.standardDecay(decayAnalysisOptions)
 			else:
 				log.debug("buffer decay");
@@ -163,11 +230,6 @@ class DecayingWindows:
 			self.decayCount +=1
 
 			#Add in a new delta worth of training
-			instance.associationsPerCommit = decayAnalysisOptions.associationsPerCommit
-			instance.itemsPerUpdate = decayAnalysisOptions.itemsPerUpdate
-			log.debug(instance.associationsPerCommit);
-			log.debug(instance.itemsPerUpdate);
-
 			analysisOptions.patientIds = decayAnalysisOptions.patientIds
 			analysisOptions.startDate = currentItemStart;
 			analysisOptions.endDate = currentItemEnd
@@ -191,14 +253,12 @@ class DecayingWindows:
 			log.debug("starting new delta");
 			log.debug(analysisOptions.startDate);
 			log.debug(analysisOptions.endDate);
-			instance.analyzePatientItems(analysisOptions) #if an outputFile has been set, it will automatically output buffer to the file
-			log.debug("finished new delta");
-
-			# if you have been doing everything in memory, then load the latest buffer from Analysis Options and merge it with your current buffer
 			if currentBuffer is not None:
-				bufferOneDelta = instance.loadUpdateBufferFromFile(decayAnalysisOptions.outputFile)
-				currentBuffer = instance.mergeBuffers(currentBuffer, bufferOneDelta)
-				log.debug("finished merge");
+				# Doing everything in memory, so just count the new delta directly into the current buffer
+				instance.accumulatePatientItems(analysisOptions, currentBuffer, linkedItemIdsByBaseId)
+			else:
+				instance.analyzePatientItems(analysisOptions)
+			log.debug("finished new delta");
 
 			#Increment dates to next four weeks
 			currentItemStart = currentItemEnd
@@ -208,18 +268,7 @@ class DecayingWindows:
 		
 		# Commit to database if have been doing everything in memory. (If not, then have already been commiting to database incrementally)
 		if currentBuffer is not None:
-			finalCommitBufferFileName = "finalCommitBuffer.txt"
-
-			if os.path.exists(decayAnalysisOptions.outputFile):
-				os.remove(decayAnalysisOptions.outputFile)
-
-			instance.saveBufferToFile(finalCommitBufferFileName, currentBuffer)
-			del currentBuffer #deleting the buffer to save memory, because commitUpdateBufferFromFile will need the memory equivalent of one new buffer
-			instance.commitUpdateBufferFromFile(str(finalCommitBufferFileName))
-
-			# Comment out if want the file to remain so can commit separetely or for debugging
-			if os.path.exists(finalCommitBufferFileName):
-				os.remove(finalCommitBufferFileName)
+			instance.commitUpdateBuffer(currentBuffer, linkedItemIdsByBaseId)
 
 		log.debug("finished process");
 
@@ -235,7 +284,9 @@ class DecayingWindows:
 		parser.add_option("-d", "--delta", type="int", dest="delta", metavar="<delta>",  help="Delta integer (e.g., 4), (unit of time is weeks, defaults to 4 weeks), define in what increments do you want to read in the data. After each increment/delta, it performs a decay.");
 		parser.add_option("-a", "--associationsPerCommit", type="int", dest="associationsPerCommit", help="If provided, will commit incremental analysis results to the database when accrue this many association items.  Can help to avoid allowing accrual of too much buffered items whose runtime memory will exceed the 32bit 2GB program limit.")
 		parser.add_option("-u", "--itemsPerUpdate", type="int", dest="itemsPerUpdate", help="If provided, when updating patient_item analyze_dates, will only update this many items at a time to avoid overloading MySQL query.")
-		parser.add_option("-o", "--outputFile", dest="outputFile", help="If provided, send buffer to output file rather than commiting to database")
+		parser.add_option("-l", "--lazyDecay", action="store_true", dest="lazyDecay", help="If set, decay the counts in the database by just updating a global scale factor that they are read through, rather than rewriting every association record each delta. Records are only rewritten periodically to renormalize.")
+		parser.add_option("-m", "--inMemory", action="store_true", dest="inMemory", help="If set, accumulate all deltas in a single in memory buffer, decayed between deltas, and only commit to the database once at the end, rather than decaying and commiting to the database for every delta")
+		parser.add_option("-o", "--outputFile", dest="outputFile", help="Deprecated. Same as --inMemory. No file is written, so the given path is ignored.")
 		(options, args) = parser.parse_args(argv[1:])
 
 		decayAnalysisOptions = DecayAnalysisOptions()
@@ -256,7 +307,12 @@ class DecayingWindows:
 			decayAnalysisOptions.delta = timedelta(weeks=(options.delta)) #length of one decay item
 
 		if options.outputFile is not None:
-			decayAnalysisOptions.outputFile = options.outputFile
+			log.warning("--outputFile is deprecated and no file is written to %s. Use --inMemory instead." % options.outputFile);
+			decayAnalysisOptions.inMemory = True
+		if options.inMemory:
+			decayAnalysisOptions.inMemory = True
+		if options.lazyDecay:
+			decayAnalysisOptions.lazyDecay = True
 
 		#set patientIds based on either a file input or args
 		decayAnalysisOptions.patientIds = list()
@@ -8,14 +8,17 @@ items / orders.
 """
 import sys, os
 import time;
+import copy;
 from optparse import OptionParser;
 import json;
 import urlparse;
 import math;
+import bisect;
 from datetime import datetime, timedelta;
-from medinfo.common.Const import FALSE_STRINGS, COMMENT_TAG;
-from medinfo.common.Util import stdOpen, ProgressDots;
-from medinfo.common.StatsUtil import ContingencyStats, UnrecognizedStatException, DEGENERATE_VALUE_ADJUSTMENT;
+import numpy as np;
+from medinfo.common.Const import FALSE_STRINGS, COMMENT_TAG, ESTIMATE_SAMPLE_SIZE;
+from medinfo.common.Util import stdOpen, ProgressDots, LRUCache, estimateBytes;
+from medinfo.common.StatsUtil import ContingencyStats, ContingencyStatsArray, UnrecognizedStatException, DEGENERATE_VALUE_ADJUSTMENT;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.db.Model import RowItemFieldComparator;
@@ -28,6 +31,9 @@ from Util import log;
 from Const import AGGREGATOR_OPTIONS;
 from Const import SECONDS_PER_DAY;
 from Const import CORE_FIELDS;
+from Const import HISTOGRAM_BIN_SECONDS;
+from AssociationAnalysis import parseHistogram;
+from AssociationIndex import AssociationIndex;
 
 # List of fields that may be aggregated across results by a (weighted) average
 WEIGHTED_AVERAGE_FIELDS = ["nAB","nA"];
@@ -406,6 +412,17 @@ class BaseItemRecommender:
             (nA'-nAB') = Product((nAi-nAiB)/(N-nB)) * (N-nB)
             nA' = Product((nAi-nAiB)/(N-nB)) * (N-nB) + nAB'
         """
+        BaseItemRecommender.populateAggregateStatsArray([aggregateResult], query, statIds);
+
+    populateAggregateStats = staticmethod(populateAggregateStats);
+
+    def populateAggregateStatsArray(aggregateResults, query, statIds=None):
+        """Vectorized populateAggregateStats for a whole list of aggregate results (e.g., all candidate items for a query).
+        Collects the component counts of all of the aggregate results into flat arrays
+        (with the components of each aggregate result contiguous), so the aggregations are
+        grouped sums / products and the derived statistics are calculated with numpy array operations
+        (StatsUtil.ContingencyStatsArray), rather than Python loops with a ContingencyStats object per item.
+        """
         if statIds is None:
             statIds = set([query.sortField]);
             for (fieldOp, value) in query.fieldFilters.iteritems():
@@ -413,85 +430,91 @@ class BaseItemRecommender:
                     field = fieldOp[:-1];
                     statIds.add(field);
 
-        if "componentResultsById" in aggregateResult:
-            componentResultsById = aggregateResult["componentResultsById"];
+        if len(aggregateResults) < 1:
+            return;
+
+        # Flatten component counts across aggregate results
+        componentCounts = list();
+        componentStarts = list();
+        componentAggregateResults = list();
+        for aggregateResult in aggregateResults:
+            if "componentResultsById" in aggregateResult:
+                componentStarts.append(len(componentCounts));
+                componentAggregateResults.append(aggregateResult);
+                for component in aggregateResult["componentResultsById"].itervalues():
+                    componentCounts.append( (component["nAB"], component["nA"], component["nB"], component["N"]) );
+
+        if componentAggregateResults:
+            componentCounts = np.array(componentCounts, dtype=np.float64);
+            (nAB, nA, nB, N) = componentCounts.T;
+            componentStarts = np.array(componentStarts);
+            componentGroups = np.repeat( np.arange(len(componentStarts)), np.diff(np.append(componentStarts, len(componentCounts))) );
 
             # Fill in baseline counts directly, as values should be identical across components
-            aggregateResult["nB"] = componentResultsById.values()[0]["nB"];
-            aggregateResult["N"] = componentResultsById.values()[0]["N"];
-
-            if query.aggregationMethod in ("weighted","unweighted"):
-                # Standard (weighted) average of component scores
-                aggregateResult["sum(nAB*weight)"] = 0.0;
-                aggregateResult["sum(nA*weight)"] = 0.0;
-                aggregateResult["sum(weight)"] = 0.0;
-
-                for componentId, component in componentResultsById.iteritems():
-                    component["weight"] = 1.0;
+            aggregateNB = nB[componentStarts];
+            aggregateN = N[componentStarts];
+            aggregateNAB = None;
+            aggregateNA = None;
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if query.aggregationMethod in ("weighted","unweighted"):
+                    # Standard (weighted) average of component scores
+                    weight = np.ones(len(componentCounts));
                     if query.aggregationMethod == "weighted":
                         # Weighted scaling of scores inversely proportional to the query item frequency,
                         #   so less common (and thus more specific) query items are paid more attention to in the aggregate recommendations
                         #   Though should beware this may give disproportionate weight to unusually rare query items
-                    	component["weight"] = 1.0 / component["nA"];
-
-                    aggregateResult["sum(nAB*weight)"] += (component["nAB"] * component["weight"]);
-                    aggregateResult["sum(nA*weight)"] += (component["nA"] * component["weight"]);
-                    aggregateResult["sum(weight)"] += component["weight"];
-
-            	aggregateResult["nAB"] = aggregateResult["sum(nAB*weight)"] / aggregateResult["sum(weight)"];   # Complete the weighted average score calculation
-            	aggregateResult["nA"] = aggregateResult["sum(nA*weight)"] / aggregateResult["sum(weight)"];
-
-            elif query.aggregationMethod in ("NaiveBayes"):
-                # Naive Bayes products
-                aggregateResult["product(nAB/nB)"] = 1.0;
-                aggregateResult["product(nA/N)"] = 1.0;
-
-                for componentId, component in componentResultsById.iteritems():
-                    nAB_ = max(component["nAB"],DEGENERATE_VALUE_ADJUSTMENT);   # Small adjustment to avoid zero value that will wipe out all information in product
-                    nA_ = max(component["nA"],DEGENERATE_VALUE_ADJUSTMENT); # Similar check should not be necessary
-                    aggregateResult["product(nAB/nB)"] *= nAB_ / component["nB"];
-                    aggregateResult["product(nA/N)"] *= nA_ / component["N"];
-
-                aggregateResult["nAB"] = aggregateResult["product(nAB/nB)"] * aggregateResult["nB"]
-                aggregateResult["nA"] = aggregateResult["product(nA/N)"] * aggregateResult["N"];
-
-            elif query.aggregationMethod in ("SerialBayes"):
-                # "Serial" Bayes method with NaiveBayes assumption,
-                #   but past Post-Test Odds based on Pre-Test Odds and successive products of Positive Likelihood Ratios
-                """
-                # Direct calculation approach
-                preTestProbB = float(aggregateResult["nB"]) / aggregateResult["N"];
-                preTestOddsB = preTestProbB / (1.0-preTestProbB);
-
-                productLR = 1.0;
-                for componentId, component in componentResultsById.iteritems():
-                    contStats = ContingencyStats( component["nAB"], component["nA"], component["nB"], component["N"] );
-                    contStats.normalize(truncateNegativeValues=True);
-                    productLR *= contStats["LR+"];
-
-                postTestOddsB = preTestOddsB * productLR;
-                postTestProbB = postTestOddsB / (1+postTestOddsB);
-
-                aggregateResult["nAB"] = postTestProbB*100.0;
-                aggregateResult["nA"] = 100.0;  # Arbitrary selection?  Could have done weighted average of component nAs?
-                """
-                aggregateResult["Product(nAB/nB)"] = 1.0;
-                aggregateResult["Product((nA-nAB)/(N-nB))"] = 1.0;
-
-                for componentId, component in componentResultsById.iteritems():
-                    nAB_ = max(component["nAB"],DEGENERATE_VALUE_ADJUSTMENT);   # Small adjustment to avoid zero value that will wipe out all information in product
-                    nA_ = component["nA"];
-                    aggregateResult["Product(nAB/nB)"] *= nAB_ / component["nB"];
-                    aggregateResult["Product((nA-nAB)/(N-nB))"] *= (nA_-nAB_) / (component["N"]-component["nB"]);
-
-                aggregateResult["nAB"] = aggregateResult["Product(nAB/nB)"] * aggregateResult["nB"];
-                aggregateResult["nA"] = aggregateResult["Product((nA-nAB)/(N-nB))"] * (aggregateResult["N"]-aggregateResult["nB"]) + aggregateResult["nAB"];
-
-        # Populate derived statistics that may be used as scoring measures
-        BaseItemRecommender.populateDerivedStats(aggregateResult, statIds);
-        aggregateResult["score"] = aggregateResult[query.sortField];
+                        weight = 1.0 / nA;
+                    sumWeight = np.bincount(componentGroups, weights=weight);
+                    aggregateNAB = np.bincount(componentGroups, weights=nAB*weight) / sumWeight;
+                    aggregateNA = np.bincount(componentGroups, weights=nA*weight) / sumWeight;
+
+                elif query.aggregationMethod in ("NaiveBayes"):
+                    # Naive Bayes products
+                    nAB_ = np.maximum(nAB, DEGENERATE_VALUE_ADJUSTMENT);    # Small adjustment to avoid zero value that will wipe out all information in product
+                    nA_ = np.maximum(nA, DEGENERATE_VALUE_ADJUSTMENT);  # Similar check should not be necessary
+                    aggregateNAB = np.multiply.reduceat(nAB_ / nB, componentStarts) * aggregateNB;
+                    aggregateNA = np.multiply.reduceat(nA_ / N, componentStarts) * aggregateN;
+
+                elif query.aggregationMethod in ("SerialBayes"):
+                    # "Serial" Bayes method with NaiveBayes assumption,
+                    #   but past Post-Test Odds based on Pre-Test Odds and successive products of Positive Likelihood Ratios
+                    nAB_ = np.maximum(nAB, DEGENERATE_VALUE_ADJUSTMENT);    # Small adjustment to avoid zero value that will wipe out all information in product
+                    aggregateNAB = np.multiply.reduceat(nAB_ / nB, componentStarts) * aggregateNB;
+                    aggregateNA = np.multiply.reduceat((nA-nAB_) / (N-nB), componentStarts) * (aggregateN-aggregateNB) + aggregateNAB;
+
+            for iAggregate, aggregateResult in enumerate(componentAggregateResults):
+                aggregateResult["nB"] = aggregateNB[iAggregate];
+                aggregateResult["N"] = aggregateN[iAggregate];
+                if aggregateNAB is not None:
+                    aggregateResult["nAB"] = aggregateNAB[iAggregate];
+                    aggregateResult["nA"] = aggregateNA[iAggregate];
+
+        # Populate derived statistics that may be used as scoring measures, for all of the aggregate results at once
+        for aggregateResult in aggregateResults:
+            if "nAB" not in aggregateResult:    # Baseline query, so just populate with full correlations (as populateDerivedStats)
+                aggregateResult["nAB"] = aggregateResult["nB"];
+                aggregateResult["nA"] = aggregateResult["N"];
+        contStats = ContingencyStatsArray \
+            (   [aggregateResult["nAB"] for aggregateResult in aggregateResults],
+                [aggregateResult["nA"] for aggregateResult in aggregateResults],
+                [aggregateResult["nB"] for aggregateResult in aggregateResults],
+                [aggregateResult["N"] for aggregateResult in aggregateResults],
+            );
+        # Adjust values to prevent abnormal stats.  Particularly, avoid divide by zero or negative counts.
+        contStats.normalize(truncateNegativeValues=False);
+        for statId in statIds:
+            statValues = None;
+            for iAggregate, aggregateResult in enumerate(aggregateResults):
+                if statId not in aggregateResult:   # Skip stats that have already been populated
+                    if statValues is None:
+                        statValues = contStats[statId];
+                    aggregateResult[statId] = float(statValues[iAggregate]);
 
-    populateAggregateStats = staticmethod(populateAggregateStats);
+        for aggregateResult in aggregateResults:
+            aggregateResult["score"] = aggregateResult[query.sortField];
+
+    populateAggregateStatsArray = staticmethod(populateAggregateStatsArray);
 
 
     def filterAggregateResultsByQuery( self, aggregateResultsByItemId, query ):
@@ -500,14 +523,14 @@ class BaseItemRecommender:
         Should require calculation of summary statistics for each aggregate result based on component results.
         """
         # Now collect and sort the aggregated results to return only the top relevant results
-        aggregateResultsWithScore = list();
-        for aggregateResult in aggregateResultsByItemId.itervalues():
-            itemId = aggregateResult["clinical_item_id"];
+        aggregateResults = aggregateResultsByItemId.values();
 
-            # Calculate and populate the aggregate result item with stats based on its component items
-            #   to enable subsequent sorting and filtering
-            self.populateAggregateStats(aggregateResult, query);
+        # Calculate and populate the aggregate result items with stats based on their component items
+        #   to enable subsequent sorting and filtering
+        self.populateAggregateStatsArray(aggregateResults, query);
 
+        aggregateResultsWithScore = list();
+        for aggregateResult in aggregateResults:
             # Look for value filters
             excludeResult = False;
             for (fieldOp, value) in query.fieldFilters.iteritems():
@@ -521,19 +544,40 @@ class BaseItemRecommender:
             if not excludeResult:
                 aggregateResultsWithScore.append( (aggregateResult[query.sortField], aggregateResult) );
 
-        aggregateResultsWithScore.sort();
-        if query.sortReverse:
-            aggregateResultsWithScore.reverse();    # Descending order of score to get top results
-
         # Pull out only the top X results to satisfy the query results
-        topAggregateResults = list();
-        for i, (score, aggregateResult) in enumerate(aggregateResultsWithScore):
-            if query.limit is not None and i >= query.limit:
-                break;  # Stop adding more results if only asked for a subset
-            topAggregateResults.append(aggregateResult);
+        topIndexes = self.topScoreIndexes \
+            (   [score for (score, aggregateResult) in aggregateResultsWithScore],
+                [aggregateResult["clinical_item_id"] for (score, aggregateResult) in aggregateResultsWithScore],
+                query.limit,
+                query.sortReverse,
+            );
+        topAggregateResults = [aggregateResultsWithScore[iResult][1] for iResult in topIndexes];
 
         return topAggregateResults;
 
+    def topScoreIndexes(scores, itemIds, limit=None, sortReverse=True):
+        """Indexes of the top (limit) scores in rank order (descending if sortReverse), with ties ordered by item ID.
+        Typical queries only want a small limit out of many candidate items, so rather than sorting every score,
+        use a partial selection (numpy.argpartition) for the limit-th best score and only fully sort the scores up to it.
+        Any ties with the limit-th score are kept through the sort, so results are the same as sorting everything.
+        """
+        sortScores = np.array(scores, dtype=np.float64);
+        if sortReverse:
+            sortScores = -sortScores;   # Descending order of score to get top results
+        itemIds = np.array(itemIds);
+
+        candidateIndexes = np.arange(len(sortScores));
+        if limit is not None and limit < len(sortScores):
+            if limit < 1:
+                return [];
+            kthScore = sortScores[np.argpartition(sortScores, limit-1)[limit-1]];
+            candidateIndexes = np.flatnonzero(sortScores <= kthScore);
+
+        rankIndexes = np.lexsort( (itemIds[candidateIndexes], sortScores[candidateIndexes]) );
+        return candidateIndexes[rankIndexes][:limit].tolist();
+
+    topScoreIndexes = staticmethod(topScoreIndexes);
+
 
 
 class ItemAssociationRecommender(BaseItemRecommender):
@@ -553,7 +597,38 @@ class ItemAssociationRecommender(BaseItemRecommender):
     If default is set, will just return whatever are the most common
     clinical items overall as recommendations.  Useful for "cold starts"
     when don't have much initial information to key recommendations from.
+
+    If histogramStorage is set, item pair association counts are instead loaded from
+    the time delta histograms in clinical_item_association_histogram (see AssociationAnalysis),
+    with the counts for the query time window (timeDeltaMax) a prefix sum of the histogram bins.
+    Loaded (cached) histograms can then serve queries for any time window.
+
+    If associationIndex is set (an AssociationIndex of an exported, memory-mapped CSR file),
+    item pair association counts, item base counts and the total patient count are instead looked up from the index
+    for just the query items, without querying (and caching) the whole association table.
+    Multiple processes (e.g., web server workers) can share one index file, as the operating system
+    shares the memory-mapped pages between them, rather than each process filling its own data cache.
+
+    If neighborIndex is set (a NeighborIndex of precomputed top item lists), single item queries
+    with the default options the lists were computed with are served directly from the lists.
     """
+    histogramStorage = None;    # If True, load item pair counts from clinical_item_association_histogram rather than the count_* window columns
+    associationIndex = None;    # If set, AssociationIndex to load item pair association counts from rather than the database
+    neighborIndex = None;   # If set, NeighborIndex to look up single item query results from before calculating them
+
+    def __init__(self):
+        BaseItemRecommender.__init__(self);
+        self.histogramStorage = False;
+        self.associationIndex = None;
+        self.neighborIndex = None;
+
+    def queryCountField(self, query):
+        """Determine sorting / scoring count field based on time limit parameters"""
+        countField = "count_any";
+        if query.timeDeltaMax is not None:
+            timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
+            countField = "count_%d" % timeDeltaSeconds;
+        return query.countPrefix+countField;
 
     def __call__(self, query, default=False, conn=None):
         extConn = True;
@@ -562,30 +637,8 @@ class ItemAssociationRecommender(BaseItemRecommender):
             extConn = False;
 
         try:
-            # Determine sorting / scoring field based on time limit parameters
-            countField = "count_any";
-            if query.timeDeltaMax is not None:
-                timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
-                countField = "count_%d" % timeDeltaSeconds;
-            countField = query.countPrefix+countField;
-
-            sqlQuery = SQLQuery();
-            sqlQuery.addSelect("cia."+query.sourceCol()+"");
-            sqlQuery.addSelect("cia."+query.targetCol()+"");
-            sqlQuery.addSelect("cia."+query.countPrefix+"count_0");
-            sqlQuery.addSelect("cia."+countField );
-            sqlQuery.addFrom("clinical_item_association as cia");
-            sqlQuery.addWhere("count_any > 0"); # Don't bother pulling no association counts (even better if these sparse records were not stored in the first place)
-
-            # Test / Debug case, want to put an artificial limit on items recommended
-            if query.maxRecommendedId is not None:
-                sqlQuery.addWhere("cia."+query.targetCol()+" <= %s" % query.maxRecommendedId );
-
-            # Caller may want to filter recommendations to exclude certain category of items
-            if query.excludeCategoryIds:
-                sqlQuery.addFrom("clinical_item as ci");
-                sqlQuery.addWhere("cia."+query.targetCol()+" = ci.clinical_item_id");
-                sqlQuery.addWhereNotIn("ci.clinical_item_category_id", query.excludeCategoryIds );
+            countField = self.queryCountField(query);
+            sqlQuery = self.associationSQLQuery(query, default=default);
 
             if default:
                 # Just query for most common items overall, no particular associations / key item priming
@@ -603,9 +656,11 @@ class ItemAssociationRecommender(BaseItemRecommender):
                 #   Use total number of patient records as a denominator as theoretical number of distinct times an order could be made
                 #   Technically not perfectly accurate, since a single patient can have the same order entered in multiple times.
                 totalPatients = self.totalPatientCount(query, conn);
+                # Association counts may be stored lazily scaled (e.g., decayed)
+                countScale = self.dataManager.getAssociationCountScale(conn=conn);
 
                 for result in resultModels:
-                    nB = result["nB"] = result[query.countPrefix+"count_0"];
+                    nB = result["nB"] = result[query.countPrefix+"count_0"] * countScale;
                     N = result["N"] = totalPatients;
 
                     self.populateDerivedStats(result, [query.sortField]);
@@ -617,12 +672,11 @@ class ItemAssociationRecommender(BaseItemRecommender):
                 # Special case of an empty query set, just look for the most commonly used items in general
                 return self( query, default=True, conn=conn );
             else:
-                # Determine sorting / scoring field based on time limit parameters
-                countField = "count_any";
-                if query.timeDeltaMax is not None:
-                    timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
-                    countField = "count_%d" % timeDeltaSeconds;
-                countField = query.countPrefix+countField;
+                if nQueryItems == 1 and self.neighborIndex is not None:
+                    # Most common single item queries may have precomputed results
+                    neighborResults = self.neighborIndex.loadResults(query);
+                    if neighborResults is not None:
+                        return neighborResults;
 
                 #if query.limit is not None:
                     # Don't need to return whole data table?  Maybe just get enough to fulfill query quantity?
@@ -645,19 +699,132 @@ class ItemAssociationRecommender(BaseItemRecommender):
             if not extConn:
                 conn.close();
 
+    def associationSQLQuery(self, query, default=False):
+        """SQL query for the association count records the query (options) could use, for any of the query items"""
+        countField = self.queryCountField(query);
+
+        sqlQuery = SQLQuery();
+        sqlQuery.addSelect("cia."+query.sourceCol()+"");
+        sqlQuery.addSelect("cia."+query.targetCol()+"");
+        if self.histogramStorage and not default:
+            # Item base counts (diagonal) still in clinical_item_association, but item pair counts for any window from histograms
+            sqlQuery.addSelect("cia."+query.countPrefix+"histogram");
+            sqlQuery.addFrom("clinical_item_association_histogram as cia");
+        else:
+            sqlQuery.addSelect("cia."+query.countPrefix+"count_0");
+            sqlQuery.addSelect("cia."+countField );
+            sqlQuery.addFrom("clinical_item_association as cia");
+            sqlQuery.addWhere("count_any > 0"); # Don't bother pulling no association counts (even better if these sparse records were not stored in the first place)
+
+        # Test / Debug case, want to put an artificial limit on items recommended
+        if query.maxRecommendedId is not None:
+            sqlQuery.addWhere("cia."+query.targetCol()+" <= %s" % query.maxRecommendedId );
+
+        # Caller may want to filter recommendations to exclude certain category of items
+        if query.excludeCategoryIds:
+            sqlQuery.addFrom("clinical_item as ci");
+            sqlQuery.addWhere("cia."+query.targetCol()+" = ci.clinical_item_id");
+            sqlQuery.addWhereNotIn("ci.clinical_item_category_id", query.excludeCategoryIds );
+
+        return sqlQuery;
+
+    def recommendBatch(self, queries, conn=None):
+        """Batch version of __call__ for a list of RecommenderQuery objects (e.g., one per patient in an evaluation),
+        returning the list of recommendation results for each query in the same order.
+        Association records are loaded once for the union of the query items of all queries that share
+        the same loading options (sourced from the same SQL query and count field),
+        and the base item counts, count scale and total patient count are loaded once per count prefix,
+        rather than repeating all of those lookups for every query.
+        Queries that a neighborIndex can serve are looked up from it instead.
+        """
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+        try:
+            # Group the queries that can share loaded association records
+            queryIndexesByLoadKey = dict();
+            sqlQueryByLoadKey = dict();
+            neighborResultsByIndex = dict();
+            for iQuery, query in enumerate(queries):
+                if len(query.queryItemIds) < 1:
+                    continue;   # Empty query set just gets default recommendations
+                if len(query.queryItemIds) == 1 and self.neighborIndex is not None:
+                    neighborResults = self.neighborIndex.loadResults(query);
+                    if neighborResults is not None:
+                        neighborResultsByIndex[iQuery] = neighborResults;
+                        continue;
+                sqlQuery = self.associationSQLQuery(query);
+                loadKey = (str(sqlQuery), tuple(sqlQuery.params), self.queryCountField(query));
+                if loadKey not in queryIndexesByLoadKey:
+                    queryIndexesByLoadKey[loadKey] = list();
+                    sqlQueryByLoadKey[loadKey] = sqlQuery;
+                queryIndexesByLoadKey[loadKey].append(iQuery);
+
+            resultModelsList = [list() for query in queries];
+            for loadKey, queryIndexes in queryIndexesByLoadKey.iteritems():
+                unionQuery = copy.copy(queries[queryIndexes[0]]);
+                unionQuery.queryItemIds = set();
+                for iQuery in queryIndexes:
+                    unionQuery.queryItemIds.update(queries[iQuery].queryItemIds);
+                resultModelsBySourceId = dict();
+                for result in self.loadQueryItemResultModels(unionQuery, sqlQueryByLoadKey[loadKey], conn=conn):
+                    resultModelsBySourceId.setdefault(result[unionQuery.sourceCol()], list()).append(result);
+
+                # Copy out each query's results, since populating stats will modify them
+                for iQuery in queryIndexes:
+                    query = queries[iQuery];
+                    resultModels = list();
+                    for queryItemId in query.queryItemIds:
+                        for result in resultModelsBySourceId.get(queryItemId, []):
+                            resultModels.append(dict(result));
+                    resultModelsList[iQuery] = self.filterResultItems(resultModels, query);
+
+            baseCountsByKey = dict();
+            recommendedDataList = list();
+            for iQuery, (query, resultModels) in enumerate(zip(queries, resultModelsList)):
+                if iQuery in neighborResultsByIndex:
+                    recommendedDataList.append( neighborResultsByIndex[iQuery] );
+                elif len(resultModels) < 1:
+                    # Not able to find any recommendations based on this query data.  Just return default recommendations then.
+                    recommendedDataList.append( self(query, default=True, conn=conn) );
+                else:
+                    baseCountsKey = (query.countPrefix, query.acceptCache, query.maxRecommendedId is not None);
+                    if baseCountsKey not in baseCountsByKey:
+                        baseCountsByKey[baseCountsKey] = self.loadBaseCounts(query, conn=conn);
+                    recommendedDataList.append( self.aggregateRecommendations(resultModels, query, self.queryCountField(query), conn=conn, baseCounts=baseCountsByKey[baseCountsKey]) );
+            return recommendedDataList;
+        finally:
+            if not extConn:
+                conn.close();
+
     def loadResultModels( self, query, sqlQuery, conn ):
         """Query for the results from the SQL query, but if the dataCache is set on this instance,
         see if this can be retrieved/stored from there as well, to minimize repetitive database hits.
         Instead of serial small DB queries, just do one massive DB query for all possible query items
         and store in memory (few GB for upto 100K items) and return select subsets as requested for much more rapid serial queries.
+
+        If an associationIndex is set, just look up the rows for the query items from the index instead.
         """
-        simpleSQLQuery = str(sqlQuery).replace(",%s" % DBUtil.SQL_PLACEHOLDER,"");   # Strip down multiple consecutive placeholders
+        resultModels = self.loadQueryItemResultModels(query, sqlQuery, conn=conn);
+        resultModels = self.filterResultItems(resultModels, query);
+        return resultModels;
+
+    def loadQueryItemResultModels( self, query, sqlQuery, conn ):
+        """Load (copies of) all of the association results for the query items, before any filterResultItems (see loadResultModels)"""
+        if self.associationIndex is not None and not self.histogramStorage:
+            return self.associationIndex.loadResultModels(query, self.queryCountField(query));
+
+        # Cache key must cover the query parameters (e.g., excluded categories), not just the query text
+        cacheKey = DBUtil.parameterizeQueryString(sqlQuery);
 
         # Populate a cache if it has not already been so
         dataCache = self.dataManager.dataCache;
-        if dataCache is None: dataCache = dict();
-        if simpleSQLQuery not in dataCache:
-            dataCache[simpleSQLQuery] = dict();
+        resultModelsBySourceId = None;
+        if dataCache is not None:
+            resultModelsBySourceId = dataCache.get(cacheKey);
+        if resultModelsBySourceId is None:
+            resultModelsBySourceId = dict();
 
             #print >> sys.stderr, sqlQuery;
 
@@ -665,28 +832,61 @@ class ItemAssociationRecommender(BaseItemRecommender):
             newResultModels = modelListFromTable(newResultsTable);
             self.dataManager.queryCount += 1;
 
+            sampleBytes = 0;
+            nSampled = 0;
             for result in newResultModels:
                 #print >> sys.stderr, "CACHE IT:", (result);
                 sourceItemId = result[query.sourceCol()];
-                if sourceItemId not in dataCache[simpleSQLQuery]:
-                    dataCache[simpleSQLQuery][sourceItemId] = list();
+                if sourceItemId not in resultModelsBySourceId:
+                    resultModelsBySourceId[sourceItemId] = list();
                 resultCopy = dict(result);
-                dataCache[simpleSQLQuery][sourceItemId].append(resultCopy);
+                histogramField = query.countPrefix+"histogram";
+                if histogramField in resultCopy:
+                    # Parse once for the cache, as cumulative counts by bin, ready for the prefix sum of any time window
+                    resultCopy[histogramField] = np.cumsum(parseHistogram(resultCopy[histogramField])).tolist();
+                resultModelsBySourceId[sourceItemId].append(resultCopy);
+                if nSampled < ESTIMATE_SAMPLE_SIZE:
+                    sampleBytes += estimateBytes(resultCopy);
+                    nSampled += 1;
+
+            # Store once complete, so a bounded cache can size the whole entry
+            if isinstance(dataCache, LRUCache):
+                # Size by row count times the size of the sampled rows, rather than walking what may be the whole association table
+                valueBytes = sampleBytes * len(newResultModels) // max(nSampled, 1);
+                dataCache.put(cacheKey, resultModelsBySourceId, valueBytes);
+            elif dataCache is not None:
+                dataCache[cacheKey] = resultModelsBySourceId;
 
         # Pull out the relevant results of interest
         resultModels = list();
         # See if can find what we want from the previously cached results
         for queryItemId in query.queryItemIds:
-            if queryItemId in dataCache[simpleSQLQuery]:
-                for result in dataCache[simpleSQLQuery][queryItemId]:
+            if queryItemId in resultModelsBySourceId:
+                for result in resultModelsBySourceId[queryItemId]:
                     resultCopy = dict(result);
+                    if query.countPrefix+"histogram" in resultCopy:
+                        self.populateHistogramCounts(resultCopy, query);
                     resultModels.append( resultCopy );
                     #print >> sys.stderr, "PULL IT", resultCopy;
-
-        resultModels = self.filterResultItems(resultModels, query);
         return resultModels;
 
 
+    def populateHistogramCounts(self, result, query):
+        """Replace the (cumulative) time delta histogram counts in a loaded result with the count fields the query expects
+        (count_0 and the query time window count field), as for results loaded from clinical_item_association.
+        Windows that are not a histogram bin edge get the count within the largest bin edge below them.
+        """
+        cumulativeCounts = result.pop(query.countPrefix+"histogram");
+        result[query.countPrefix+"count_0"] = cumulativeCounts[0];
+        windowCount = cumulativeCounts[-1];
+        if query.timeDeltaMax is not None:
+            timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
+            iBin = bisect.bisect_right(HISTOGRAM_BIN_SECONDS, timeDeltaSeconds) - 1;
+            windowCount = 0.0;
+            if iBin >= 0:
+                windowCount = cumulativeCounts[iBin];
+        result[self.queryCountField(query)] = windowCount;
+
     def filterResultItems(self,resultModels,query):
         """Application level item filtering so get more DB results that can be cached in local memory
         for rapid retrieval again, but retaining filtering options.
@@ -706,19 +906,20 @@ class ItemAssociationRecommender(BaseItemRecommender):
             filteredModels.append(result);
         return filteredModels;
 
-    def aggregateRecommendations( self, resultModels, query, countField, conn=None ):
+    def aggregateRecommendations( self, resultModels, query, countField, conn=None, baseCounts=None ):
         """Given all of the resultModels from an association query from multiple
         key clinical items, aggregate them into a single recommendation list
         (with option of link back to component results).
 
         Should be sorted and filtered by any sort and filter options as specified in the query.
+        Option to provide previously loaded baseCounts (see loadBaseCounts) to populate the result counts with.
         """
         if len(resultModels) < 1:
             # Not able to find any recommendations based on this query data.  Just return default recommendations then.
             return self( query, default=True, conn=conn );
 
         # Ensure core association count statistics are available for each result
-        self.populateResultCounts( resultModels, query, countField, conn=conn );
+        self.populateResultCounts( resultModels, query, countField, conn=conn, baseCounts=baseCounts );
 
         # Organize all possible results by target item ID, with component results as sub items
         aggregateResultsByItemId = self.collateAggregateResuls( resultModels, query );
@@ -728,7 +929,7 @@ class ItemAssociationRecommender(BaseItemRecommender):
 
         return filteredAggregateResults;
 
-    def populateResultCounts( self, resultModels, query, countField, conn=None ):
+    def populateResultCounts( self, resultModels, query, countField, conn=None, baseCounts=None ):
         """Ensure core association counts are populated for each result model.
         Assume ordering of A as source-query item and B as target-recommended item.  Then,
         nAB = Number of occurrences of item B occuring after A (within a timeframe specified in the query)
@@ -742,41 +943,62 @@ class ItemAssociationRecommender(BaseItemRecommender):
 
         Query options should be available to specify preference for n counts to be based on patient occurrences
         ("Number of patients where item B occurs after item A") to fill a properly scaled 2x2 table.
+
+        If baseCounts are not provided (see loadBaseCounts), will load them for the query.
+        """
+        if baseCounts is None:
+            baseCounts = self.loadBaseCounts(query, conn=conn);
+        (baseCountResultsByItemId, countScale, totalPatients) = baseCounts;
+
+        countPrefix = query.countPrefix;
+        if countPrefix == "":
+            countPrefix = "item_";
+
+        for result in resultModels:
+            queryItemId = result[""+query.sourceCol()+""];
+            targetItemId = result[""+query.targetCol()+""];
+            baseCountResultsByItemId[queryItemId][countPrefix+"count"]
+
+            # Ensure component items have core association counts.  Convert to floats to facilitate calculations
+            nAB = result["nAB"] = float(result[countField]) * countScale;
+            nA = result["nA"] = float(baseCountResultsByItemId[queryItemId][countPrefix+"count"]);
+            nB = result["nB"] = float(baseCountResultsByItemId[targetItemId][countPrefix+"count"]);
+            N = result["N"] = float(totalPatients);
+
+    def loadBaseCounts(self, query, conn=None):
+        """Load the item base counts and scaling values needed to populate the result counts of the query (see populateResultCounts).
+        Returns (baseCountResultsByItemId, countScale, totalPatients)
         """
         extConn = True;
         if conn is None:
             conn = self.connFactory.connection();
             extConn = False;
         try:
-            # Ensure the summary count cache is up-to-date before using it to query
-            self.dataManager.updateClinicalItemCounts(acceptCache=query.acceptCache, conn=conn);
-
             # Collect baseline relative prevalence / frequency of query and target items to allow subsequent scaling
             countPrefix = query.countPrefix;
             if countPrefix == "":
                 countPrefix = "item_";
-            baseCountQuery = SQLQuery();
-            baseCountQuery.addSelect("ci.clinical_item_id");
-            baseCountQuery.addSelect(countPrefix+"count");
-            baseCountQuery.addFrom("clinical_item as ci");
-            baseCountQuery.addWhere("analysis_status <> 0");    # Will need all records fit for analysis to scale any suggested item
-            baseCountResultTable = self.dataManager.executeCacheOption( baseCountQuery, includeColumnNames=True, conn=conn );
-
-            baseCountResultsByItemId = modelDictFromList( modelListFromTable(baseCountResultTable), "clinical_item_id");
+            if self.associationIndex is not None and not self.histogramStorage:
+                # Base counts exported with the index, consistent with its association counts and scale
+                baseCountResultsByItemId = self.associationIndex.loadBaseCountModelsByItemId(countPrefix);
+                countScale = self.associationIndex.countScale;
+            else:
+                # Ensure the summary count cache is up-to-date before using it to query
+                self.dataManager.updateClinicalItemCounts(acceptCache=query.acceptCache, conn=conn);
+
+                baseCountQuery = SQLQuery();
+                baseCountQuery.addSelect("ci.clinical_item_id");
+                baseCountQuery.addSelect(countPrefix+"count");
+                baseCountQuery.addFrom("clinical_item as ci");
+                baseCountQuery.addWhere("analysis_status <> 0");    # Will need all records fit for analysis to scale any suggested item
+                baseCountResultTable = self.dataManager.executeCacheOption( baseCountQuery, includeColumnNames=True, conn=conn );
+
+                baseCountResultsByItemId = modelDictFromList( modelListFromTable(baseCountResultTable), "clinical_item_id");
+                # Association counts may be stored lazily scaled (e.g., decayed). Base item counts are already scaled by DataManager.updateClinicalItemCounts
+                countScale = self.dataManager.getAssociationCountScale(conn=conn);
             # Count up total number of patients to turn counts into per patient frequency
             totalPatients = self.totalPatientCount(query, conn);
-
-            for result in resultModels:
-                queryItemId = result[""+query.sourceCol()+""];
-                targetItemId = result[""+query.targetCol()+""];
-                baseCountResultsByItemId[queryItemId][countPrefix+"count"]
-
-                # Ensure component items have core association counts.  Convert to floats to facilitate calculations
-                nAB = result["nAB"] = float(result[countField]);
-                nA = result["nA"] = float(baseCountResultsByItemId[queryItemId][countPrefix+"count"]);
-                nB = result["nB"] = float(baseCountResultsByItemId[targetItemId][countPrefix+"count"]);
-                N = result["N"] = float(totalPatients);
-
+            return (baseCountResultsByItemId, countScale, totalPatients);
         finally:
             if not extConn:
                 conn.close();
@@ -838,6 +1060,10 @@ class ItemAssociationRecommender(BaseItemRecommender):
         if isSpecializedQuery:
             return SIMULATED_PATIENT_COUNT;
 
+        if self.associationIndex is not None and self.associationIndex.totalPatients is not None and not self.histogramStorage:
+            # Patient count exported with the index, consistent with its counts, without any database lookup
+            return self.associationIndex.totalPatients;
+
         # First do optimistic check that results will already be in database result cache
         dataStr = self.dataManager.getCacheData("analyzedPatientCount", conn=conn);
         if dataStr is not None:
@@ -868,12 +1094,15 @@ class ItemAssociationRecommender(BaseItemRecommender):
                     "   <outputFile>    Tab-delimited table of recommender results..\n"+\
                     "                       Leave blank or specify \"-\" to send to stdout.\n"
         parser = OptionParser(usage=usageStr)
+        parser.add_option("-i", "--associationIndex", dest="associationIndex", help="If provided, association index file (see AssociationIndex) to look up item association counts from instead of the database.")
 
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
         timer = time.time();
         if len(args) > 0:
+            if options.associationIndex is not None:
+                self.associationIndex = AssociationIndex(options.associationIndex);
             queryStr = args[0];
             # Format the results for output
             outputFilename = None;
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+Precompute the top N recommended (neighbor) items for every single clinical item query,
+for each supported count prefix, time window and sort statistic, into a compact
+file that can be memory-mapped, so ItemAssociationRecommender can answer single item
+queries with default options (e.g., RelatedOrders lookups) with one indexed read
+rather than loading and aggregating all of the item's association records.
+"""
+import sys, os
+import time;
+import copy;
+import json;
+from optparse import OptionParser;
+from datetime import timedelta;
+import numpy as np;
+from medinfo.common.Util import ProgressDots, LRUCache;
+from medinfo.db import DBUtil;
+from medinfo.db.Model import SQLQuery, RowItemModel;
+
+from Const import SECONDS_PER_DAY, COUNT_PREFIX_OPTIONS;
+from AssociationAnalysis import DELTA_SECONDS_OPTIONS;
+from AssociationIndex import AssociationIndex, saveArrays, loadArrays;
+from ItemRecommender import ItemAssociationRecommender, RecommenderQuery;
+
+from Util import log;
+
+"""Default number of top neighbor items to store per list.
+Should comfortably exceed typical result counts, so lists still fill a query after removing any extra excluded items (e.g., those already ordered)
+"""
+DEFAULT_NEIGHBOR_COUNT = 100;
+
+"""Default sort statistics to precompute neighbor lists for"""
+DEFAULT_SORT_FIELDS = ["PPV","P-YatesChi2-NegLog","P-Fisher-NegLog"];
+
+"""Default time windows (seconds) to precompute neighbor lists for, with None for any time (count_any)"""
+DEFAULT_TIME_DELTA_SECONDS_OPTIONS = [None] + DELTA_SECONDS_OPTIONS;
+
+"""Result fields stored for each neighbor item, enough to reconstruct the recommender result (other stats can be derived from the counts)"""
+NEIGHBOR_STAT_NAMES = ["nAB","nA","nB","N","score"];
+
+"""Order of the numpy arrays stored in an index file.
+Each (query item, neighbor list key) pair is one row, numbered iList*len(itemIds) + iItem, with neighbors in rank order.
+"""
+NEIGHBOR_ARRAY_NAMES = \
+    [   "itemIds",          # Sorted query clinical_item_id with neighbor lists
+        "rowOffsets",       # Neighbors for row i are in positions rowOffsets[i]:rowOffsets[i+1]
+        "neighborItemIds",  # Recommended clinical_item_id of each neighbor
+        "neighborStats",    # Stat array per NEIGHBOR_STAT_NAMES, shape (nStats, nNeighbors)
+        "metadata",
+    ];
+
+"""Number of query items to run through ItemAssociationRecommender.recommendBatch at a time when exporting"""
+EXPORT_ITEMS_PER_BATCH = 1000;
+
+"""Data cache entries to keep while exporting.  Enough for the association records of the current count prefix and time window
+plus base count queries, while releasing those of prior windows."""
+EXPORT_DATA_CACHE_ENTRIES = 8;
+
+class NeighborIndex:
+    """Precomputed top N neighbor lists of single item recommender queries.
+    Export with exportIndex, then open with loadIndex (or the filename constructor argument)
+    and look up the recommendations for a query with loadResults.
+
+    Lists are computed with the options of a base query (e.g., default excluded items and categories, and the neighbor count as the limit).
+    Queries with other options than those that can be served from the lists just fall back to normal recommender calculations.
+    The index is a snapshot, so should be re-exported after association analysis updates.
+    """
+    connFactory = None; # Allow specification of alternative DB connection source
+    filename = None;
+    recommender = None; # ItemAssociationRecommender to precompute neighbor lists with
+
+    def __init__(self, filename=None):
+        """Default constructor"""
+        self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
+        self.recommender = ItemAssociationRecommender();
+        self.filename = None;
+        self.metadata = None;
+        self.arraysByName = dict();
+        self.listIndexByKey = dict();
+        if filename is not None:
+            self.loadIndex(filename);
+
+    def defaultBaseQuery(self, conn=None):
+        """Base query for neighbor lists with the default options an interactive (e.g., RelatedOrders) query would use"""
+        baseQuery = RecommenderQuery();
+        baseQuery.excludeItemIds = self.recommender.defaultExcludedClinicalItemIds(conn=conn);
+        baseQuery.excludeCategoryIds = self.recommender.defaultExcludedClinicalItemCategoryIds(conn=conn);
+        baseQuery.limit = DEFAULT_NEIGHBOR_COUNT;
+        return baseQuery;
+
+    def exportIndex(self, filename, baseQuery=None, countPrefixes=None, timeDeltaSecondsOptions=None, sortFields=None, conn=None):
+        """Calculate the neighbor lists for every clinical item fit for analysis and write them to an index file.
+        Lists are the top baseQuery.limit recommendations for each of the count prefixes, time windows and sort fields
+        (defaults of COUNT_PREFIX_OPTIONS, DEFAULT_TIME_DELTA_SECONDS_OPTIONS and DEFAULT_SORT_FIELDS),
+        otherwise with the baseQuery options (defaults of defaultBaseQuery).
+        File is a sequence of numpy (.npy) arrays in the order of NEIGHBOR_ARRAY_NAMES.
+        """
+        if countPrefixes is None:
+            countPrefixes = COUNT_PREFIX_OPTIONS;
+        if timeDeltaSecondsOptions is None:
+            timeDeltaSecondsOptions = DEFAULT_TIME_DELTA_SECONDS_OPTIONS;
+        if sortFields is None:
+            sortFields = DEFAULT_SORT_FIELDS;
+
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+        try:
+            if baseQuery is None:
+                baseQuery = self.defaultBaseQuery(conn=conn);
+            itemIds = self.queryItemIds(conn);
+
+            # Only keep the association records of the current time window, rather than every window queried
+            self.recommender.dataManager.dataCache = LRUCache(EXPORT_DATA_CACHE_ENTRIES);
+
+            listKeys = list();
+            neighborsByListKey = dict();
+            progress = ProgressDots(name="Item Queries", total=len(countPrefixes)*len(timeDeltaSecondsOptions)*len(itemIds));
+            for countPrefix in countPrefixes:
+                for timeDeltaSeconds in timeDeltaSecondsOptions:
+                    for iStart in xrange(0, len(itemIds), EXPORT_ITEMS_PER_BATCH):
+                        batchItemIds = itemIds[iStart:iStart+EXPORT_ITEMS_PER_BATCH];
+                        queries = [self.itemQuery(baseQuery, itemId, countPrefix, timeDeltaSeconds, sortFields[0]) for itemId in batchItemIds];
+                        recommendedDataList = self.recommender.recommendBatch(queries, conn=conn);
+                        for itemId, query, recommendedData in zip(batchItemIds, queries, recommendedDataList):
+                            self.addNeighbors(neighborsByListKey, itemId, query, recommendedData, baseQuery, countPrefix, timeDeltaSeconds, sortFields);
+                            progress.update();
+                    for sortField in sortFields:
+                        listKeys.append( (countPrefix, timeDeltaSeconds, sortField) );
+            progress.printStatus();
+        finally:
+            if not extConn:
+                conn.close();
+
+        # Only need rows for items with any neighbors
+        neighborItemIdSet = set();
+        for neighborsByItemId in neighborsByListKey.itervalues():
+            neighborItemIdSet.update(neighborsByItemId.iterkeys());
+        rowItemIds = sorted(neighborItemIdSet);
+
+        rowLengths = list();
+        neighborItemIdsList = list();
+        neighborStatsList = list();
+        for listKey in listKeys:
+            neighborsByItemId = neighborsByListKey.get(listKey, {});
+            for itemId in rowItemIds:
+                (neighborItemIds, neighborStats) = neighborsByItemId.get(itemId, ([], []));
+                rowLengths.append(len(neighborItemIds));
+                neighborItemIdsList.extend(neighborItemIds);
+                neighborStatsList.extend(neighborStats);
+
+        metadata = \
+            {   "listKeys": listKeys,
+                "neighborCount": baseQuery.limit,
+                "statNames": NEIGHBOR_STAT_NAMES,
+                "excludeItemIds": sorted(baseQuery.excludeItemIds),
+                "excludeCategoryIds": sorted(baseQuery.excludeCategoryIds),
+                "maxRecommendedId": baseQuery.maxRecommendedId,
+                "invertQuery": baseQuery.invertQuery,
+                "aggregationMethod": baseQuery.aggregationMethod,
+                "sortReverse": baseQuery.sortReverse,
+            };
+
+        arraysByName = \
+            {   "itemIds": np.array(rowItemIds, dtype=np.int64),
+                "rowOffsets": np.append(0, np.cumsum(rowLengths)).astype(np.int64),
+                "neighborItemIds": np.array(neighborItemIdsList, dtype=np.int64),
+                "neighborStats": np.ascontiguousarray(np.array(neighborStatsList, dtype=np.float64).reshape(-1,len(NEIGHBOR_STAT_NAMES)).T),
+                "metadata": np.array(json.dumps(metadata)),
+            };
+        saveArrays(filename, arraysByName, NEIGHBOR_ARRAY_NAMES);
+        log.info("Exported %d neighbor lists for %d items to %s" % (len(listKeys), len(rowItemIds), filename) );
+
+    def queryItemIds(self, conn):
+        """Sorted clinical_item_id of all of the items fit for analysis, to precompute neighbor lists for"""
+        query = SQLQuery();
+        query.addSelect("clinical_item_id");
+        query.addFrom("clinical_item");
+        query.addWhere("analysis_status <> 0");
+        query.addOrderBy("clinical_item_id");
+        resultTable = DBUtil.execute(query, conn=conn);
+        return [row[0] for row in resultTable];
+
+    def itemQuery(self, baseQuery, itemId, countPrefix, timeDeltaSeconds, sortField):
+        """Single item query for all of the candidate neighbors of the item (no limit), otherwise with the baseQuery options"""
+        query = copy.copy(baseQuery);
+        query.queryItemIds = set([itemId]);
+        query.targetItemIds = set();
+        query.fieldFilters = dict();
+        query.countPrefix = countPrefix;
+        query.timeDeltaMax = None;
+        if timeDeltaSeconds is not None:
+            query.timeDeltaMax = timedelta(0, timeDeltaSeconds);
+        query.sortField = sortField;
+        query.limit = None;
+        return query;
+
+    def addNeighbors(self, neighborsByListKey, itemId, query, recommendedData, baseQuery, countPrefix, timeDeltaSeconds, sortFields):
+        """Rank the recommended (candidate neighbor) data for the item query by each of the sort fields
+        and add the top baseQuery.limit of them to the (neighborItemIds, neighborStats) by item ID for each list key.
+        """
+        if len(recommendedData) < 1 or "componentResultsById" not in recommendedData[0]:
+            return; # No associations for the item, so recommender fell back to default recommendations.  Leave that to the recommender.
+
+        # Results only have the stat of the query sort field so far
+        ItemAssociationRecommender.populateAggregateStatsArray(recommendedData, query, statIds=sortFields);
+        itemIds = [result["clinical_item_id"] for result in recommendedData];
+        for sortField in sortFields:
+            topIndexes = ItemAssociationRecommender.topScoreIndexes \
+                (   [result[sortField] for result in recommendedData], itemIds, baseQuery.limit, baseQuery.sortReverse );
+            neighborItemIds = list();
+            neighborStats = list();
+            for iResult in topIndexes:
+                result = recommendedData[iResult];
+                neighborItemIds.append(result["clinical_item_id"]);
+                neighborStats.append( [result[statName] for statName in NEIGHBOR_STAT_NAMES[:-1]] + [result[sortField]] );
+            listKey = (countPrefix, timeDeltaSeconds, sortField);
+            neighborsByListKey.setdefault(listKey, dict())[itemId] = (neighborItemIds, neighborStats);
+
+    def loadIndex(self, filename):
+        """Memory-map the arrays of an index file written by exportIndex (see AssociationIndex.loadArrays)"""
+        arraysByName = loadArrays(filename, NEIGHBOR_ARRAY_NAMES);
+        metadata = json.loads(str(arraysByName["metadata"]));
+        metadata["excludeItemIds"] = set(metadata["excludeItemIds"]);
+        metadata["excludeCategoryIds"] = set(metadata["excludeCategoryIds"]);
+
+        self.filename = filename;
+        self.metadata = metadata;
+        self.arraysByName = arraysByName;
+        self.listIndexByKey = dict([(tuple(listKey), iList) for iList, listKey in enumerate(metadata["listKeys"])]);
+
+    def queryListKey(self, query):
+        """Neighbor list key (countPrefix, timeDeltaSeconds, sortField) for the query options"""
+        timeDeltaSeconds = None;
+        if query.timeDeltaMax is not None:
+            timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
+        return (query.countPrefix, timeDeltaSeconds, query.sortField);
+
+    def isQueryServable(self, query):
+        """Whether the query recommendations would just be (a prefix of) a precomputed neighbor list, less any extra excluded items.
+        Requires a single query item, no target items or field filters,
+        the same other options as the base query of the lists, and at least the base query excluded items.
+        """
+        metadata = self.metadata;
+        if metadata is None or len(query.queryItemIds) != 1:
+            return False;
+        if query.targetItemIds:
+            return False;
+        for value in query.fieldFilters.itervalues():
+            if value is not None:
+                return False;
+        if query.invertQuery != metadata["invertQuery"] or \
+            query.aggregationMethod != metadata["aggregationMethod"] or \
+            query.sortReverse != metadata["sortReverse"] or \
+            query.maxRecommendedId != metadata["maxRecommendedId"]:
+            return False;
+        if set(query.excludeCategoryIds) != metadata["excludeCategoryIds"]:
+            return False;
+        if not metadata["excludeItemIds"].issubset(query.excludeItemIds):
+            return False;
+        return self.queryListKey(query) in self.listIndexByKey;
+
+    def loadResults(self, query):
+        """Recommendation results for the query from the precomputed neighbor lists, as ItemAssociationRecommender would return.
+        Returns None if the query cannot be served from the lists (see isQueryServable), including if the query item has no list,
+        or too few neighbors remain after removing extra excluded items to be sure of the top query.limit results.
+        """
+        if not self.isQueryServable(query):
+            return None;
+
+        itemIds = self.arraysByName["itemIds"];
+        queryItemId = iter(query.queryItemIds).next();
+        iItem = np.searchsorted(itemIds, queryItemId);
+        if iItem >= len(itemIds) or itemIds[iItem] != queryItemId:
+            return None;
+        iRow = self.listIndexByKey[self.queryListKey(query)] * len(itemIds) + iItem;
+        rowOffsets = self.arraysByName["rowOffsets"];
+        (rowStart, rowEnd) = (rowOffsets[iRow], rowOffsets[iRow+1]);
+        if rowStart == rowEnd:
+            return None;
+
+        neighborItemIds = self.arraysByName["neighborItemIds"][rowStart:rowEnd].tolist();
+        neighborStats = np.asarray(self.arraysByName["neighborStats"][:,rowStart:rowEnd]).T.tolist();
+        # A full length list may have been truncated, so can only serve a limited number of results from it
+        isCompleteList = (len(neighborItemIds) < self.metadata["neighborCount"]);
+
+        results = list();
+        for neighborItemId, statValues in zip(neighborItemIds, neighborStats):
+            if neighborItemId in query.excludeItemIds:
+                continue;   # Extra excluded items just drop out of the ranked list
+            if query.limit is not None and len(results) >= query.limit:
+                break;
+            result = RowItemModel();
+            result["clinical_item_id"] = neighborItemId;
+            for statName, value in zip(NEIGHBOR_STAT_NAMES, statValues):
+                result[statName] = value;
+            result[query.sortField] = result["score"];
+            results.append(result);
+
+        if not isCompleteList and (query.limit is None or len(results) < query.limit):
+            return None;    # Neighbors beyond the stored list may belong in the results
+        if len(results) < 1:
+            return None;    # Recommender falls back to default recommendations when none are left
+        return results;
+
+    def main(self, argv):
+        """Main method, callable from command line"""
+        usageStr =  "usage: %prog [options] <outputFile>\n"+\
+                    "   <outputFile>    Index file to write the precomputed neighbor lists to.\n"+\
+                    "                   Set as the ItemAssociationRecommender neighborIndex to serve single item queries from it.\n"
+        parser = OptionParser(usage=usageStr)
+        parser.add_option("-n", "--neighborCount", dest="neighborCount", help="Number of top neighbor items to store per list. Default %s." % DEFAULT_NEIGHBOR_COUNT);
+        parser.add_option("-p", "--countPrefixes", dest="countPrefixes", help="Comma-separated list of count prefixes to precompute lists for (use 'item_' for the default item counts). Default all.");
+        parser.add_option("-t", "--timeDeltaMax", dest="timeDeltaMax", help="Comma-separated list of time windows (seconds) to precompute lists for (use 'any' for no time limit). Default all.");
+        parser.add_option("-s", "--sortFields", dest="sortFields", help="Comma-separated list of sort statistics to precompute lists for. Default %s." % str.join(",", DEFAULT_SORT_FIELDS));
+        parser.add_option("-i", "--associationIndex", dest="associationIndex", help="If provided, association index file (see AssociationIndex) to calculate the lists from instead of the database.");
+        (options, args) = parser.parse_args(argv[1:])
+
+        log.info("Starting: "+str.join(" ", argv))
+        timer = time.time();
+        if len(args) > 0:
+            if options.associationIndex is not None:
+                self.recommender.associationIndex = AssociationIndex(options.associationIndex);
+
+            baseQuery = self.defaultBaseQuery();
+            if options.neighborCount is not None:
+                baseQuery.limit = int(options.neighborCount);
+            countPrefixes = None;
+            if options.countPrefixes is not None:
+                countPrefixes = [countPrefix.replace("item_","") for countPrefix in options.countPrefixes.split(",")];
+            timeDeltaSecondsOptions = None;
+            if options.timeDeltaMax is not None:
+                timeDeltaSecondsOptions = [None if secondsStr == "any" else int(secondsStr) for secondsStr in options.timeDeltaMax.split(",")];
+            sortFields = None;
+            if options.sortFields is not None:
+                sortFields = options.sortFields.split(",");
+
+            self.exportIndex(args[0], baseQuery, countPrefixes, timeDeltaSecondsOptions, sortFields);
+        else:
+            parser.print_help()
+            sys.exit(-1)
+
+        timer = time.time() - timer;
+        log.info("%.3f seconds to complete",timer);
+
+if __name__ == "__main__":
+    instance = NeighborIndex();
+    instance.main(sys.argv);
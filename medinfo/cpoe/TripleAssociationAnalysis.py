@@ -2,6 +2,7 @@
 import sys, os
 import time;
 import math;
+import bisect;
 from datetime import datetime;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
@@ -27,12 +28,15 @@ class TripleAssociationAnalysis(AssociationAnalysis):
     where B2 is used as the time point for B', and only count cases where the time sequence Ai->B1->B2 is observed.
     """
     connFactory = None; # Allow specification of alternative DB connection source
+    minPatientCount = None; # If set, only consider items recorded for at least this many patients (clinical_item.patient_count from prior association analysis) as candidate starting items of triple sequences
 
     def __init__(self):
         """Default constructor"""
         AssociationAnalysis.__init__(self);
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
         self.dataManager = DataManager();
+        self.minPatientCount = None;
+        self.verifiedVirtualItemLinks = set();  # Cache of (virtualItemId, componentId) links already verified to exist in the database
 
     def analyzePatientItems(self, patientIds, itemIdSequence, virtualItemId):
         """Primary run function to analyze patient clinical item data and
@@ -52,16 +56,17 @@ class TripleAssociationAnalysis(AssociationAnalysis):
             # Preload lookup data to facilitate rapid checks and filters later
             linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
             self.verifyVirtualItemLinked(itemIdSequence, virtualItemId, linkedItemIdsByBaseId, conn=conn);
+            candidateItemIds = self.loadCandidateItemIds(conn=conn);
 
             # Keep an in memory buffer of the updates to be done so can stall and submit them
             #   to the database in batch to minimize inefficient DB hits
-            updateBuffer = dict();
+            updateBuffer = self.makeUpdateBuffer();
             log.info("Main patient item query...")
             analysisOptions = AnalysisOptions();
             analysisOptions.patientIds = patientIds;
             for iPatient, patientItemList in enumerate(self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn)):
                 log.debug("Calculate associations for Patient %d's %d patient items" % (iPatient, len(patientItemList)) );
-                self.updateItemAssociationsBuffer(itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId, progress=progress);
+                self.updateItemAssociationsBuffer(itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId, progress=progress, candidateItemIds=candidateItemIds);
                 # Periodically send a quick arbitrary query to DB, otherwise connection may get recycled because DB thinks timeout with no interaction
                 DBUtil.execute("select 1+1", conn=conn);
             log.info("Final commit");
@@ -70,7 +75,20 @@ class TripleAssociationAnalysis(AssociationAnalysis):
             conn.close();
         # progress.PrintStatus();
 
-    def updateItemAssociationsBuffer(self, itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId=None, progress=None):
+    def loadCandidateItemIds(self, conn=None):
+        """Set of clinical item IDs with enough support (minPatientCount) to consider as the starting items of triple sequences.
+        None if no support threshold, in which case all items are candidates.
+        """
+        if self.minPatientCount is None:
+            return None;
+        patientCountByItemId = self.dataManager.loadClinicalItemBaseCountByItemId(countPrefix="patient_", conn=conn);
+        candidateItemIds = set();
+        for itemId, patientCount in patientCountByItemId.iteritems():
+            if patientCount is not None and patientCount >= self.minPatientCount:
+                candidateItemIds.add(itemId);
+        return candidateItemIds;
+
+    def updateItemAssociationsBuffer(self, itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId=None, progress=None, candidateItemIds=None):
         """Given a list of data on patient clinical items,
         ordered by item event date, increment information in the
         updateBuffer to inform subsequent updates to the clinical_item_association
@@ -79,54 +97,59 @@ class TripleAssociationAnalysis(AssociationAnalysis):
         Looking for specific triple sequences only though with items followed by those specified
         in the itemIdSequence.  If a triple sequence is found, then mark the end point as
         a virtualItem instance for counting associations.
-        """
-        # Keep track of which items to mark as newly analyzed
-        newlyAnalyzedPatientItemIdSet = set();
 
-        # Keep track of which subsequent items have been analyzed, so we don't count further duplicates (just the first ones found)
-        subsequentItemIds = set();
+        Rather than checking every item pair against every mid-sequence item,
+        only end-sequence items are considered as the second item of a pair,
+        and a sorted array of mid-sequence item dates is binary searched to find
+        the earliest end-sequence item that can complete a triple from each starting item.
+        If candidateItemIds is provided, only those items are considered as starting items.
+        """
         # Keep track of all item pairs encountered to avoid counting patient level duplicates
         encounterIdPairsByItemIdPair = dict();
 
-        # Track where the mid-sequence items occur for easy comparison later
-        midSequenceItemDates = set();
-        for patientItem in patientItemList:
-            if patientItem["clinical_item_id"] == itemIdSequence[0]:
-                midSequenceItemDates.add(patientItem["item_date"]);
+        # Track where the mid-sequence and end-sequence items occur (patient items are in chronological order)
+        midSequenceItemDates = sorted(set([patientItem["item_date"] for patientItem in patientItemList if patientItem["clinical_item_id"] == itemIdSequence[0]]));
+        endSequenceItems = [patientItem for patientItem in patientItemList if patientItem["clinical_item_id"] == itemIdSequence[-1]];
+        endSequenceItemDates = [patientItem["item_date"] for patientItem in endSequenceItems];
         endSequenceItemsByPatientItemId = dict();
 
-        # Main nested loop to look for associations
+        # Main loop to look for associations
         for iItem1, patientItem1 in enumerate(patientItemList):
-            subsequentItemIds.clear();
+            if progress is not None:
+                progress.Update();
+            if candidateItemIds is not None and patientItem1["clinical_item_id"] not in candidateItemIds:
+                continue;   # Not enough support to bother counting
+
+            # Earliest mid-sequence item on or after the starting item. Any end-sequence item on or after that completes a triple
+            iMidDate = bisect.bisect_left(midSequenceItemDates, patientItem1["item_date"]);
+            if iMidDate >= len(midSequenceItemDates):
+                continue;   # No subsequent mid-sequence item, so no triples can start from here
+            iFirstEndItem = bisect.bisect_left(endSequenceItemDates, midSequenceItemDates[iMidDate]);
 
-            for iItem2, patientItem2 in enumerate(patientItemList):
+            isNewSubsequentItem = True; # Only the first triple found for each starting item counts as new
+            for patientItem2 in endSequenceItems[iFirstEndItem:]:
                 itemIdPair = (patientItem1["clinical_item_id"], virtualItemId);
                 encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
 
                 # Verify is not a previously linked item pair, in which case no meaningful asssociation stats to calculate
                 #   and that the item dates are in non-negative direction
                 isPairToAnalyze = self.acceptableClinicalItemPair(patientItem1, patientItem2, linkedItemIdsByBaseId);
-                if isPairToAnalyze and self.isTripleSequence(patientItem1, patientItem2, midSequenceItemDates, itemIdSequence):
+                if isPairToAnalyze:
                     # Record the stat update
-                    isNewSubsequentItem = virtualItemId not in subsequentItemIds;   # Track repeats
                     isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
                     isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);    # Pair ever seen for a common encounter combination
 
                     self.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, itemIdPair=itemIdPair );
 
-                    subsequentItemIds.add(virtualItemId);
+                    isNewSubsequentItem = False;
                     endSequenceItemsByPatientItemId[patientItem2["patient_item_id"]] = patientItem2;
 
                     if itemIdPair not in encounterIdPairsByItemIdPair:
                         encounterIdPairsByItemIdPair[itemIdPair] = set();
                     encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
 
-            # Update progress meter if available
-            if progress is not None:
-                progress.Update();
-
         # Separate pass to get virtual item baseline counts.  Cannot be done directly, since the virtual items do not actually exist in the raw data
-        subsequentItemIds.clear();
+        subsequentItemIds = set();
         for iItem1, patientItem1 in enumerate(endSequenceItemsByPatientItemId.itervalues()):
             for iItem2, patientItem2 in enumerate(endSequenceItemsByPatientItemId.itervalues()):
                 itemIdPair = (virtualItemId, virtualItemId);
@@ -155,7 +178,10 @@ class TripleAssociationAnalysis(AssociationAnalysis):
                 linkedItemIdsByBaseId[virtualItemId] = set();
 
             for componentId in itemIdSequence:
-                if componentId not in linkedItemIdsByBaseId[virtualItemId]:
+                if (virtualItemId, componentId) in self.verifiedVirtualItemLinks:
+                    # Already verified (or created) the link on a prior call, just ensure it is in the in memory lookup
+                    linkedItemIdsByBaseId[virtualItemId].add(componentId);
+                elif componentId not in linkedItemIdsByBaseId[virtualItemId]:
                     linkModel = RowItemModel();
                     linkModel["clinical_item_id"] = virtualItemId;
                     linkModel["linked_item_id"] = componentId;
@@ -165,32 +191,11 @@ class TripleAssociationAnalysis(AssociationAnalysis):
                     DBUtil.execute( insertQuery, insertParams, conn=conn);
 
                     linkedItemIdsByBaseId[virtualItemId].add(componentId);
+                self.verifiedVirtualItemLinks.add( (virtualItemId, componentId) );
         finally:
             if not extConn:
                 conn.close();
 
-    def isTripleSequence(self, patientItem1, patientItem2, midSequenceItemDates, itemIdSequence):
-        """Assess whether the pair of items represents an acceptable triple sequence.
-        Is so if end point matches the end of the itemIdSequence, and there exists a mid-sequence
-        item in the intervening time, as previously tracked by the midSequenceItemDates.
-
-        Assume previous check has already confirmed that the item pairs are not previously linked,
-        and that there is a non-negative / forward direction in the relationship
-        """
-        itemId1 = patientItem1["clinical_item_id"]
-        itemId2 = patientItem2["clinical_item_id"]
-
-        isAcceptable = True;
-        isAcceptable = isAcceptable and itemId2 == itemIdSequence[-1];
-
-        foundMidSequenceDate = False;
-        for midDate in midSequenceItemDates:
-            if patientItem1["item_date"] <= midDate and midDate <= patientItem2["item_date"]:
-                foundMidSequenceDate = True;
-                break;  # Don't need to keep looking
-        isAcceptable = isAcceptable and foundMidSequenceDate;
-        return isAcceptable;
-
     def main(self, argv):
         """Main method, callable from command line"""
         usageStr =  "usage: %prog [options] <patientIds>\n"+\
@@ -198,6 +203,7 @@ class TripleAssociationAnalysis(AssociationAnalysis):
         parser = OptionParser(usage=usageStr)
         parser.add_option("-s", "--itemIdSequence", dest="itemIdSequence", help="Comma-separated sequence of item IDs to look for as representing the end of a triple of interest.")
         parser.add_option("-v", "--virtualItemId", dest="virtualItemId", help="ID of virtual clinical item to record against if find a specified triple.")
+        parser.add_option("-m", "--minPatientCount", dest="minPatientCount", help="If provided, only consider items recorded for at least this many patients (based on prior association analysis counts) as the start of triple sequences. Skips counting long tail items to save time on patients with many items.")
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -215,6 +221,8 @@ class TripleAssociationAnalysis(AssociationAnalysis):
 
         itemIdSequence = [int(idStr) for idStr in options.itemIdSequence.split(",")];
         virtualItemId = int(options.virtualItemId);
+        if options.minPatientCount is not None:
+            self.minPatientCount = float(options.minPatientCount);
 
         self.analyzePatientItems(patientIds, itemIdSequence, virtualItemId);
 
@@ -2,9 +2,12 @@
 """Test case for respective module in application package"""
 
 import sys, os
+import json
+import shutil, tempfile
 from cStringIO import StringIO
-from datetime import datetime;
+from datetime import datetime, timedelta;
 import unittest
+import numpy as np;
 
 from Const import LOGGER_LEVEL, RUNNER_VERBOSITY;
 from Util import log;
@@ -14,7 +17,10 @@ from medinfo.db.test.Util import DBTestCase;
 from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 
-from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
+from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions, parseHistogram;
+import medinfo.cpoe.AssociationAnalysis as AssociationAnalysisModule;
+from medinfo.cpoe.ItemRecommender import RecommenderQuery, ItemAssociationRecommender;
+from medinfo.cpoe.Const import DELTA_NAME_BY_SECONDS, COUNT_PREFIX_OPTIONS, HISTOGRAM_BIN_SECONDS;
 
 class TestAssociationAnalysis(DBTestCase):
     def setUp(self):
@@ -101,6 +107,7 @@ class TestAssociationAnalysis(DBTestCase):
 
         DBUtil.execute("delete from clinical_item_link where clinical_item_id < 0");
         DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("delete from clinical_item_association_histogram where clinical_item_id < 0");
         DBUtil.execute("delete from patient_item where patient_item_id < 0");
         DBUtil.execute("delete from clinical_item where clinical_item_id < 0");
         DBUtil.execute("delete from clinical_item_category where clinical_item_category_id in (%s)" % str.join(",", self.clinicalItemCategoryIdStrList) );
@@ -591,6 +598,723 @@ class TestAssociationAnalysis(DBTestCase):
         associationStats = DBUtil.execute(encounterAssociationQuery);
         self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
 
+    def test_analyzePatientItems_parallel(self):
+        # Counting patient shards in parallel worker processes should yield the same results as the serial analysis
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        serialAssociationStats = DBUtil.execute(associationQuery);
+        # Drop the primary key column, as will be regenerated
+        serialAssociationStats = [row[1:] for row in serialAssociationStats];
+
+        # Reset and repeat with worker processes
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        self.analyzer.nWorkers = 2; # Patients split into 2 shards whose partial buffers are merged before commit
+        self.analyzer.analyzePatientItems( analysisOptions );
+        parallelAssociationStats = DBUtil.execute(associationQuery);
+        parallelAssociationStats = [row[1:] for row in parallelAssociationStats];
+
+        self.assertTrue( len(serialAssociationStats) > 0 );
+        self.assertEqualTable( serialAssociationStats, parallelAssociationStats );
+
+        # Reset and repeat with only date filters (empty patient list, as command-line main provides), so patients must be queried for
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = list();
+        analysisOptions.startDate = datetime(2000,1,1);
+        analysisOptions.endDate = datetime(2000,3,1);
+        self.analyzer.analyzePatientItems( analysisOptions );
+        dateFilterAssociationStats = DBUtil.execute(associationQuery);
+        dateFilterAssociationStats = [row[1:] for row in dateFilterAssociationStats];
+        self.assertEqualTable( serialAssociationStats, dateFilterAssociationStats );
+
+    def test_analyzePatientItems_parallelIntervalCommit(self):
+        # Parallel runs with patientsPerCommit should persist after each shard, not just once at the end
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0 and count_any > 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        expectedAssociationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        # Reset and repeat with worker processes, recording each persist
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        persistPatientIndexes = list();
+        persistUpdateBuffer = self.analyzer.persistUpdateBuffer;
+        def recordPersistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient=None, conn=None):
+            persistPatientIndexes.append(iPatient);
+            return persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient, conn=conn);
+        self.analyzer.persistUpdateBuffer = recordPersistUpdateBuffer;
+
+        self.analyzer.nWorkers = 2;
+        self.analyzer.patientsPerCommit = 2;    # Shards of 2 and 1 patients
+        self.analyzer.analyzePatientItems( analysisOptions );
+        self.assertEqual( [1, -1], persistPatientIndexes ); # Interval commit after the first shard, then the final commit
+
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        self.assertTrue( len(expectedAssociationStats) > 0 );
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+    def test_analyzePatientItems_bulkCommit(self):
+        # Set-based commit of increments through a staging table should yield the same results as per item pair updates
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+
+        # Two separate runs to verify increments on top of existing records
+        analysisOptionsList = [AnalysisOptions(), AnalysisOptions()];
+        analysisOptionsList[0].patientIds = [-11111, -22222];
+        analysisOptionsList[1].patientIds = [-11111, -22222, -33333];
+        for analysisOptions in analysisOptionsList:
+            self.analyzer.analyzePatientItems( analysisOptions );
+        expectedAssociationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        # Reset and repeat with bulk commits
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        self.analyzer.bulkCommit = True;
+        for analysisOptions in analysisOptionsList:
+            self.analyzer.analyzePatientItems( analysisOptions );
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        self.assertTrue( len(expectedAssociationStats) > 0 );
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+    def test_prepareItemAssociations_existingPairs(self):
+        # Baseline records should still be prepared for all missing pairs when some of the candidate pairs already exist or collide
+        associationQuery = \
+            """
+            select clinical_item_id, subsequent_item_id, count_any
+            from clinical_item_association
+            where clinical_item_id < 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        expectedAssociationStats = DBUtil.execute(associationQuery);
+
+        # Reset, but with some of the candidate pairs already recorded (e.g., by a parallel process)
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+        for (itemId1, itemId2) in [(-4,-4), (-4,-10), (-10,-8), (-6,-11)]:
+            DBUtil.findOrInsertItem("clinical_item_association", {"clinical_item_id": itemId1, "subsequent_item_id": itemId2} );
+        self.assertEqual( 4, DBUtil.execute("select count(*) from clinical_item_association where clinical_item_id < 0")[0][0] );
+
+        self.analyzer.analyzePatientItems( analysisOptions );
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+        # Candidate pairs colliding within the same insert should be skipped, without dropping the other new pairs
+        conn = DBUtil.connection();
+        try:
+            itemIdPairs = [(-4,-10), (-7,-2), (-7,-2), (-2,-7)];  # Items never observed together for a patient
+            self.analyzer.prepareItemAssociations(itemIdPairs, dict(), conn, allCombinations=False);
+            conn.commit();
+        finally:
+            conn.close();
+        associationStats = DBUtil.execute("select clinical_item_id, subsequent_item_id, count_any from clinical_item_association where clinical_item_id in (-7,-2) and subsequent_item_id in (-7,-2) and clinical_item_id <> subsequent_item_id order by clinical_item_id");
+        self.assertEqualTable( [[-7,-2,0], [-2,-7,0]], associationStats );
+
+    def test_analyzePatientItems_phaseProfile(self):
+        # Phase profile should track the rows and associations processed in each phase
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+
+        nPatientItems = DBUtil.execute("select count(*) from patient_item as pi, clinical_item as ci where pi.clinical_item_id = ci.clinical_item_id and ci.analysis_status <> 0 and patient_id in (-11111, -22222, -33333)")[0][0];
+        nAnalyzedItems = DBUtil.execute("select count(*) from patient_item where analyze_date is not null and patient_id in (-11111, -22222, -33333)")[0][0];
+        nAssociations = DBUtil.execute("select count(*) from clinical_item_association where clinical_item_id < 0")[0][0];
+
+        phaseSummaryByName = dict( [(phaseSummary["phase"], phaseSummary) for phaseSummary in self.analyzer.profiler.summary()["phases"]] );
+        for phaseName in ("query","counting","baseline","increments","markAnalyzed","dbCommit"):
+            self.assertTrue( phaseSummaryByName[phaseName]["calls"] > 0 );
+            self.assertTrue( phaseSummaryByName[phaseName]["seconds"] >= 0.0 );
+        self.assertEqual( nPatientItems, phaseSummaryByName["query"]["rows"] );
+        self.assertEqual( nPatientItems, phaseSummaryByName["counting"]["rows"] );
+        self.assertEqual( nAnalyzedItems, phaseSummaryByName["markAnalyzed"]["rows"] );
+        self.assertEqual( phaseSummaryByName["counting"]["associations"], phaseSummaryByName["increments"]["associations"] );
+        self.assertTrue( phaseSummaryByName["baseline"]["associations"] <= nAssociations );
+
+        # Machine-readable summary file
+        (fd, profileFilename) = tempfile.mkstemp(suffix=".json");
+        os.close(fd);
+        try:
+            self.analyzer.profiler.writeSummary(profileFilename);
+            profile = json.load(open(profileFilename));
+        finally:
+            os.remove(profileFilename);
+        self.assertEqual( [phaseSummary["phase"] for phaseSummary in self.analyzer.profiler.summary()["phases"]], [phaseSummary["phase"] for phaseSummary in profile["phases"]] );
+
+    def test_binaryBufferFiles(self):
+        # Save update buffers in binary format and merge them back with the streaming merge.
+        #   Should be equivalent to merging them in memory, in item pair key order
+        bufferOne = self.analyzer.makeUpdateBuffer();
+        bufferTwo = self.analyzer.makeUpdateBuffer();
+        patientItemLists = list(self.analyzer.queryPatientItemsPerPatient(AnalysisOptions()));
+        self.analyzer.updateItemAssociationsBuffer(patientItemLists[0], bufferOne, None);
+        self.analyzer.updateItemAssociationsBuffer(patientItemLists[1], bufferTwo, None);
+        self.analyzer.updateItemAssociationsBuffer(patientItemLists[2], bufferTwo, None);
+
+        expectedBuffer = self.analyzer.mergeBuffers( self.analyzer.mergeBuffers(self.analyzer.makeUpdateBuffer(), bufferOne), bufferTwo );
+        expectedDataByItemIdPair = dict();
+        for iRow, itemIdPair in enumerate(self.analyzer.bufferItemIdPairs(expectedBuffer)):
+            expectedDataByItemIdPair[itemIdPair] = expectedBuffer["incrementData"][iRow].tolist();
+        expectedAnalyzedIds = set(expectedBuffer["analyzedPatientItemIds"]);
+
+        self.analyzer.saveBufferToBinaryFile(self.bufferFilename+".0.npy", bufferOne);
+        self.analyzer.saveBufferToBinaryFile(self.bufferFilename+".1.npy", bufferTwo);
+        self.assertEqual( 0, bufferOne["nAssociations"] );  # Buffer reset after save
+
+        mergeBuffer = self.analyzer.loadUpdateBufferFromFile(self.bufferFilename);
+        itemIdPairs = self.analyzer.bufferItemIdPairs(mergeBuffer);
+        self.assertEqual( sorted(expectedDataByItemIdPair.keys()), sorted(itemIdPairs) );
+        self.assertEqual( expectedAnalyzedIds, mergeBuffer["analyzedPatientItemIds"] );
+        for iRow, itemIdPair in enumerate(itemIdPairs):
+            self.assertEqual( expectedDataByItemIdPair[itemIdPair], mergeBuffer["incrementData"][iRow].tolist() );
+            self.assertEqual( iRow, self.analyzer.bufferRowIndex(mergeBuffer, itemIdPair[0], itemIdPair[-1]) );
+
+        # Committing the files directly streams the merge in blocks, which should match committing the merged buffer
+        associationQuery = "select * from clinical_item_association where clinical_item_id < 0 order by clinical_item_id, subsequent_item_id";
+        self.analyzer.commitUpdateBuffer(mergeBuffer, self.analyzer.dataManager.loadLinkedItemIdsByBaseId());
+        expectedAssociationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        originalMergeBlockSize = AssociationAnalysisModule.MERGE_BLOCK_SIZE;
+        AssociationAnalysisModule.MERGE_BLOCK_SIZE = 2;  # Many small blocks
+        try:
+            self.analyzer.commitUpdateBufferFromFile(self.bufferFilename);
+        finally:
+            AssociationAnalysisModule.MERGE_BLOCK_SIZE = originalMergeBlockSize;
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        self.assertTrue( len(expectedAssociationStats) > 0 );
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+        nAnalyzedItems = DBUtil.execute("select count(*) from patient_item where analyze_date is not null and patient_item_id < 0")[0][0];
+        self.assertEqual( len(expectedAnalyzedIds), nAnalyzedItems );
+
+    def test_analyzePatientItems_spillBuffer(self):
+        # Spilling the update buffer to disk when over memory budget should not change results
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        expectedAssociationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        # Reset and repeat with tiny memory budget, so every patient's results get spilled to a separate run file
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        spillDir = tempfile.mkdtemp();
+        analysisOptions.maxBufferMemory = 1;
+        analysisOptions.spillDir = spillDir;
+        originalMergeBlockSize = AssociationAnalysisModule.MERGE_BLOCK_SIZE;
+        AssociationAnalysisModule.MERGE_BLOCK_SIZE = 2;  # Run files merged and committed in many small blocks
+        try:
+            self.analyzer.analyzePatientItems( analysisOptions );
+            self.assertEqual( [], os.listdir(spillDir) );   # Run files cleaned up after merge
+        finally:
+            AssociationAnalysisModule.MERGE_BLOCK_SIZE = originalMergeBlockSize;
+            shutil.rmtree(spillDir);
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        self.assertTrue( len(expectedAssociationStats) > 0 );
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+        # Repeat should not change results, as analyze dates recorded from spilled buffers
+        self.analyzer.analyzePatientItems( analysisOptions );
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+        # Reset and repeat, with the spilled runs merged into a binary buffer file, then committed from that
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        spillDir = tempfile.mkdtemp();
+        analysisOptions.spillDir = spillDir;
+        analysisOptions.bufferFile = self.bufferFilename;
+        analysisOptions.binaryBufferFile = True;
+        try:
+            self.analyzer.analyzePatientItems( analysisOptions );
+            self.assertEqual( [], os.listdir(spillDir) );
+        finally:
+            shutil.rmtree(spillDir);
+        self.analyzer.commitUpdateBufferFromFile(self.bufferFilename);
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+    def test_analyzePatientItems_checkpointResume(self):
+        # Interrupted run should be able to resume from checkpoint without repeating or double counting patients
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+
+        self.analyzer.patientsPerCommit = 1;    # Commit (and checkpoint) after every patient
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        expectedAssociationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        # Reset and repeat, but simulate a failure after the second patient's commit
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        checkpointFilename = self.bufferFilename+".checkpoint";
+        analysisOptions.checkpointFile = checkpointFilename;
+
+        class SimulatedFailure(Exception): pass;
+        analyzedPatientIds = list();
+        originalUpdateItemAssociationsBuffer = self.analyzer.updateItemAssociationsBuffer;
+        def failingUpdateItemAssociationsBuffer(patientItemList, *args, **kwargs):
+            if len(analyzedPatientIds) >= 2:
+                raise SimulatedFailure();
+            analyzedPatientIds.append(patientItemList[0]["patient_id"]);
+            return originalUpdateItemAssociationsBuffer(patientItemList, *args, **kwargs);
+        self.analyzer.updateItemAssociationsBuffer = failingUpdateItemAssociationsBuffer;
+        self.assertRaises( SimulatedFailure, self.analyzer.analyzePatientItems, analysisOptions );
+        self.assertTrue( os.path.exists(checkpointFilename) );
+
+        # Resume should only need to go through the last patient (patients ordered by ID)
+        resumedPatientIds = list();
+        def trackingUpdateItemAssociationsBuffer(patientItemList, *args, **kwargs):
+            resumedPatientIds.append(patientItemList[0]["patient_id"]);
+            return originalUpdateItemAssociationsBuffer(patientItemList, *args, **kwargs);
+        self.analyzer.updateItemAssociationsBuffer = trackingUpdateItemAssociationsBuffer;
+        self.analyzer.analyzePatientItems( analysisOptions );
+        self.assertEqual( [-11111], resumedPatientIds );
+        self.assertFalse( os.path.exists(checkpointFilename) ); # Cleared once complete
+
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+    def test_analyzePatientItems_parallelCheckpointResume(self):
+        # Parallel resume should pick up after the checkpoint's last completed patient,
+        #   even if the shard size (and so the number of shards completed) differs from the interrupted run.
+        #   Only compare associations with counts, as interval commits only prepare baseline records for item combinations within each interval.
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0 and count_any > 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        expectedAssociationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        # Reset and simulate an interrupted run that completed the first two patients (ordered by ID), one shard each
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+        completedOptions = AnalysisOptions();
+        completedOptions.patientIds = [-33333, -22222];
+        self.analyzer.analyzePatientItems( completedOptions );
+        # Clear analyze dates, so any patient analyzed again would be double counted
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        checkpointFilename = self.bufferFilename+".checkpoint";
+        analysisOptions.checkpointFile = checkpointFilename;
+        self.analyzer.saveCheckpoint(analysisOptions, nPatients=2, lastPatientId=-22222);
+
+        # Resume with larger shards than the interrupted run
+        self.analyzer.nWorkers = 2;
+        self.analyzer.patientsPerCommit = 2;
+        self.analyzer.analyzePatientItems( analysisOptions );
+        self.assertFalse( os.path.exists(checkpointFilename) ); # Cleared once complete
+
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+        # Reset and actually interrupt a parallel run with multiple patients per shard, after its first shard is committed
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        persistUpdateBuffer = self.analyzer.persistUpdateBuffer;
+        def interruptedPersistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient=None, conn=None):
+            if iPatient == -1:
+                raise KeyboardInterrupt("Simulated interruption before the final commit");
+            return persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient, conn=conn);
+        self.analyzer.persistUpdateBuffer = interruptedPersistUpdateBuffer;
+        self.assertRaises( KeyboardInterrupt, self.analyzer.analyzePatientItems, analysisOptions );
+
+        checkpoint = self.analyzer.loadCheckpoint(analysisOptions);
+        self.assertEqual( 2, checkpoint["nPatients"] );
+        self.assertEqual( -22222, checkpoint["lastPatientId"] );    # First shard of the 2 lowest patient IDs
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        # Resume should only analyze the remaining patient
+        self.analyzer.persistUpdateBuffer = persistUpdateBuffer;
+        self.analyzer.analyzePatientItems( analysisOptions );
+        self.assertFalse( os.path.exists(checkpointFilename) );
+
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+    def test_analyzePatientItems_sketch(self):
+        # Approximate counting with a count-min sketch should match exact counts when wide enough to avoid collisions,
+        #   and otherwise only overestimate
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        linkedItemIdsByBaseId = self.analyzer.dataManager.loadLinkedItemIdsByBaseId();
+        exactBuffer = self.analyzer.accumulatePatientItems(analysisOptions, self.analyzer.makeUpdateBuffer(), linkedItemIdsByBaseId);
+        columnIndex = dict( [(columnName, iColumn) for iColumn, columnName in enumerate(exactBuffer["columnNames"])] );
+
+        analysisOptions.sketchWidth = 1 << 16;
+        sketchBuffer = self.analyzer.accumulatePatientItems(analysisOptions, self.analyzer.makeUpdateBuffer(analysisOptions=analysisOptions), linkedItemIdsByBaseId);
+        self.assertEqual( 0, sketchBuffer["nAssociations"] );   # Nothing in buffer rows until materialized
+        self.assertTrue( self.analyzer.materializeSketch(sketchBuffer) > 0 );
+        accuracy = self.analyzer.bufferAccuracy(exactBuffer, sketchBuffer);
+        self.assertTrue( accuracy["nExact"] > 0 );
+        self.assertEqual( accuracy["nExact"], accuracy["nApproximate"] );
+        self.assertEqual( 1.0, accuracy["recall"] );
+        self.assertEqual( 1.0, accuracy["precision"] );
+        self.assertEqual( 0.0, accuracy["maxAbsoluteError"] );
+
+        # Tiny sketch forces collisions. Should still find every supported pair, but with overestimates
+        analysisOptions.sketchWidth = 4;
+        analysisOptions.sketchMinSupport = 2;
+        sketchBuffer = self.analyzer.accumulatePatientItems(analysisOptions, self.analyzer.makeUpdateBuffer(analysisOptions=analysisOptions), linkedItemIdsByBaseId);
+        self.analyzer.materializeSketch(sketchBuffer);
+        accuracy = self.analyzer.bufferAccuracy(exactBuffer, sketchBuffer, minSupport=2);
+        self.assertEqual( 1.0, accuracy["recall"] );
+        self.assertTrue( accuracy["maxAbsoluteError"] > 0.0 );
+        exactRowIndexByItemIdPair = dict( [(itemIdPair, iRow) for iRow, itemIdPair in enumerate(self.analyzer.bufferItemIdPairs(exactBuffer))] );
+        for iRow, itemIdPair in enumerate(self.analyzer.bufferItemIdPairs(sketchBuffer)):
+            self.assertTrue( sketchBuffer["incrementData"][iRow,columnIndex["patient_count_any"]] >= 2 );
+            if itemIdPair in exactRowIndexByItemIdPair:
+                self.assertTrue( (sketchBuffer["incrementData"][iRow] >= exactBuffer["incrementData"][exactRowIndexByItemIdPair[itemIdPair]]).all() );
+
+        # End to end, wide sketch should yield the same stored supported associations as exact counting
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0 and patient_count_any > 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        expectedAssociationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        analysisOptions.sketchWidth = 1 << 16;
+        self.analyzer.analyzePatientItems( analysisOptions );
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+        self.assertTrue( len(expectedAssociationStats) > 0 );
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+    def test_analyzePatientItems_minCount(self):
+        # Item pairs below minimum counts should be dropped before commit, and stored records below them deleted,
+        #   leaving the rest (and the item base counts) as if without pruning
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-11111, -22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        columnNames = DBUtil.execute(associationQuery, includeColumnNames=True)[0];
+        (countAnyIndex, patientCountIndex) = (columnNames.index("count_any")-1, columnNames.index("patient_count_86400")-1);
+        allAssociationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        # Reset and repeat with pruning
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+
+        analysisOptions.minCount = 2;
+        analysisOptions.minCountByColumn = {"patient_count_86400": 1};
+        self.analyzer.analyzePatientItems( analysisOptions );
+        associationStats = [row[1:] for row in DBUtil.execute(associationQuery)];
+
+        expectedAssociationStats = [row for row in allAssociationStats if row[0] == row[1] or (row[countAnyIndex] >= 2 and row[patientCountIndex] >= 1)];
+        self.assertTrue( 0 < len(expectedAssociationStats) < len(allAssociationStats) );
+        self.assertEqualTable( expectedAssociationStats, associationStats );
+
+        # Buffer pruning alone
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+        updateBuffer = self.analyzer.makeUpdateBuffer();
+        for patientItemList in self.analyzer.queryPatientItemsPerPatient(AnalysisOptions()):
+            self.analyzer.updateItemAssociationsBuffer(patientItemList, updateBuffer, None);
+        nAssociations = updateBuffer["nAssociations"];
+        nPruned = self.analyzer.pruneUpdateBuffer(updateBuffer, analysisOptions);
+        self.assertTrue( 0 < nPruned < nAssociations );
+        self.assertEqual( nAssociations-nPruned, updateBuffer["nAssociations"] );
+        columnIndex = dict( [(columnName, iColumn) for iColumn, columnName in enumerate(updateBuffer["columnNames"])] );
+        for iRow, (itemId1, itemId2) in enumerate(self.analyzer.bufferItemIdPairs(updateBuffer)):
+            self.assertEqual( iRow, self.analyzer.bufferRowIndex(updateBuffer, itemId1, itemId2) );
+            if itemId1 != itemId2:
+                self.assertTrue( updateBuffer["incrementData"][iRow,columnIndex["count_any"]] >= 2 );
+
+        analysisOptions.minCountByColumn = {"count_bogus": 1};
+        self.assertRaises( ValueError, self.analyzer.pruneItemAssociations, analysisOptions );
+
+    def test_analyzePatientItems_minCountIntervals(self):
+        # Item pairs already stored by a prior interval commit should keep accumulating increments,
+        #   even if the next interval's increments alone are below the minimum counts
+        headers = ["patient_item_id","encounter_id","patient_id","clinical_item_id","item_date"];
+        dataModels = \
+            [   RowItemModel( [-20, -100, -10000, -4,  datetime(2000, 3, 1, 0)], headers ),
+                RowItemModel( [-21, -100, -10000, -10, datetime(2000, 3, 1, 1)], headers ),
+            ];
+        for dataModel in dataModels:
+            DBUtil.findOrInsertItem("patient_item", dataModel );
+
+        countQuery = "select count_any from clinical_item_association where clinical_item_id = -4 and subsequent_item_id = -10";
+
+        # Two intervals (commits) for the same pair
+        analysisOptions = AnalysisOptions();
+        analysisOptions.minCount = 2;
+        analysisOptions.patientIds = [-11111];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        self.assertEqual( 2, DBUtil.execute(countQuery)[0][0] );
+
+        analysisOptions.patientIds = [-10000];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        self.assertEqual( 3, DBUtil.execute(countQuery)[0][0] );
+
+        # Same with interval commits within a single run (patients ordered by ID)
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+        self.analyzer.patientsPerCommit = 1;
+        analysisOptions.patientIds = [-11111, -10000];
+        self.analyzer.analyzePatientItems( analysisOptions );
+        self.assertEqual( 3, DBUtil.execute(countQuery)[0][0] );
+
+    def test_analyzePatientItems_histogramStorage(self):
+        # Time delta histograms per item pair should yield the same counts for every time window (as prefix sums)
+        #   as the cumulative window count columns, while item base counts remain in clinical_item_association
+        associationQuery = \
+            """
+            select *
+            from clinical_item_association
+            where clinical_item_id < 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+        histogramQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                histogram, patient_histogram, encounter_histogram,
+                time_diff_sum, patient_time_diff_sum, encounter_time_diff_sum
+            from clinical_item_association_histogram
+            where clinical_item_id < 0
+            order by clinical_item_id, subsequent_item_id
+            """;
+        recommender = ItemAssociationRecommender();
+        recQuery = RecommenderQuery();
+        recQuery.queryItemIds = set([-10]);
+        recQuery.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+
+        # Two separate runs to verify increments on top of existing records
+        analysisOptionsList = [AnalysisOptions(), AnalysisOptions()];
+        analysisOptionsList[0].patientIds = [-11111, -22222];
+        analysisOptionsList[1].patientIds = [-11111, -22222, -33333];
+        for analysisOptions in analysisOptionsList:
+            self.analyzer.analyzePatientItems( analysisOptions );
+        resultTable = DBUtil.execute(associationQuery, includeColumnNames=True);
+        columnNames = resultTable[0];
+        expectedModelByItemIdPair = dict();
+        for row in resultTable[1:]:
+            expectedModelByItemIdPair[(row[1],row[2])] = RowItemModel(row, columnNames);
+        expectedRecsByWindow = dict();
+        for timeDeltaMax in (None, timedelta(0,86400), timedelta(0,2592000)):
+            recQuery.timeDeltaMax = timeDeltaMax;
+            expectedRecsByWindow[timeDeltaMax] = [(rec["clinical_item_id"], rec["nAB"]) for rec in recommender(recQuery)];
+
+        # Reset and repeat with histogram storage
+        DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("update patient_item set analyze_date = null where patient_item_id < 0");
+        for analysisOptions in analysisOptionsList:
+            analysisOptions.histogramStorage = True;
+            self.analyzer.analyzePatientItems( analysisOptions );
+
+        # Only the diagonal item base counts in the standard table, which should be unchanged
+        resultTable = DBUtil.execute(associationQuery, includeColumnNames=True);
+        for row in resultTable[1:]:
+            resultModel = RowItemModel(row, columnNames);
+            self.assertEqual( resultModel["clinical_item_id"], resultModel["subsequent_item_id"] );
+            expectedModel = expectedModelByItemIdPair[(resultModel["clinical_item_id"], resultModel["subsequent_item_id"])];
+            for columnName in columnNames[1:]:
+                self.assertAlmostEqual( expectedModel[columnName], resultModel[columnName] );
+
+        histogramItemIdPairs = set();
+        for row in DBUtil.execute(histogramQuery):
+            itemIdPair = (row[0], row[1]);
+            histogramItemIdPairs.add(itemIdPair);
+            expectedModel = expectedModelByItemIdPair[itemIdPair];
+            for iPrefix, countPrefix in enumerate(COUNT_PREFIX_OPTIONS):
+                cumulativeCounts = np.cumsum(parseHistogram(row[2+iPrefix]));
+                for secondsOption in DELTA_NAME_BY_SECONDS.iterkeys():
+                    self.assertAlmostEqual( expectedModel["%scount_%d" % (countPrefix, secondsOption)], cumulativeCounts[HISTOGRAM_BIN_SECONDS.index(secondsOption)] );
+                self.assertAlmostEqual( expectedModel[countPrefix+"count_any"], cumulativeCounts[-1] );
+                self.assertAlmostEqual( expectedModel[countPrefix+"time_diff_sum"], row[5+iPrefix] );
+        expectedItemIdPairs = set([itemIdPair for itemIdPair, expectedModel in expectedModelByItemIdPair.iteritems() if itemIdPair[0] != itemIdPair[-1] and expectedModel["count_any"] > 0]);
+        self.assertTrue( len(expectedItemIdPairs) > 0 );
+        self.assertEqual( expectedItemIdPairs, histogramItemIdPairs );
+
+        # Recommendations for any time window from the (same cached) histograms
+        recommender = ItemAssociationRecommender();
+        recommender.histogramStorage = True;
+        for timeDeltaMax, expectedRecs in expectedRecsByWindow.iteritems():
+            recQuery.timeDeltaMax = timeDeltaMax;
+            recs = [(rec["clinical_item_id"], rec["nAB"]) for rec in recommender(recQuery)];
+            self.assertTrue( len(recs) > 0 );
+            self.assertEqual( expectedRecs, recs );
+
+    def test_mergeBuffers(self):
+        # Merge of separately accumulated update buffers should add counts for shared item pairs and keep the rest
+        analyzer = AssociationAnalysis();
+        patientItem1 = {"clinical_item_id": -2, "item_date": datetime(2000,1,1,0)};
+        patientItem2 = {"clinical_item_id": -3, "item_date": datetime(2000,1,1,2)};
+        patientItem3 = {"clinical_item_id": -4, "item_date": datetime(2000,1,3,0)};
+
+        bufferOne = analyzer.makeUpdateBuffer();
+        bufferOne["analyzedPatientItemIds"].add(-1001);
+        analyzer.updateClinicalItemAssociationBuffer(patientItem1, patientItem2, True, True, False, bufferOne);
+
+        bufferTwo = analyzer.makeUpdateBuffer();
+        bufferTwo["analyzedPatientItemIds"].add(-1002);
+        analyzer.updateClinicalItemAssociationBuffer(patientItem1, patientItem2, False, False, False, bufferTwo);
+        analyzer.updateClinicalItemAssociationBuffer(patientItem1, patientItem3, True, True, True, bufferTwo);
+
+        mergeBuffer = analyzer.mergeBuffers(bufferOne, bufferTwo);
+        self.assertEqual( 2, mergeBuffer["nAssociations"] );
+        self.assertEqual( set([-1001,-1002]), mergeBuffer["analyzedPatientItemIds"] );
+        self.assertEqual( [(-2,-3),(-2,-4)], analyzer.bufferItemIdPairs(mergeBuffer) );
+
+        incrementData = mergeBuffer["incrementData"];
+        columnIndex = dict( [(columnName, iColumn) for iColumn, columnName in enumerate(mergeBuffer["columnNames"])] );
+        self.assertEqual( 2, incrementData[0,columnIndex["count_any"]] );
+        self.assertEqual( 0, incrementData[0,columnIndex["count_3600"]] );
+        self.assertEqual( 2, incrementData[0,columnIndex["count_7200"]] );
+        self.assertEqual( 1, incrementData[0,columnIndex["patient_count_any"]] );
+        self.assertEqual( 0, incrementData[0,columnIndex["encounter_count_any"]] );
+        self.assertEqual( 2*7200, incrementData[0,columnIndex["time_diff_sum"]] );
+        self.assertEqual( 0, incrementData[1,columnIndex["count_86400"]] );
+        self.assertEqual( 1, incrementData[1,columnIndex["encounter_count_172800"]] );
+
+    def test_updateItemAssociationsBuffer_pairwiseEquivalence(self):
+        # Vectorized counting of a patient's item pairs should match checking every pair with updateClinicalItemAssociationBuffer,
+        #   on randomized patient histories with repeated items, multiple encounters, linked items, and time deltas exactly on window boundaries
+        analyzer = AssociationAnalysis();
+        linkedItemIdsByBaseId = {-1: set([-2]), -3: set([-4])};
+        itemSecondsOptions = [0, 1] + DELTA_NAME_BY_SECONDS.keys() + [secondsOption+1 for secondsOption in DELTA_NAME_BY_SECONDS.keys()];
+
+        def pairwiseUpdateItemAssociationsBuffer(patientItemList, updateBuffer, analysisOptions):
+            # Reference implementation checking every ordered item pair one at a time
+            subsequentItemIds = set();
+            encounterIdPairsByItemIdPair = dict();
+            for patientItem1 in patientItemList:
+                subsequentItemIds.clear();
+                for patientItem2 in patientItemList:
+                    itemIdPair = (patientItem1["clinical_item_id"], patientItem2["clinical_item_id"]);
+                    encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
+                    if analyzer.acceptableClinicalItemPair(patientItem1, patientItem2, linkedItemIdsByBaseId):
+                        if patientItem1["analyze_date"] is None or patientItem2["analyze_date"] is None:
+                            isNewSubsequentItem = patientItem2["clinical_item_id"] not in subsequentItemIds;
+                            isNewPair = itemIdPair not in encounterIdPairsByItemIdPair;
+                            isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);
+                            analyzer.updateClinicalItemAssociationBuffer(patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, analysisOptions);
+                            for patientItem in (patientItem1, patientItem2):
+                                if patientItem["analyze_date"] is None:
+                                    updateBuffer["analyzedPatientItemIds"].add(patientItem["patient_item_id"]);
+                        subsequentItemIds.add(patientItem2["clinical_item_id"]);
+                        encounterIdPairsByItemIdPair.setdefault(itemIdPair, set()).add(encounterIdPair);
+
+        def incrementDataByItemIdPair(updateBuffer):
+            nAssociations = updateBuffer["nAssociations"];
+            return dict( zip(analyzer.bufferItemIdPairs(updateBuffer), updateBuffer["incrementData"][:nAssociations].tolist()) );
+
+        windowOptions = AnalysisOptions();
+        windowOptions.deltaSecondsOptions = [3600, 86400];
+        histogramOptions = AnalysisOptions();
+        histogramOptions.histogramStorage = True;
+
+        randomState = np.random.RandomState(0);
+        baseDate = datetime(2000,1,1);
+        for iTrial in xrange(30):
+            nItems = randomState.randint(1, 25);
+            itemSeconds = sorted( randomState.choice(itemSecondsOptions, nItems) );
+            patientItemList = list();
+            for iItem in xrange(nItems):
+                patientItem = \
+                    {   "patient_item_id": -(iItem+1),
+                        "patient_id": -11111,
+                        "encounter_id": -int(randomState.randint(1,4)),
+                        "clinical_item_id": -int(randomState.randint(1,7)),  # Small item set, so plenty of repeats
+                        "item_date": baseDate + timedelta(seconds=int(itemSeconds[iItem])),
+                        "analyze_date": None,
+                    };
+                if randomState.rand() < 0.2:
+                    patientItem["analyze_date"] = baseDate;  # Previously analyzed items
+                patientItemList.append(patientItem);
+
+            for analysisOptions in (None, windowOptions, histogramOptions):
+                expectedBuffer = analyzer.makeUpdateBuffer(analysisOptions=analysisOptions);
+                pairwiseUpdateItemAssociationsBuffer(patientItemList, expectedBuffer, analysisOptions);
+
+                for pairsPerBlock in (AssociationAnalysisModule.PAIRS_PER_BLOCK, 7): # Also split across multiple blocks of item1 rows
+                    originalPairsPerBlock = AssociationAnalysisModule.PAIRS_PER_BLOCK;
+                    AssociationAnalysisModule.PAIRS_PER_BLOCK = pairsPerBlock;
+                    try:
+                        updateBuffer = analyzer.makeUpdateBuffer(analysisOptions=analysisOptions);
+                        analyzer.updateItemAssociationsBuffer(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId);
+                    finally:
+                        AssociationAnalysisModule.PAIRS_PER_BLOCK = originalPairsPerBlock;
+
+                    self.assertEqual( expectedBuffer["analyzedPatientItemIds"], updateBuffer["analyzedPatientItemIds"] );
+                    expectedDataByItemIdPair = incrementDataByItemIdPair(expectedBuffer);
+                    dataByItemIdPair = incrementDataByItemIdPair(updateBuffer);
+                    self.assertEqual( set(expectedDataByItemIdPair), set(dataByItemIdPair) );
+                    for itemIdPair, expectedData in expectedDataByItemIdPair.iteritems():
+                        # Time difference sums of squares may differ in floating point summation order
+                        np.testing.assert_allclose( expectedData, dataByItemIdPair[itemIdPair], rtol=1e-12 );
+
 def suite():
     """Returns the suite of tests to run for this test class / module.
     Use unittest.makeSuite methods which simply extracts all of the
@@ -11,6 +11,7 @@ from Util import log;
 
 from medinfo.db.test.Util import DBTestCase;
 
+from medinfo.common.Util import LRUCache, estimateBytes;
 from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 
@@ -655,6 +656,59 @@ class TestDataManager(DBTestCase):
         self.assertEqualTable(expectedClinicalItemCounts, clinicalItemCounts)
 
 
+    def test_executeCacheOption(self):
+        # Cached query results should be keyed by parameters as well as query text, and bounded by least recently used eviction
+        self.analyzer.dataCache = LRUCache(maxEntries=2);
+        query = "select name from clinical_item where clinical_item_id = %s" % DBUtil.SQL_PLACEHOLDER;
+
+        self.assertEqual( [["CBC"]], self.analyzer.executeCacheOption(query, (-1,)) );
+        self.assertEqual( [["BMP"]], self.analyzer.executeCacheOption(query, (-2,)) );    # Different parameter, not the same cached result
+        self.assertEqual( [["CBC"]], self.analyzer.executeCacheOption(query, (-1,)) );
+        self.assertEqual( 2, self.analyzer.queryCount );
+        self.assertEqual( {"hits": 1, "misses": 2, "evictions": 0}, dict([(key, self.analyzer.dataCache.stats()[key]) for key in ("hits","misses","evictions")]) );
+
+        # Third distinct query evicts the least recently used (-2), not the most recently used (-1)
+        self.assertEqual( [["Hepatic Panel"]], self.analyzer.executeCacheOption(query, (-3,)) );
+        self.assertEqual( [["CBC"]], self.analyzer.executeCacheOption(query, (-1,)) );
+        self.assertEqual( 3, self.analyzer.queryCount );
+        self.assertEqual( [["BMP"]], self.analyzer.executeCacheOption(query, (-2,)) );
+        self.assertEqual( 4, self.analyzer.queryCount );
+        stats = self.analyzer.dataCache.stats();
+        self.assertEqual( 2, stats["entries"] );
+        self.assertEqual( 2, stats["evictions"] );
+
+        # Byte bound, where an entry too large to keep at all is not cached
+        cache = LRUCache(maxBytes=1000, sizeFunction=len);
+        cache["a"] = "x"*400;
+        cache["b"] = "x"*400;
+        cache["c"] = "x"*400;
+        self.assertEqual( ["b","c"], cache.keys() );
+        cache["d"] = "x"*2000;
+        self.assertFalse( "d" in cache );
+        self.assertEqual( 800, cache.stats()["bytes"] );
+        self.assertEqual( 2, cache.stats()["evictions"] );
+
+        # Explicit sizes (e.g., by row count) take the place of the size function
+        cache.put("e", "x"*10, 300);
+        self.assertEqual( ["c","e"], cache.keys() );
+        self.assertEqual( 700, cache.stats()["bytes"] );
+        cache.put("f", "x"*10, 2000);
+        self.assertFalse( "f" in cache );
+        self.assertEqual( 4, cache.stats()["evictions"] );  # "b" evicted to fit "e", and "f" too large to keep
+
+        # Large containers are sized from a sample of their items, close to walking every item
+        table = [[float(i), "name%d" % i, {"count": i}] for i in xrange(10000)];
+        fullBytes = estimateBytes(table, None);
+        self.assertAlmostEqual( 1.0, float(estimateBytes(table)) / fullBytes, 2 );
+        tableByKey = dict([(i, row) for (i, row) in enumerate(table)]);
+        self.assertAlmostEqual( 1.0, float(estimateBytes(tableByKey)) / estimateBytes(tableByKey, None), 2 );
+
+        # Without a cache, always query
+        self.analyzer.dataCache = None;
+        self.analyzer.executeCacheOption(query, (-1,));
+        self.analyzer.executeCacheOption(query, (-1,));
+        self.assertEqual( 6, self.analyzer.queryCount );
+
     def test_resetAssociationModel(self):
 
         self.analyzer.updateClinicalItemCounts();	# Generate clinical item counts based on patient item data
@@ -19,7 +19,7 @@ from medinfo.cpoe.DecayingWindows import DecayingWindows, DecayAnalysisOptions;
 #from medinfo.cpoe.ResetModel import ResetModel;
 from medinfo.cpoe.DataManager import DataManager;
 
-from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
+from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions, parseHistogram;
 
 TEMP_FILENAME = "DWTemp.txt";
 
@@ -109,6 +109,7 @@ class TestDecayingWindows(DBTestCase):
 
         DBUtil.execute("delete from clinical_item_link where clinical_item_id < 0");
         DBUtil.execute("delete from clinical_item_association where clinical_item_id < 0");
+        DBUtil.execute("delete from clinical_item_association_histogram where clinical_item_id < 0");
         DBUtil.execute("delete from patient_item where patient_item_id < 0");
         DBUtil.execute("delete from clinical_item where clinical_item_id < 0");
         DBUtil.execute("delete from clinical_item_category where clinical_item_category_id in (%s)" % str.join(",", self.clinicalItemCategoryIdStrList) );
@@ -144,9 +145,10 @@ class TestDecayingWindows(DBTestCase):
         decayAnalysisOptions.decay = 0.9
         decayAnalysisOptions.delta = timedelta(weeks=4)
         decayAnalysisOptions.patientIds = [-22222, -33333]
-        decayAnalysisOptions.outputFile = TEMP_FILENAME;
+        decayAnalysisOptions.inMemory = True;
 
         self.decayAnalyzer.decayAnalyzePatientItems(decayAnalysisOptions)
+        self.assertFalse( os.path.exists(TEMP_FILENAME) );   # Deltas accumulated in memory, without buffer file round trips
 
         expectedAssociationStats = \
             [
@@ -211,7 +213,7 @@ class TestDecayingWindows(DBTestCase):
         #decayAnalysisOptions.decay = 0.9
         decayAnalysisOptions.delta = timedelta(weeks=4)
         decayAnalysisOptions.patientIds = [-22222, -33333]
-        decayAnalysisOptions.outputFile = TEMP_FILENAME;
+        decayAnalysisOptions.inMemory = True;
 
         self.decayAnalyzer.decayAnalyzePatientItems(decayAnalysisOptions)
 
@@ -371,6 +373,109 @@ class TestDecayingWindows(DBTestCase):
         self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
 
 
+    def test_decayingWindows_lazyDecay(self):
+        # Lazy decay with a global scale factor should yield the same effective counts as rewriting every record each delta
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                patient_count_0, patient_count_3600, patient_count_86400, patient_count_604800,
+                patient_count_2592000, patient_count_7776000, patient_count_31536000,
+                patient_count_any
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        decayAnalysisOptions = DecayAnalysisOptions()
+        decayAnalysisOptions.startD = datetime(2000,1,9)
+        decayAnalysisOptions.endD = datetime(2000,2,11)
+        decayAnalysisOptions.windowLength = 10
+        decayAnalysisOptions.decay = 0.9
+        decayAnalysisOptions.delta = timedelta(weeks=4)
+        decayAnalysisOptions.patientIds = [-22222, -33333]
+
+        self.decayAnalyzer.decayAnalyzePatientItems (decayAnalysisOptions)
+        expectedAssociationStats = [list(row) for row in DBUtil.execute(associationQuery)];
+
+        # Reset and repeat with lazy decay
+        self.dataManager.resetAssociationModel()
+        decayAnalysisOptions.lazyDecay = True
+        self.decayAnalyzer.decayAnalyzePatientItems (decayAnalysisOptions)
+
+        countScale = self.dataManager.getAssociationCountScale();
+        self.assertAlmostEqual( 0.81, countScale ); # Two deltas decayed
+        associationStats = [list(row[:2]) + [value * countScale for value in row[2:]] for row in DBUtil.execute(associationQuery)];
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+        # Summary item counts should also be read through the scale factor
+        self.dataManager.updateClinicalItemCounts();
+        patientCount = DBUtil.execute("select patient_count from clinical_item where clinical_item_id = -11")[0][0];
+        self.assertAlmostEqual( 1.9, patientCount, 3 );
+
+        # Reset and repeat with a minimum scale so records are renormalized at every delta
+        self.dataManager.resetAssociationModel()
+        decayAnalysisOptions.minCountScale = 0.95;
+        self.decayAnalyzer.decayAnalyzePatientItems (decayAnalysisOptions)
+
+        self.assertEqual( 1.0, self.dataManager.getAssociationCountScale() );
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+    def test_decayingWindows_lazyDecayHistograms(self):
+        # Item pair histograms should decay along with the association counts, both when rewriting every record
+        #   and when lazily scaled, including increments committed in between and renormalization once below minCountScale
+        histogramQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                histogram, time_diff_sum, patient_histogram, patient_time_diff_sum, patient_time_diff_sum_squares
+            from
+                clinical_item_association_histogram
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+        def loadHistogramStats():
+            histogramStats = list();
+            for row in DBUtil.execute(histogramQuery):
+                histogramStats.append( list(row[:2]) + parseHistogram(row[2]).tolist() + [row[3]] + parseHistogram(row[4]).tolist() + list(row[5:]) );
+            return histogramStats;
+
+        analyzer = AssociationAnalysis();
+        analysisOptionsList = [AnalysisOptions(), AnalysisOptions()];
+        analysisOptionsList[0].patientIds = [-22222, -33333];
+        analysisOptionsList[1].patientIds = [-11111];
+        for analysisOptions in analysisOptionsList:
+            analysisOptions.histogramStorage = True;
+
+        decayAnalysisOptions = DecayAnalysisOptions()
+        decayAnalysisOptions.decay = 0.5
+        decayAnalysisOptions.minCountScale = 0.3;   # Renormalize on the second decay
+
+        for analysisOptions in analysisOptionsList:
+            analyzer.analyzePatientItems(analysisOptions);
+            self.decayAnalyzer.standardDecay(decayAnalysisOptions);
+        expectedHistogramStats = loadHistogramStats();
+        self.assertTrue( len(expectedHistogramStats) > 0 );
+
+        # Reset and repeat with lazy decay
+        self.dataManager.resetAssociationModel()
+        analyzer.analyzePatientItems(analysisOptionsList[0]);
+        undecayedHistogramStats = loadHistogramStats();
+        self.decayAnalyzer.lazyDecay(decayAnalysisOptions);
+        self.assertEqual( 0.5, self.dataManager.getAssociationCountScale() );
+        self.assertEqualTable( undecayedHistogramStats, loadHistogramStats(), precision=9 );  # Not rewritten yet
+        analyzer.analyzePatientItems(analysisOptionsList[1]);
+        self.decayAnalyzer.lazyDecay(decayAnalysisOptions);
+
+        self.assertEqual( 1.0, self.dataManager.getAssociationCountScale() );   # Renormalized
+        self.assertEqualTable( expectedHistogramStats, loadHistogramStats(), precision=9 );
+
     def test_resetModel(self):
         associationQuery = \
             """
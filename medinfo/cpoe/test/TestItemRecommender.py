@@ -2,6 +2,7 @@
 """Test case for respective module in application package"""
 
 import sys, os
+import tempfile;
 from cStringIO import StringIO
 from datetime import datetime, timedelta;
 import unittest
@@ -18,6 +19,8 @@ from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.db.ResultsFormatter import TabDictReader;
 
 from medinfo.cpoe.DataManager import DataManager;
+from medinfo.cpoe.AssociationIndex import AssociationIndex;
+from medinfo.cpoe.NeighborIndex import NeighborIndex;
 from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, RecommenderQuery;
 from medinfo.cpoe.ItemRecommender import SIMULATED_PATIENT_COUNT;
 
@@ -490,6 +493,157 @@ class TestItemRecommender(DBTestCase):
         self.assertEqualRecommendedData( baselineData, newData, query );
         self.assertEqual( baselineQueryCount, newQueryCount );  # Expect no queries for subsets
 
+    def test_recommendBatch(self):
+        # Batch of queries with shared loading should give the same results as separate queries
+        queryParamsList = \
+            [   {"queryItemIds": "-2,-5,-100"},
+                {"queryItemIds": "-2"},
+                {"queryItemIds": "-5,-6", "timeDeltaMax": "3600"},
+                {"queryItemIds": "-2,-5", "countPrefix": "patient_", "aggregationMethod": "SerialBayes"},
+                {"queryItemIds": "-4,-6", "invertQuery": "true"},
+                {"queryItemIds": "-100"},   # No association data, so default recommendations
+                {},
+            ];
+        queries = list();
+        for queryParams in queryParamsList:
+            query = RecommenderQuery();
+            query.parseParams(dict(queryParams));
+            query.limit = 3;
+            query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+            queries.append(query);
+
+        for dataCache in (None, dict()):
+            self.recommender.dataManager.dataCache = dataCache;
+            recommendedDataList = self.recommender.recommendBatch(queries);
+            self.assertEqual( len(queries), len(recommendedDataList) );
+            for query, recommendedData in zip(queries, recommendedDataList):
+                expectedData = self.recommender( query );
+                self.assertEqualRecommendedData( expectedData, recommendedData, query );
+                for expectedItem, recommendedItem in zip(expectedData, recommendedData):
+                    self.assertAlmostEqual( expectedItem["score"], recommendedItem["score"], 5 );
+
+    def test_topScoreIndexes(self):
+        # Partial selection of the top scores should give the same ranking as fully sorting, including ties at the limit
+        scores = [0.5, 0.9, 0.1, 0.9, 0.3, 0.5, 0.5, 0.7];
+        itemIds = [-1, -2, -3, -4, -5, -6, -7, -8];
+
+        self.assertEqual( [3, 1, 7, 6, 5, 0, 4, 2], ItemAssociationRecommender.topScoreIndexes(scores, itemIds) );
+        self.assertEqual( [3, 1, 7, 6, 5, 0, 4, 2], ItemAssociationRecommender.topScoreIndexes(scores, itemIds, limit=20) );
+        self.assertEqual( [3, 1, 7, 6], ItemAssociationRecommender.topScoreIndexes(scores, itemIds, limit=4) );
+        self.assertEqual( [3, 1, 7, 6, 5], ItemAssociationRecommender.topScoreIndexes(scores, itemIds, limit=5) );
+        self.assertEqual( [], ItemAssociationRecommender.topScoreIndexes(scores, itemIds, limit=0) );
+        self.assertEqual( [2, 4, 6], ItemAssociationRecommender.topScoreIndexes(scores, itemIds, limit=3, sortReverse=False) );
+
+    def test_associationIndex(self):
+        # Export association counts to a CSR index file and verify recommendations served from it match those from the database
+        (fd, indexFilename) = tempfile.mkstemp(suffix=".npy");
+        os.close(fd);
+        try:
+            AssociationIndex().exportIndex(indexFilename);
+            associationIndex = AssociationIndex(indexFilename);
+
+            # Zero count association records are not exported
+            (entryPositions, targetItemIds) = associationIndex.itemEntries(-2);
+            self.assertEqual( [-6,-4,-2], targetItemIds.tolist() );
+            (entryPositions, sourceItemIds) = associationIndex.itemEntries(-4, inverted=True);
+            self.assertEqual( [-6,-5,-4,-2], sourceItemIds.tolist() );
+
+            # Base counts and patient count looked up from the index, consistent with the database
+            baseCountModelsByItemId = associationIndex.loadBaseCountModelsByItemId("patient_");
+            baseCountTable = DBUtil.execute("select clinical_item_id, patient_count from clinical_item where analysis_status <> 0 and clinical_item_id < 0");
+            for (itemId, patientCount) in baseCountTable:
+                self.assertTrue( itemId in baseCountModelsByItemId );
+                self.assertAlmostEqual( patientCount, baseCountModelsByItemId[itemId]["patient_count"] );
+            self.assertFalse( -100 in baseCountModelsByItemId );
+            self.assertEqual( None, baseCountModelsByItemId.get(-100) );
+            expectedPatients = self.recommender.totalPatientCount( RecommenderQuery(), conn=None );
+            self.recommender.associationIndex = associationIndex;
+            self.assertEqual( expectedPatients, self.recommender.totalPatientCount( RecommenderQuery(), conn=None ) );
+
+            headers = ["clinical_item_id","score","nAB","nA","nB","N"];
+            queryParamsList = \
+                [   {"queryItemIds": "-2,-5,-100"},
+                    {"queryItemIds": "-2,-5,-100", "timeDeltaMax": "3600"},
+                    {"queryItemIds": "-2,-5", "countPrefix": "patient_", "aggregationMethod": "NaiveBayes"},
+                    {"queryItemIds": "-2,-5", "excludeCategoryIds": "-2"},
+                    {"queryItemIds": "-4,-6", "invertQuery": "true"},
+                    {"queryItemIds": "-4", "invertQuery": "true", "timeDeltaMax": "86400", "excludeItemIds": "-2"},
+                ];
+            for queryParams in queryParamsList:
+                query = RecommenderQuery();
+                query.parseParams(dict(queryParams));
+                query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+
+                self.recommender.associationIndex = None;
+                expectedData = self.recommender( query );
+
+                self.recommender.associationIndex = associationIndex;
+                recommendedData = self.recommender( query );
+
+                self.assertTrue( len(expectedData) > 0 );
+                self.assertEqual( len(expectedData), len(recommendedData) );
+                for expectedItem, recommendedItem in zip(expectedData, recommendedData):
+                    for header in headers:
+                        self.assertAlmostEqual( expectedItem[header], recommendedItem[header], 5 );
+        finally:
+            self.recommender.associationIndex = None;
+            os.remove(indexFilename);
+
+    def test_neighborIndex(self):
+        # Precompute top neighbor lists and verify single item queries served from them match calculated recommendations
+        (fd, indexFilename) = tempfile.mkstemp(suffix=".npy");
+        os.close(fd);
+        try:
+            baseQuery = RecommenderQuery();
+            baseQuery.limit = 3;
+            baseQuery.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+            neighborIndex = NeighborIndex();
+            neighborIndex.exportIndex(indexFilename, baseQuery, countPrefixes=["","patient_"], timeDeltaSecondsOptions=[None,3600], sortFields=["PPV","P-YatesChi2-NegLog"]);
+            neighborIndex = NeighborIndex(indexFilename);
+
+            headers = ["clinical_item_id","score","nAB","nA","nB","N"];
+            # Query params and whether expect them to be served from the neighbor lists
+            queryParamsList = \
+                [   ({"queryItemIds": "-2"}, True),
+                    ({"queryItemIds": "-5", "timeDeltaMax": "3600", "resultCount": "2"}, True),
+                    ({"queryItemIds": "-2", "countPrefix": "patient_", "sortField": "P-YatesChi2-NegLog"}, True),
+                    ({"queryItemIds": "-5", "excludeItemIds": "-2"}, True),    # Extra excluded items drop out of the list
+                    ({"queryItemIds": "-2", "resultCount": "10"}, True),   # Stored list has all of the neighbors
+                    ({"queryItemIds": "-4"}, True),
+                    ({"queryItemIds": "-4", "resultCount": "10"}, False),  # Full length stored list may be missing further neighbors
+                    ({"queryItemIds": "-2", "timeDeltaMax": "86400"}, False), # No list for the time window
+                    ({"queryItemIds": "-2", "sortField": "RR"}, False),
+                    ({"queryItemIds": "-2", "excludeCategoryIds": "-2"}, False),
+                    ({"queryItemIds": "-2,-5"}, False),
+                    ({"queryItemIds": "-100"}, False),  # No association data, so default recommendations
+                ];
+            for queryParams, expectServed in queryParamsList:
+                query = RecommenderQuery();
+                query.parseParams(dict(queryParams));
+                query.limit = query.limit or 3;
+                query.maxRecommendedId = 0;
+                self.assertEqual( expectServed, neighborIndex.loadResults(query) is not None );
+
+                self.recommender.neighborIndex = None;
+                expectedData = self.recommender( query );
+
+                self.recommender.neighborIndex = neighborIndex;
+                queryCount = self.recommender.dataManager.queryCount;
+                recommendedData = self.recommender( query );
+                recommendedDataList = self.recommender.recommendBatch([query]);
+                if expectServed:
+                    self.assertEqual( queryCount, self.recommender.dataManager.queryCount );  # No DB queries needed
+
+                self.assertTrue( len(expectedData) > 0 );
+                for recommendedData in (recommendedData, recommendedDataList[0]):
+                    self.assertEqual( len(expectedData), len(recommendedData) );
+                    for expectedItem, recommendedItem in zip(expectedData, recommendedData):
+                        for header in headers:
+                            self.assertAlmostEqual( expectedItem[header], recommendedItem[header], 5 );
+        finally:
+            self.recommender.neighborIndex = None;
+            os.remove(indexFilename);
+
 def suite():
     """Returns the suite of tests to run for this test class / module.
     Use unittest.makeSuite methods which simply extracts all of the
@@ -15,6 +15,7 @@ from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 
 from medinfo.cpoe.TripleAssociationAnalysis import TripleAssociationAnalysis;
+from medinfo.cpoe.DataManager import DataManager;
 
 class TestTripleAssociationAnalysis(DBTestCase):
     def setUp(self):
@@ -153,6 +154,45 @@ class TestTripleAssociationAnalysis(DBTestCase):
         itemLinks = DBUtil.execute(itemLinkQuery);
         self.assertEqualTable( expectedItemLinks, itemLinks );
 
+    def test_analyzePatientItems_minPatientCount(self):
+        # Only items with enough support (patient counts from prior analysis) should be considered as triple starting items
+        associationQuery = \
+            """
+            select 
+                clinical_item_id, subsequent_item_id, 
+                count_0, count_3600, count_86400, count_604800, 
+                count_2592000, count_7776000, count_31536000,
+                count_any, 
+                time_diff_sum, time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0 and
+                count_any > 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        # Simulate item counts from prior association analysis
+        dataManager = DataManager();
+        DBUtil.execute("update clinical_item set patient_count = 0 where clinical_item_id < 0");
+        DBUtil.execute("update clinical_item set patient_count = 2 where clinical_item_id in (-10,-8)");
+        dataManager.setCacheData("clinicalItemCountsUpdated", "True");
+        try:
+            self.analyzer.minPatientCount = 2;
+            self.analyzer.analyzePatientItems( [-11111], (-15,-14), -16 );
+        finally:
+            dataManager.clearCacheData("clinicalItemCountsUpdated");
+
+        expectedAssociationStats = \
+            [
+                [-16,-16,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [-10,-16,   0, 0, 0, 0, 0, 2, 2, 2,  5101200.0+5187600.0, 5101200.0**2+5187600.0**2],
+                [ -8,-16,   0, 0, 0, 0, 0, 1, 1, 1,  5180400.0, 5180400.0**2],
+            ];
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
 
 def suite():
     """Returns the suite of tests to run for this test class / module.
@@ -45,3 +45,17 @@ CGI_TEXT_RESPONSE = False;
 # Whether to use a local memory data cache to reduce DB hits for web queries.  If left unchecked, this will result
 #   in excessive memory use / leak by the webserver
 USE_DATA_CACHE = True;
+# Bounds on the data cache size, by number of cached query results and (estimated) bytes.
+#   Least recently used results are evicted beyond these.  Set to None for no limit.
+DATA_CACHE_MAX_ENTRIES = 1000;
+DATA_CACHE_MAX_BYTES = 4*1024*1024*1024;
+
+# Association index file (see medinfo.cpoe.AssociationIndex) to look up item association and base counts from.
+#   Memory-mapped read-only, so all server processes share one copy of the model in memory (via the OS page cache)
+#   instead of each filling its own data cache from the database.  Leave as None to query the database.
+#   Re-export after association analysis updates.
+ASSOCIATION_INDEX_FILENAME = None;
+
+# Precomputed neighbor lists file (see medinfo.cpoe.NeighborIndex) to serve single item recommender queries from.
+#   Leave as None to always calculate recommendations.  Re-export after association analysis updates.
+NEIGHBOR_INDEX_FILENAME = None;
@@ -5,6 +5,9 @@ import Env;
 import Const
 import sys, os
 import logging
+from medinfo.common.Util import LRUCache;
+from medinfo.cpoe.AssociationIndex import AssociationIndex;
+from medinfo.cpoe.NeighborIndex import NeighborIndex;
 
 log = logging.getLogger("CDSS")
 log.setLevel(Const.LOGGER_LEVEL)
@@ -15,7 +18,19 @@ formatter = logging.Formatter(Const.LOGGER_FORMAT)
 handler.setFormatter(formatter)
 log.addHandler(handler)
 
-"""Persistent cache object to store query results in local memory for reuse later"""
+"""Persistent cache object to store query results in local memory for reuse later, bounded to avoid growing without limit"""
 webDataCache = None;
 if Env.USE_DATA_CACHE:
-    webDataCache = dict();
+    webDataCache = LRUCache(Env.DATA_CACHE_MAX_ENTRIES, Env.DATA_CACHE_MAX_BYTES);
+
+"""Shared (memory-mapped) association model for recommender queries.
+Mapped once per process (on import, so before any fork if the server preloads this module), with the pages shared by all processes.
+"""
+webAssociationIndex = None;
+if Env.ASSOCIATION_INDEX_FILENAME is not None:
+    webAssociationIndex = AssociationIndex(Env.ASSOCIATION_INDEX_FILENAME);
+
+"""Precomputed neighbor lists for single item recommender queries, memory-mapped once per process"""
+webNeighborIndex = None;
+if Env.NEIGHBOR_INDEX_FILENAME is not None:
+    webNeighborIndex = NeighborIndex(Env.NEIGHBOR_INDEX_FILENAME);
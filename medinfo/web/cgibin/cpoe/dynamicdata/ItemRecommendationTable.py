@@ -18,7 +18,7 @@ from medinfo.common.StatsUtil import ContingencyStats;
 
 from medinfo.web.cgibin.cpoe.dynamicdata.BaseDynamicData import BaseDynamicData;
 from medinfo.web.cgibin import Options;
-from medinfo.web.cgibin.Util import webDataCache;
+from medinfo.web.cgibin.Util import webDataCache, webAssociationIndex, webNeighborIndex;
 
 CONTROLS_TEMPLATE = \
     """
@@ -51,6 +51,8 @@ class ItemRecommendationTable(BaseDynamicData):
 
         self.recommender = ItemAssociationRecommender();  # Instance to test on
         self.recommender.dataManager.dataCache = webDataCache;
+        self.recommender.associationIndex = webAssociationIndex;
+        self.recommender.neighborIndex = webNeighborIndex;
 
         
     def action_default(self):
@@ -22,7 +22,7 @@ from medinfo.cpoe.cpoeSim.SimManager import SimManager, ClinicalItemQuery;
 
 from medinfo.web.cgibin.cpoe.dynamicdata.BaseDynamicData import BaseDynamicData;
 from medinfo.web.cgibin import Options;
-from medinfo.web.cgibin.Util import webDataCache;
+from medinfo.web.cgibin.Util import webDataCache, webAssociationIndex, webNeighborIndex;
 
 CATEGORY_HEADER_TEMPLATE = \
     """
@@ -120,6 +120,8 @@ class RelatedOrders(BaseDynamicData):
         # Recommender Instance to test on
         self.recommender = ItemAssociationRecommender();
         self.recommender.dataManager.dataCache = webDataCache;  # Allow caching of data for rapid successive queries
+        self.recommender.associationIndex = webAssociationIndex;  # Shared memory-mapped association counts, if available
+        self.recommender.neighborIndex = webNeighborIndex;  # Precomputed results for single item queries, if available
 
         query = RecommenderQuery();
         if self.requestData["sortField"] == "":
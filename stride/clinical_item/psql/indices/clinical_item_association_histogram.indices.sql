@@ -0,0 +1,6 @@
+-- Table: clinical_item_association_histogram
+
+CREATE INDEX IF NOT EXISTS clinical_item_association_histogram_clinical_item_id
+                            ON clinical_item_association_histogram(clinical_item_id, subsequent_item_id);
+CREATE INDEX IF NOT EXISTS clinical_item_association_histogram_subsequent_item_id
+                            ON clinical_item_association_histogram(subsequent_item_id, clinical_item_id);
@@ -0,0 +1,41 @@
+-- Table: clinical_item_association_histogram
+-- Description: Alternative compact storage of clinical_item_association stats
+--              (see AssociationAnalysis histogramStorage option). Rather than a
+--              column per cumulative time window, record a histogram of the
+--              time differences between each item pair, so the count within any
+--              time window is a prefix sum over the histogram bins.
+--              Item base counts (diagonal item pairs) are still recorded in
+--              clinical_item_association.
+
+CREATE TABLE IF NOT EXISTS clinical_item_association_histogram
+(
+    clinical_item_association_histogram_id SERIAL NOT NULL,
+    clinical_item_id BIGINT NOT NULL,
+    subsequent_item_id BIGINT NOT NULL,
+    CONSTRAINT clinical_item_association_histogram_pkey PRIMARY KEY (clinical_item_association_histogram_id),
+    CONSTRAINT clinical_item_association_histogram_clinical_item_fkey FOREIGN KEY (clinical_item_id) REFERENCES clinical_item(clinical_item_id),
+    CONSTRAINT clinical_item_association_histogram_subsequent_item_fkey FOREIGN KEY (subsequent_item_id) REFERENCES clinical_item(clinical_item_id),
+    CONSTRAINT clinical_item_association_histogram_composite_key UNIQUE (clinical_item_id, subsequent_item_id)
+);
+
+-- Number of times the subsequent item follows the primary clinical item, by
+-- time difference in seconds. Space separated list of only the non-zero bins,
+-- as "edge:count" entries, where each bin counts time differences greater
+-- than the prior bin edge, up to and including its own edge. The "any" bin
+-- counts differences beyond the last edge. Bin edges are listed in
+-- Const.HISTOGRAM_BIN_SECONDS. Counts may be floating point pseudo-counts.
+ALTER TABLE clinical_item_association_histogram ADD COLUMN histogram TEXT;
+-- Sum of differences in event times of subsequent vs. primary items, in seconds.
+ALTER TABLE clinical_item_association_histogram ADD COLUMN time_diff_sum DOUBLE PRECISION DEFAULT 0;
+-- Sum of squared difference values as above.
+ALTER TABLE clinical_item_association_histogram ADD COLUMN time_diff_sum_squares DOUBLE PRECISION DEFAULT 0;
+
+-- Similar stats, but only count once per patient.
+ALTER TABLE clinical_item_association_histogram ADD COLUMN patient_histogram TEXT;
+ALTER TABLE clinical_item_association_histogram ADD COLUMN patient_time_diff_sum DOUBLE PRECISION DEFAULT 0;
+ALTER TABLE clinical_item_association_histogram ADD COLUMN patient_time_diff_sum_squares DOUBLE PRECISION DEFAULT 0;
+
+-- Similar stats, but only count once per encounter.
+ALTER TABLE clinical_item_association_histogram ADD COLUMN encounter_histogram TEXT;
+ALTER TABLE clinical_item_association_histogram ADD COLUMN encounter_time_diff_sum DOUBLE PRECISION DEFAULT 0;
+ALTER TABLE clinical_item_association_histogram ADD COLUMN encounter_time_diff_sum_squares DOUBLE PRECISION DEFAULT 0;